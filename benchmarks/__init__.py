@@ -0,0 +1 @@
+"""Benchmarks of the Simple Database, run them from the root of the repository as modules"""
@@ -0,0 +1,76 @@
+"""
+Throughput of a thread-safe database accessed from several threads
+
+    > python -m benchmarks.concurrency --threads 1 2 4 8 --operations 200000
+
+Every thread runs on its own session a mix of SET, GET and NUMEQUALTO over a shared
+key space, and the total operations per second are reported for each number of threads.
+On a free-threaded build of CPython the threads run in parallel, on a build with the GIL
+the throughput is expected to stay flat, showing the cost of the locking.
+
+"""
+
+import argparse
+import random
+import sys
+import threading
+import time
+
+from simple_database import Database
+
+
+def run_thread(session, seed, operations, keys, values, barrier):
+    """Runs the operations of a single thread"""
+    generator = random.Random(seed)
+    commands = []
+    for _ in range(operations):
+        commands.append((generator.random(), 'key%d' % generator.randrange(keys), str(generator.randrange(values))))
+
+    barrier.wait()
+    for choice, key, value in commands:
+        if choice < 0.5:
+            session.set(key, value)
+        elif choice < 0.9:
+            session.get(key)
+        else:
+            session.num_equal_to(value)
+
+
+def run(threads, operations, keys, values, stripes):
+    """Runs the given number of threads, returns the total operations per second"""
+    database = Database(thread_safe=True, stripes=stripes)
+    barrier = threading.Barrier(threads + 1)
+    workers = [
+        threading.Thread(target=run_thread, args=(database.session(), seed, operations, keys, values, barrier))
+        for seed in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    return threads * operations / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Thread-safe database scaling benchmark')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--operations', type=int, default=200000, help='operations per thread')
+    parser.add_argument('--keys', type=int, default=100000)
+    parser.add_argument('--values', type=int, default=1000)
+    parser.add_argument('--stripes', type=int, default=64)
+    args = parser.parse_args()
+
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', lambda: True)
+    print('GIL enabled: %s' % is_gil_enabled())
+    baseline = None
+    for threads in args.threads:
+        throughput = run(threads, args.operations, args.keys, args.values, args.stripes)
+        if baseline is None:
+            baseline = throughput
+        print('%3d threads: %10.0f ops/sec (x%.2f)' % (threads, throughput, throughput / baseline))
+
+if __name__ == "__main__":
+    main()
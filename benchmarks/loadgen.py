@@ -0,0 +1,117 @@
+"""
+Load generator for the Simple Database server
+
+    > python server.py --port 6380
+    > python -m benchmarks.loadgen --port 6380 --connections 50 --pipeline 64 --seconds 10
+
+Every connection sends pipelines of commands and waits for all their replies before
+sending the next one. Since SET does not reply, each pipeline is built so the number of
+reply lines is known in advance. Reports the throughput in commands per second and the
+latency percentiles of a whole pipeline.
+
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+
+def build_pipeline(generator, size, keys, values):
+    """Builds a pipeline of commands
+
+    Returns:
+        a tuple, containing the bytes to send and the number of reply lines expected
+    """
+    lines = []
+    replies = 0
+    for _ in range(size):
+        choice = generator.random()
+        key = 'key%d' % generator.randrange(keys)
+        if choice < 0.5:
+            lines.append('GET %s' % key)
+            replies += 1
+        elif choice < 0.9:
+            lines.append('SET %s %d' % (key, generator.randrange(values)))
+        else:
+            lines.append('NUMEQUALTO %d' % generator.randrange(values))
+            replies += 1
+    lines.append('')
+    return ('\n'.join(lines).encode('utf-8'), replies)
+
+
+async def run_connection(args, seed, deadline, latencies):
+    """Runs the pipelines of a single connection until the deadline, returns the commands sent"""
+    if args.unix:
+        reader, writer = await asyncio.open_unix_connection(args.unix)
+    else:
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+
+    generator = random.Random(seed)
+    pipelines = [build_pipeline(generator, args.pipeline, args.keys, args.values) for _ in range(16)]
+    commands = 0
+    index = 0
+    while time.perf_counter() < deadline:
+        payload, replies = pipelines[index % len(pipelines)]
+        index += 1
+
+        start = time.perf_counter()
+        writer.write(payload)
+        await writer.drain()
+        for _ in range(replies):
+            await reader.readline()
+        latencies.append(time.perf_counter() - start)
+        commands += args.pipeline
+
+    writer.write(b'END\n')
+    await writer.drain()
+    writer.close()
+    await writer.wait_closed()
+    return commands
+
+
+def percentile(sorted_values, fraction):
+    """Returns the value at the given fraction (0 to 1) of a sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+async def run(args):
+    """Runs all connections concurrently and returns a dictionary with the results"""
+    latencies = []
+    start = time.perf_counter()
+    deadline = start + args.seconds
+    counts = await asyncio.gather(*[
+        run_connection(args, seed, deadline, latencies) for seed in range(args.connections)
+    ])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'commands': sum(counts),
+        'ops_per_sec': sum(counts) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': percentile(latencies, 1.0) * 1000
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator for the Simple Database server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6380)
+    parser.add_argument('--unix', help='Unix socket path to connect to instead of TCP')
+    parser.add_argument('--connections', type=int, default=50)
+    parser.add_argument('--pipeline', type=int, default=64, help='commands sent per pipeline')
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--keys', type=int, default=100000)
+    parser.add_argument('--values', type=int, default=1000)
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print('%(commands)d commands, %(ops_per_sec).0f ops/sec, pipeline latency '
+          'p50 %(p50_ms).3f ms, p99 %(p99_ms).3f ms, max %(max_ms).3f ms' % results)
+
+if __name__ == "__main__":
+    main()
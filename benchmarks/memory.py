@@ -0,0 +1,61 @@
+"""
+Memory used per key by the default and the compact storage
+
+    > python -m benchmarks.memory --keys 1000000 10000000 50000000 --values 5000
+
+Loads the given number of keys, all of them set to one of a few thousand distinct values,
+and reports the bytes per key measured as the growth of the resident memory of the
+process. Each measure runs in a fresh process, so they do not affect each other.
+Values are built as new strings for every key, like the ones parsed from commands.
+
+"""
+
+import argparse
+import subprocess
+import sys
+
+from simple_database import Database
+
+
+MODES = ('default', 'compact')
+
+
+def resident_memory():
+    """Returns the resident memory of the process in bytes"""
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * 4096
+
+
+def measure(mode, keys, values, batch_size=100000):
+    """Loads the keys into a new database, returns the bytes per key"""
+    before = resident_memory()
+    database = Database(compact=(mode == 'compact'))
+    for start in range(0, keys, batch_size):
+        end = min(start + batch_size, keys)
+        database.mset(dict(('key:%d' % index, 'value:%d' % (index % values)) for index in range(start, end)))
+    return (resident_memory() - before) / float(keys)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bytes per key of the default and compact storage')
+    parser.add_argument('--keys', type=int, nargs='+', default=[1000000, 10000000, 50000000])
+    parser.add_argument('--values', type=int, default=5000, help='number of distinct values')
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print('%.1f' % measure(args.child, args.keys[0], args.values))
+        return
+
+    print('%12s %12s %12s' % ('keys', 'default', 'compact'))
+    for keys in args.keys:
+        results = []
+        for mode in MODES:
+            output = subprocess.check_output([sys.executable, '-m', 'benchmarks.memory', '--child', mode,
+                                              '--keys', str(keys), '--values', str(args.values)])
+            results.append(output.decode().strip())
+        print('%12d %12s %12s' % (keys, results[0], results[1]))
+
+if __name__ == "__main__":
+    main()
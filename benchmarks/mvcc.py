@@ -0,0 +1,73 @@
+"""
+Read throughput of a multi-version database while heavy commits are running
+
+    > python -m benchmarks.mvcc --keys 100000 --seconds 3
+
+Measures the reads per second of a thread reading consistent batches of keys through
+snapshots, first alone and then while another thread keeps committing large transactions.
+Readers never wait for the commits, on a build with the GIL both threads share a single
+core, so the throughput is expected to drop by the share of time taken by the writer.
+
+"""
+
+import argparse
+import threading
+import time
+
+from simple_database import Database
+
+
+def read_batches(database, keys, batch_size, seconds):
+    """Reads batches of keys through snapshots for the given seconds, returns the reads per second"""
+    reads = 0
+    index = 0
+    deadline = time.perf_counter() + seconds
+    start = time.perf_counter()
+    while time.perf_counter() < deadline:
+        batch = keys[index:index + batch_size]
+        index = (index + batch_size) % len(keys)
+        database.mget(batch)
+        reads += len(batch)
+    return reads / (time.perf_counter() - start)
+
+
+def commit_forever(database, keys, commit_size, stop):
+    """Commits transactions of the given size until stop is set"""
+    value = 0
+    while not stop.is_set():
+        value += 1
+        database.begin()
+        for key in keys[:commit_size]:
+            database.set(key, str(value))
+        database.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MVCC read throughput under concurrent commits')
+    parser.add_argument('--keys', type=int, default=100000)
+    parser.add_argument('--batch', type=int, default=100, help='keys read per snapshot')
+    parser.add_argument('--commit-size', type=int, default=10000, help='keys modified per commit')
+    parser.add_argument('--seconds', type=float, default=3.0)
+    args = parser.parse_args()
+
+    database = Database(mvcc=True)
+    keys = ['key%d' % index for index in range(args.keys)]
+    database.mset(dict.fromkeys(keys, '0'))
+
+    alone = read_batches(database, keys, args.batch, args.seconds)
+
+    stop = threading.Event()
+    writer = database.session()
+    thread = threading.Thread(target=commit_forever, args=(writer, keys, args.commit_size, stop))
+    thread.start()
+    try:
+        concurrent = read_batches(database, keys, args.batch, args.seconds)
+    finally:
+        stop.set()
+        thread.join()
+
+    print('reads/sec alone: %.0f' % alone)
+    print('reads/sec while committing %d keys per commit: %.0f' % (args.commit_size, concurrent))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Scaling of the range queries as the number of distinct values grows
+
+    > python -m benchmarks.ranges --values 2000 8000 32000 128000 --operations 20000
+
+For each number of distinct values, preloads a database with a range index and then
+alternates setting a key to a value never seen before with a NUMRANGE query, the worst case
+for an index that has to place new values in order. Both operations are expected to run in
+about logarithmic time, so the time per operation should barely grow with the values. The
+check fails, exiting with status 1, when the time per operation of the largest size is more
+than --max-growth times the one of the smallest size.
+
+"""
+
+import argparse
+import sys
+import time
+
+from simple_database import Database
+
+
+def run(values, operations):
+    """Runs the workload over a database with the given distinct values, returns the microseconds per operation"""
+    database = Database(range_index=True)
+    database.mset(dict(('key%d' % index, str(index * 2)) for index in range(values)))
+
+    start = time.perf_counter()
+    for operation in range(operations):
+        # odd values are never preloaded, so every SET adds a distinct value
+        database.set('new%d' % operation, str((operation * 7919 % values) * 2 + 1))
+        low = operation * 104729 % values
+        database.num_range(low, low + values // 10)
+    return (time.perf_counter() - start) * 1e6 / (2 * operations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scaling of NUMRANGE with the number of distinct values')
+    parser.add_argument('--values', type=int, nargs='+', default=[2000, 8000, 32000, 128000])
+    parser.add_argument('--operations', type=int, default=20000, help='SET and NUMRANGE pairs per size')
+    parser.add_argument('--max-growth', type=float, default=3.0,
+                        help='allowed ratio between the largest and the smallest size (default: %(default)s)')
+    args = parser.parse_args()
+
+    results = []
+    print('%10s %10s' % ('values', 'us/op'))
+    for values in sorted(args.values):
+        results.append(run(values, args.operations))
+        print('%10d %10.2f' % (values, results[-1]))
+
+    growth = results[-1] / results[0]
+    if growth > args.max_growth:
+        print('REGRESSION us/op grew %.1fx from %d to %d values' % (growth, min(args.values), max(args.values)))
+        sys.exit(1)
+    print('us/op grew %.1fx from %d to %d values' % (growth, min(args.values), max(args.values)))
+
+if __name__ == "__main__":
+    main()
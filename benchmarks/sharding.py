@@ -0,0 +1,61 @@
+"""
+Throughput of a sharded database with 1 shard and with N shards
+
+    > python -m benchmarks.sharding --shards 1 4 --batches 2000 --batch-size 500
+
+Runs batches of MSET and MGET (each batch is split by shard and sent to all of its
+shards in parallel) and NUMEQUALTO (scatter-gather), reporting the keys processed
+per second for each number of shards.
+
+"""
+
+import argparse
+import random
+import time
+
+from sharding import ShardedDatabase
+
+
+def run(shards, batches, batch_size, keys, values):
+    """Runs the workload on a database with the given number of shards, returns the keys per second"""
+    generator = random.Random(shards)
+    database = ShardedDatabase(shards)
+    try:
+        workload = []
+        for _ in range(batches):
+            batch = ['key%d' % generator.randrange(keys) for _ in range(batch_size)]
+            workload.append((batch, str(generator.randrange(values))))
+
+        processed = 0
+        start = time.perf_counter()
+        for index, (batch, value) in enumerate(workload):
+            if index % 2:
+                database.mget(batch)
+            else:
+                database.mset(dict.fromkeys(batch, value))
+            if index % 10 == 0:
+                database.num_equal_to(value)
+            processed += len(batch)
+        return processed / (time.perf_counter() - start)
+    finally:
+        database.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sharded database throughput benchmark')
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--batches', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--keys', type=int, default=1000000)
+    parser.add_argument('--values', type=int, default=1000)
+    args = parser.parse_args()
+
+    baseline = None
+    for shards in args.shards:
+        throughput = run(shards, args.batches, args.batch_size, args.keys, args.values)
+        if baseline is None:
+            baseline = throughput
+        print('%3d shards: %10.0f keys/sec (x%.2f)' % (shards, throughput, throughput / baseline))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+"""
+Benchmark suite of the Simple Database
+
+    > python -m benchmarks.suite --size small --save results.json
+    > python -m benchmarks.suite --size small --baseline results.json --tolerance 0.10
+    > python -m benchmarks.suite --workloads read_heavy huge_commit --modes console --engine undo
+
+Every workload is a deterministic list of commands (the same seed builds the same list)
+run over a database preloaded with some keys, in two modes:
+    database    the commands call the methods of a Database directly
+    console     the commands are text lines parsed and executed by a DBConsole, as they
+                are when read from a file, including the formatting of the output
+
+Each run happens in a fresh process, so the peak resident memory (RSS) belongs to that run
+alone, and reports the operations per second and the percentiles of the latency of every
+single command. The arguments that configure a database (see simple_database.add_arguments),
+such as --engine or --compact, are forwarded to every run.
+
+The results can be saved as a JSON baseline, and compared against a baseline: a run whose
+ops/sec drops, or whose p99 latency or peak RSS grows, by more than the tolerance is flagged
+as a regression and the suite exits with status 1.
+
+"""
+
+import argparse
+import bisect
+import itertools
+import json
+import random
+import resource
+import subprocess
+import sys
+import time
+
+from simple_database import DBConsole, add_arguments, open_database, open_stats, parse_command
+
+
+SIZES = {
+    'small':    {'keys': 10000,     'values': 100,      'operations': 100000},
+    'medium':   {'keys': 100000,    'values': 1000,     'operations': 300000},
+    'large':    {'keys': 1000000,   'values': 10000,    'operations': 1000000}
+}
+
+MODES = ('database', 'console')
+
+NESTING_DEPTH = 1000
+
+
+
+class Workload(object):
+    """Generator of the commands of a workload
+
+    Args:
+        seed: an integer, the seed of the random generator
+        keys: an integer, the number of distinct keys
+        values: an integer, the number of distinct values
+        operations: an integer, the number of commands to generate (approximately, for
+                    the workloads made of whole transactions)
+
+    Attributes:
+        generator: an object of type random.Random
+    """
+    def __init__(self, seed, keys, values, operations):
+        self.generator = random.Random(seed)
+        self.keys = keys
+        self.values = values
+        self.operations = operations
+
+    def preload(self):
+        """Returns a dictionary with the data loaded before running the commands"""
+        return dict(('key%d' % index, str(index % self.values)) for index in range(self.keys))
+
+    def keys_for(self, count):
+        """Returns a list of keys chosen at random"""
+        return ['key%d' % index for index in self.generator.choices(range(self.keys), k=count)]
+
+    def values_for(self, count):
+        """Returns a list of values chosen at random"""
+        return [str(index) for index in self.generator.choices(range(self.values), k=count)]
+
+    def mix(self, weights):
+        """Builds commands choosing each one by its weight, see WORKLOADS
+
+        Args:
+            weights: a list of tuples (name, weight), being name one of GET, SET, UNSET
+                     and NUMEQUALTO
+        """
+        names = self.generator.choices([name for name, _ in weights], [weight for _, weight in weights],
+                                       k=self.operations)
+        keys = self.keys_for(self.operations)
+        values = self.values_for(self.operations)
+        commands = []
+        for name, key, value in zip(names, keys, values):
+            if name == 'GET' or name == 'UNSET':
+                commands.append((name, [key]))
+            elif name == 'SET':
+                commands.append((name, [key, value]))
+            else:
+                commands.append((name, [value]))
+        return commands
+
+    def transaction(self, count):
+        """Builds the SET and UNSET commands of a transaction, one UNSET every ten commands"""
+        commands = []
+        keys = self.keys_for(count)
+        values = self.values_for(count)
+        for key, value, choice in zip(keys, values, self.generator.choices(range(10), k=count)):
+            if choice:
+                commands.append(('SET', [key, value]))
+            else:
+                commands.append(('UNSET', [key]))
+        return commands
+
+
+class SkewedWorkload(Workload):
+    """Workload whose keys and values follow a Zipf distribution (exponent 1), so a few of
+    them get most of the commands"""
+
+    def zipf(self, population, count):
+        """Returns a list of integers from 0 to population - 1, being 0 the most frequent"""
+        weights = list(itertools.accumulate(1.0 / rank for rank in range(1, population + 1)))
+        total = weights[-1]
+        uniform = self.generator.random
+        return [bisect.bisect_left(weights, uniform() * total) for _ in range(count)]
+
+    def keys_for(self, count):
+        """Returns a list of keys chosen with a Zipf distribution"""
+        return ['key%d' % index for index in self.zipf(self.keys, count)]
+
+    def values_for(self, count):
+        """Returns a list of values chosen with a Zipf distribution"""
+        return [str(index) for index in self.zipf(self.values, count)]
+
+
+def read_heavy(workload):
+    """90% GET, 10% SET"""
+    return workload.mix([('GET', 90), ('SET', 10)])
+
+
+def write_heavy(workload):
+    """20% GET, 70% SET, 10% UNSET"""
+    return workload.mix([('GET', 20), ('SET', 70), ('UNSET', 10)])
+
+
+def num_equal_to_heavy(workload):
+    """70% NUMEQUALTO, 30% SET"""
+    return workload.mix([('NUMEQUALTO', 70), ('SET', 30)])
+
+
+def skewed(workload):
+    """50% GET, 40% SET, 10% NUMEQUALTO, with skewed keys and values (see SkewedWorkload)"""
+    return workload.mix([('GET', 50), ('SET', 40), ('NUMEQUALTO', 10)])
+
+
+def deep_nesting(workload):
+    """Transactions NESTING_DEPTH levels deep, with a SET in every level, half of them are
+    rolled back level by level and the rest committed at once"""
+    commands = []
+    rounds = max(1, workload.operations // (2 * NESTING_DEPTH + 1))
+    for round_index in range(rounds):
+        keys = workload.keys_for(NESTING_DEPTH)
+        values = workload.values_for(NESTING_DEPTH)
+        for key, value in zip(keys, values):
+            commands.append(('BEGIN', []))
+            commands.append(('SET', [key, value]))
+        if round_index % 2:
+            commands.extend([('ROLLBACK', [])] * NESTING_DEPTH)
+        else:
+            commands.append(('COMMIT', []))
+    return commands
+
+
+def rollback_storm(workload):
+    """Short transactions of 10 commands that are always rolled back"""
+    commands = []
+    for _ in range(max(1, workload.operations // 12)):
+        commands.append(('BEGIN', []))
+        commands.extend(workload.transaction(10))
+        commands.append(('ROLLBACK', []))
+    return commands
+
+
+def huge_commit(workload):
+    """A few transactions modifying a large share of the keys, committed at once"""
+    commands = []
+    size = max(1, workload.keys // 2)
+    for _ in range(max(1, workload.operations // (size + 2))):
+        commands.append(('BEGIN', []))
+        commands.extend(workload.transaction(size))
+        commands.append(('COMMIT', []))
+    return commands
+
+
+WORKLOADS = {
+    'read_heavy':           (Workload, read_heavy),
+    'write_heavy':          (Workload, write_heavy),
+    'numequalto_heavy':     (Workload, num_equal_to_heavy),
+    'skewed':               (SkewedWorkload, skewed),
+    'deep_nesting':         (Workload, deep_nesting),
+    'rollback_storm':       (Workload, rollback_storm),
+    'huge_commit':          (Workload, huge_commit)
+}
+
+
+def percentile(sorted_values, fraction):
+    """Returns the value at the given fraction (0 to 1) of a sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def peak_rss():
+    """Returns the peak resident memory of the process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def bind(database, commands):
+    """Converts the commands into bound methods of the database and their arguments"""
+    methods = {
+        'GET':          database.get,
+        'SET':          database.set,
+        'UNSET':        database.unset,
+        'NUMEQUALTO':   database.num_equal_to,
+        'BEGIN':        database.begin,
+        'ROLLBACK':     database.rollback,
+        'COMMIT':       database.commit
+    }
+    return [(methods[name], arguments) for name, arguments in commands]
+
+
+def run(name, mode, size, seed, database_args):
+    """Runs a workload in the current process, returns a dictionary with the results"""
+    workload_type, build = WORKLOADS[name]
+    workload = workload_type(seed, **SIZES[size])
+    commands = build(workload)
+    database, persistence = open_database(database_args)
+    database.mset(workload.preload())
+
+    latencies = []
+    append = latencies.append
+    clock = time.perf_counter
+    if mode == 'database':
+        calls = bind(database, commands)
+        started = clock()
+        for method, arguments in calls:
+            start = clock()
+            method(*arguments)
+            append(clock() - start)
+    else:
+        console = DBConsole(database, persistence=persistence, stats=open_stats(database_args))
+        lines = ['%s %s' % (command, ' '.join(arguments)) for command, arguments in commands]
+        execute = console.execute
+        started = clock()
+        for line in lines:
+            start = clock()
+            execute(parse_command(line))
+            append(clock() - start)
+    elapsed = clock() - started
+    if persistence is not None:
+        persistence.close()
+
+    latencies.sort()
+    return {
+        'operations': len(latencies),
+        'ops_per_sec': len(latencies) / elapsed,
+        'p50_us': percentile(latencies, 0.50) * 1e6,
+        'p99_us': percentile(latencies, 0.99) * 1e6,
+        'p999_us': percentile(latencies, 0.999) * 1e6,
+        'max_us': percentile(latencies, 1.0) * 1e6,
+        'peak_rss_mb': peak_rss() / float(1 << 20)
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of strings describing each regression against the baseline
+
+    Only the runs present in both of them are compared.
+    """
+    regressions = []
+    for run_name, result in sorted(results.items()):
+        reference = baseline.get(run_name)
+        if reference is None:
+            continue
+        if result['ops_per_sec'] < reference['ops_per_sec'] * (1 - tolerance):
+            regressions.append('%s: ops/sec %.0f < %.0f' % (run_name, result['ops_per_sec'], reference['ops_per_sec']))
+        for metric in ('p99_us', 'peak_rss_mb'):
+            if result[metric] > reference[metric] * (1 + tolerance):
+                regressions.append('%s: %s %.1f > %.1f' % (run_name, metric, result[metric], reference[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark suite of the Simple Database')
+    parser.add_argument('--workloads', nargs='+', choices=sorted(WORKLOADS), default=sorted(WORKLOADS))
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--size', choices=sorted(SIZES), default='small')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help='path of a JSON file to save the results as a baseline')
+    parser.add_argument('--baseline', help='path of a JSON baseline to compare the results against')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='relative change considered a regression (default: %(default)s)')
+    parser.add_argument('--child', nargs=2, metavar=('WORKLOAD', 'MODE'), help=argparse.SUPPRESS)
+    args, database_argv = parser.parse_known_args()
+
+    database_parser = argparse.ArgumentParser()
+    add_arguments(database_parser)
+    database_args = database_parser.parse_args(database_argv)
+
+    if args.child:
+        name, mode = args.child
+        print(json.dumps(run(name, mode, args.size, args.seed, database_args)))
+        return
+
+    results = {}
+    print('%-18s %-9s %12s %10s %10s %10s %10s %9s' % ('workload', 'mode', 'ops/sec', 'p50 us', 'p99 us',
+                                                      'p99.9 us', 'max us', 'rss MB'))
+    for name in args.workloads:
+        for mode in args.modes:
+            output = subprocess.check_output([sys.executable, '-m', 'benchmarks.suite', '--child', name, mode,
+                                              '--size', args.size, '--seed', str(args.seed)] + database_argv)
+            result = json.loads(output.decode())
+            results['%s/%s' % (name, mode)] = result
+            print('%-18s %-9s %12.0f %10.2f %10.2f %10.2f %10.1f %9.1f' % (
+                name, mode, result['ops_per_sec'], result['p50_us'], result['p99_us'], result['p999_us'],
+                result['max_us'], result['peak_rss_mb']))
+
+    if args.save:
+        with open(args.save, 'w') as output_file:
+            json.dump({'size': args.size, 'seed': args.seed, 'options': database_argv, 'results': results},
+                      output_file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as input_file:
+            baseline = json.load(input_file)
+        if baseline.get('size') != args.size:
+            print('baseline size %s does not match %s, nothing compared' % (baseline.get('size'), args.size))
+            return
+        if baseline.get('options') != database_argv:
+            print('baseline options %s differ from %s' % (' '.join(baseline.get('options', [])), ' '.join(database_argv)))
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for regression in regressions:
+            print('REGRESSION %s' % regression)
+        if regressions:
+            sys.exit(1)
+        print('no regressions against %s' % args.baseline)
+
+if __name__ == "__main__":
+    main()
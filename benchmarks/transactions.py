@@ -0,0 +1,62 @@
+"""
+Transactions per second of the redo and the undo transaction engines
+
+    > python -m benchmarks.transactions --transactions 100000 --writes 10
+
+Runs three workloads over a database preloaded with some keys:
+    commit: every transaction writes some keys and commits
+    rollback: every transaction writes some keys and rolls back
+    nested: every transaction opens as many nested transactions as writes, writing one
+            key in each of them, and commits all of them at once
+
+"""
+
+import argparse
+import time
+
+from simple_database import Database, ENGINES
+
+
+WORKLOADS = ('commit', 'rollback', 'nested')
+
+
+def run(engine, workload, transactions, writes, keys):
+    """Runs the workload in a new database, returns the transactions per second"""
+    database = Database(engine=engine)
+    database.mset(dict(('key:%d' % index, str(index)) for index in range(keys)))
+    names = ['key:%d' % index for index in range(keys)]
+
+    start = time.perf_counter()
+    for transaction in range(transactions):
+        value = str(transaction)
+        offset = (transaction * writes) % keys
+        if workload == 'nested':
+            for write in range(writes):
+                database.begin()
+                database.set(names[(offset + write) % keys], value)
+            database.commit()
+        else:
+            database.begin()
+            for write in range(writes):
+                database.set(names[(offset + write) % keys], value)
+            if workload == 'commit':
+                database.commit()
+            else:
+                database.rollback()
+    return transactions / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Transactions per second of each transaction engine')
+    parser.add_argument('--transactions', type=int, default=100000)
+    parser.add_argument('--writes', type=int, default=10, help='keys written by each transaction')
+    parser.add_argument('--keys', type=int, default=100000, help='number of keys preloaded')
+    args = parser.parse_args()
+
+    print('%10s' % 'workload' + ''.join('%12s' % engine for engine in ENGINES))
+    for workload in WORKLOADS:
+        results = [run(engine, workload, args.transactions, args.writes, args.keys) for engine in ENGINES]
+        print('%10s' % workload + ''.join('%12d' % result for result in results))
+
+if __name__ == "__main__":
+    main()
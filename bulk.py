@@ -0,0 +1,353 @@
+"""
+Bulk import and export for the Simple Database
+
+    Formats:
+        csv      one pair per line, key,value with the quoting rules of the csv module.
+                 Quoted fields must not contain line breaks, since the file is split by lines
+        tsv      one pair per line, key<TAB>value
+        jsonl    one JSON document per line, either {"key": "a", "value": "1"} or ["a", "1"].
+                 A null value removes the key, and numbers are converted into strings
+
+    Keys and values must be non-empty strings without whitespace, as in the SET command. A
+    file with an invalid line is not imported, and the error reports the number of the line.
+
+    The format is detected from the extension of the file (.csv, .tsv, .jsonl or .ndjson)
+    unless it is given. There is no header line.
+
+    Import:
+        Setting every pair through SET reads the previous value of each key and updates the
+        frequency of both values one key at a time. Instead, the file is split in ranges of
+        whole lines that are parsed by several processes, each one building a dictionary
+        with the latest value of each key of its range. The dictionaries are merged in file
+        order with dict.update, and the values frequency is counted once at the end (the
+        counts of each range are added up, unless a key appears in several ranges or is
+        removed). If the database is empty, the result replaces its content at once as a
+        snapshot does (Data.load), otherwise each range is applied as a regular batch once all of
+        them are parsed.
+
+    Export:
+        The committed pairs are written as they are iterated, so the dataset is never copied.
+
+"""
+
+import csv
+import io
+import json
+import math
+import multiprocessing
+import os
+import re
+import time
+from collections import Counter
+
+
+FORMATS = ('csv', 'tsv', 'jsonl')
+
+EXTENSIONS = {
+    '.csv':     'csv',
+    '.tsv':     'tsv',
+    '.jsonl':   'jsonl',
+    '.ndjson':  'jsonl'
+}
+
+RANGE_SIZE = 1 << 25
+
+LOAD_BATCH_SIZE = 1 << 12
+
+WHITESPACE = re.compile(r'\s')
+
+
+
+def detect_format(path, format=None):
+    """Returns the format of a file, the given one or else the one of its extension
+
+    Raises:
+        ValueError: if the format is not one of FORMATS, or it cannot be detected
+    """
+    if format is None:
+        format = EXTENSIONS.get(os.path.splitext(path)[1].lower())
+        if format is None:
+            raise ValueError('unknown format of %s, expected one of %s' % (path, ', '.join(FORMATS)))
+    format = format.lower()
+    if format not in FORMATS:
+        raise ValueError('invalid format %r, expected one of %s' % (format, ', '.join(FORMATS)))
+    return format
+
+
+class RecordError(ValueError):
+    """Error raised when a line of a file is not a valid pair
+
+    Attributes:
+        line: an integer, the number of the line in the file, starting at 1
+        message: an string describing the error
+    """
+    def __init__(self, line, message):
+        super(RecordError, self).__init__(line, message)
+        self.line = line
+        self.message = message
+
+    def __str__(self):
+        return 'line %d: %s' % (self.line, self.message)
+
+
+def check_pair(line, key, value):
+    """Returns the pair of a line as it is stored, coercing numeric JSON values into strings
+
+    Keys and values are written as they are into the command log, which splits each line by
+    whitespace, so both must be non-empty strings without whitespace. None is a valid value,
+    meaning that the key is removed.
+
+    Raises:
+        RecordError: if the key or the value is not valid
+    """
+    if not isinstance(key, str) or not key or WHITESPACE.search(key):
+        raise RecordError(line, 'invalid key %r, expected a non-empty string without whitespace' % (key,))
+    if value is None or isinstance(value, str):
+        if value is None or (value and not WHITESPACE.search(value)):
+            return (key, value)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value):
+        return (key, str(value))
+    raise RecordError(line, 'invalid value %r of key %r, expected a non-empty string without whitespace' %
+                      (value, key))
+
+
+def parse_text(text, format):
+    """Parses the pairs of several lines
+
+    Args:
+        text: an string with whole lines
+        format: an string, one of FORMATS
+
+    Returns:
+        a tuple, containing the number of rows parsed and a dictionary mapping each key to
+        its latest value, being None the value of the keys removed
+
+    Raises:
+        RecordError: if a line is not a valid pair, see check_pair
+    """
+    pairs = {}
+    rows = 0
+    if format == 'csv':
+        reader = csv.reader(io.StringIO(text, newline=''))
+        for row in reader:
+            if not row:
+                continue
+            line = reader.line_num
+            if len(row) != 2:
+                raise RecordError(line, 'expected a key and a value, found %r' % (row,))
+            key, value = check_pair(line, row[0], row[1])
+            pairs[key] = value
+            rows += 1
+        return (rows, pairs)
+
+    for line, text_line in enumerate(text.split('\n'), 1):
+        if format == 'tsv':
+            if not text_line or text_line == '\r':
+                continue
+            row = text_line.rstrip('\r').split('\t')
+            if len(row) != 2:
+                raise RecordError(line, 'expected a key and a value separated by a tab')
+            key, value = check_pair(line, row[0], row[1])
+        else:
+            if not text_line.strip():
+                continue
+            try:
+                document = json.loads(text_line)
+            except ValueError as error:
+                raise RecordError(line, 'invalid JSON, %s' % error)
+            if isinstance(document, dict) and 'key' in document:
+                key, value = check_pair(line, document['key'], document.get('value'))
+            elif isinstance(document, list) and len(document) == 2:
+                key, value = check_pair(line, document[0], document[1])
+            else:
+                raise RecordError(line, 'expected {"key": ..., "value": ...} or [key, value]')
+        pairs[key] = value
+        rows += 1
+    return (rows, pairs)
+
+
+def split_ranges(path, range_size=RANGE_SIZE):
+    """Splits a file in ranges of about range_size bytes that end at an end of line
+
+    Returns:
+        a list of tuples (start, end) with the byte offsets of each range
+    """
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as input_file:
+        start = 0
+        while start < size:
+            input_file.seek(min(start + range_size, size))
+            input_file.readline()
+            end = min(input_file.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def parse_range(task):
+    """Parses the pairs of a range of a file and counts their values, run by the workers
+
+    Args:
+        task: a tuple (path, format, start, end)
+
+    Returns:
+        a tuple, containing the number of rows parsed, a dictionary mapping each key to its
+        latest value and a Counter with the frequency of the values of the dictionary
+    """
+    path, format, start, end = task
+    with open(path, 'rb') as input_file:
+        input_file.seek(start)
+        content = input_file.read(end - start)
+    try:
+        rows, pairs = parse_text(content.decode('utf-8'), format)
+    except RecordError as error:
+        # the lines before the range are only counted to report the error
+        with open(path, 'rb') as input_file:
+            lines_before = input_file.read(start).count(b'\n')
+        raise RecordError(error.line + lines_before, error.message)
+    return (rows, pairs, Counter(pairs.values()))
+
+
+def read_ranges(path, format, processes=None, range_size=RANGE_SIZE):
+    """Generator that yields the parsed ranges of a file in order, see parse_range
+
+    Args:
+        processes: an integer, the number of worker processes, None for one per CPU.
+                   A file with a single range is parsed by the current process
+    """
+    tasks = [(path, format, start, end) for start, end in split_ranges(path, range_size)]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if len(tasks) <= 1 or processes <= 1:
+        for task in tasks:
+            yield parse_range(task)
+        return
+    with multiprocessing.get_context().Pool(min(processes, len(tasks))) as pool:
+        for result in pool.imap(parse_range, tasks):
+            yield result
+
+
+def import_file(database, path, format=None, processes=None, range_size=RANGE_SIZE):
+    """Imports all the pairs of a file into the committed data of a database
+
+    Running Time: O(n / p + k)
+    Being 'n' the number of rows, 'p' the number of processes and 'k' the number of keys
+    imported, since merging the ranges and counting the values run at C speed
+
+    Args:
+        database: an object of type Database, or any object with an mset method such as a
+                  ShardedDatabase, which imports each range as a batch
+        path: an string, the path of the file
+        format: an string, one of FORMATS, or None to detect it from the extension
+
+    Returns:
+        a tuple, containing the number of rows imported and the seconds taken
+
+    Raises:
+        ValueError: if the format is not valid, a line is not a valid pair or a transaction
+                    is open
+    """
+    started = time.perf_counter()
+    format = detect_format(path, format)
+    if database.is_transaction_active():
+        raise ValueError('the import is not allowed within a transaction')
+
+    data = getattr(database, 'database', None)
+    ranges = read_ranges(path, format, processes, range_size)
+    total_rows = 0
+    if data is None or data.data:
+        # every range is parsed, so every line is validated, before any of them is applied
+        for rows, pairs, _ in list(ranges):
+            if data is None:
+                database.mset(pairs)
+            else:
+                data.apply(pairs)
+            total_rows += rows
+        return (total_rows, time.perf_counter() - started)
+
+    imported = {}
+    values_freq = Counter()
+    ranges_size = 0
+    for rows, pairs, freq in ranges:
+        imported.update(pairs)
+        values_freq.update(freq)
+        ranges_size += len(pairs)
+        total_rows += rows
+    if None in values_freq or len(imported) != ranges_size:
+        if None in values_freq:
+            for key in [key for key, value in imported.items() if value is None]:
+                del imported[key]
+        values_freq = Counter(imported.values())
+    load(data, imported, dict(values_freq))
+    return (total_rows, time.perf_counter() - started)
+
+
+def load(data, imported, values_freq):
+    """Replaces the content of an empty Data with the pairs imported
+
+    The listeners that are rebuilt on load (on_load), such as the indexes, are rebuilt. The
+    rest of them, such as a command log, are notified of the pairs as changes in batches.
+    """
+    data.load(imported, values_freq)
+    listeners = [listener for listener in data.listeners if not hasattr(listener, 'on_load')]
+    if not listeners:
+        return
+    batch = []
+    for key, value in data.data.items():
+        batch.append((key, None, value))
+        if len(batch) == LOAD_BATCH_SIZE:
+            for listener in listeners:
+                listener.on_commit(batch)
+            batch = []
+    if batch:
+        for listener in listeners:
+            listener.on_commit(batch)
+
+
+def dump(database):
+    """Generator that yields every committed pair (key, value), without copying the data
+
+    Keys whose time to live is over are removed first. The data must not be modified while
+    the generator is consumed.
+
+    Raises:
+        ValueError: if the database does not expose its committed data, such as a ShardedDatabase
+    """
+    data = getattr(database, 'database', None)
+    if data is None:
+        raise ValueError('the export is not supported by this database')
+    if data.expires:
+        data.expire_due()
+    return iter(data.data.items())
+
+
+def export_file(database, path, format=None):
+    """Writes every committed pair of a database into a file, see dump
+
+    Returns:
+        a tuple, containing the number of rows written and the seconds taken
+    """
+    started = time.perf_counter()
+    format = detect_format(path, format)
+    pairs = dump(database)
+    rows = 0
+    with open(path, 'w', newline='' if format == 'csv' else None, encoding='utf-8') as output_file:
+        if format == 'csv':
+            writer = csv.writer(output_file, lineterminator='\n')
+            for pair in pairs:
+                writer.writerow(pair)
+                rows += 1
+        elif format == 'tsv':
+            write = output_file.write
+            for key, value in pairs:
+                write('%s\t%s\n' % (key, value))
+                rows += 1
+        else:
+            write = output_file.write
+            dumps = json.dumps
+            for key, value in pairs:
+                write(dumps({'key': key, 'value': value}))
+                write('\n')
+                rows += 1
+    return (rows, time.perf_counter() - started)
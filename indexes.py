@@ -0,0 +1,557 @@
+"""
+Secondary indexes of the Simple Database
+
+    Indexes are listeners of the committed data (see Data.listeners): every committed change
+    is applied to them, including the ones made by expiry and eviction, and they are
+    rebuilt when the data is loaded from a snapshot (on_load).
+    Transactions do not modify the indexes, the database merges the changes of the open
+    transactions into their results.
+
+"""
+
+import bisect
+import threading
+
+
+
+class RangeIndex(object):
+    """Ordered index of the values answering how many keys are set to a value within a range
+
+    The sort keys of the values are kept in order in a list of sorted blocks of at most
+    2 * BLOCK_SIZE keys each, like a B-tree with two levels, along with the frequency of
+    each key. The total frequency of each block is kept in a Fenwick tree (binary indexed
+    tree), so counting the keys within a range adds up the whole blocks before each bound
+    in O(log b) and the part of the block of the bound in O(BLOCK_SIZE).
+    A value seen for the first time is inserted into its block, which is split once it is
+    full, and a value no key is set to anymore is removed from it. Only splitting or
+    emptying a block rebuilds the Fenwick tree, in O(b).
+
+    Values with the same sort key, such as '1' and '1.0' in a numeric index, share the
+    same entry.
+
+    Args:
+        numeric: a boolean, if True values are ordered as numbers and values that are not
+                 numbers are not indexed, otherwise values are ordered as strings
+
+    Attributes:
+        blocks: a list of sorted lists with the sort keys of the indexed values, every key of
+                a block being lower than the keys of the next one
+
+        counts: a list of lists with the frequency of each sort key, in the same order
+
+        maxes: a list with the greatest sort key of each block
+
+        tree: a list representing the Fenwick tree of the total frequency of each block,
+              1-indexed
+
+        ignored: a set with the values that are not numbers in a numeric index
+    """
+    BLOCK_SIZE = 256
+
+    def __init__(self, numeric=False):
+        self.numeric = numeric
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Removes every value from the index"""
+        self.blocks = []
+        self.counts = []
+        self.maxes = []
+        self.tree = [0]
+        self.ignored = set()
+
+    def sort_key(self, value):
+        """Returns the key a value is ordered by
+
+        Raises:
+            ValueError: if the value is not a number in a numeric index
+        """
+        if not self.numeric:
+            return value
+        number = float(value)
+        if number != number:
+            raise ValueError('NaN values are not ordered')
+        return number
+
+    def on_commit(self, changes):
+        """Updates the frequencies of the values with a list of (key, old_value, new_value) changes"""
+        with self.lock:
+            for key, old_value, new_value in changes:
+                if old_value is not None:
+                    self.add(old_value, -1)
+                if new_value is not None:
+                    self.add(new_value, 1)
+
+    def on_load(self, data):
+        """Rebuilds the index from the frequency of the values of the data
+
+        Running Time: O(v log v)
+        """
+        with self.lock:
+            self.clear()
+            frequencies = {}
+            for value, count in data.values_freq.items():
+                try:
+                    sort_key = self.sort_key(value)
+                except ValueError:
+                    self.ignored.add(value)
+                    continue
+                frequencies[sort_key] = frequencies.get(sort_key, 0) + count
+            sort_keys = sorted(frequencies)
+            size = self.BLOCK_SIZE
+            for start in range(0, len(sort_keys), size):
+                block = sort_keys[start:start + size]
+                self.blocks.append(block)
+                self.counts.append([frequencies[sort_key] for sort_key in block])
+                self.maxes.append(block[-1])
+            self.rebuild()
+
+    def add(self, value, num):
+        """Modifies the frequency of a value by 'num', the lock must be held
+
+        Running Time: O(log b + BLOCK_SIZE)
+        Being 'b' the number of blocks
+        """
+        if value in self.ignored:
+            return
+        try:
+            sort_key = self.sort_key(value)
+        except ValueError:
+            self.ignored.add(value)
+            return
+
+        maxes = self.maxes
+        if not maxes:
+            self.blocks.append([sort_key])
+            self.counts.append([num])
+            maxes.append(sort_key)
+            self.rebuild()
+            return
+        index = bisect.bisect_left(maxes, sort_key)
+        if index == len(maxes):
+            index -= 1
+        block = self.blocks[index]
+        counts = self.counts[index]
+        position = bisect.bisect_left(block, sort_key)
+        if position < len(block) and block[position] == sort_key:
+            counts[position] += num
+            if not counts[position]:
+                del block[position]
+                del counts[position]
+                if not block:
+                    del self.blocks[index]
+                    del self.counts[index]
+                    del maxes[index]
+                    self.rebuild()
+                    return
+                maxes[index] = block[-1]
+        else:
+            block.insert(position, sort_key)
+            counts.insert(position, num)
+            maxes[index] = block[-1]
+            if len(block) > 2 * self.BLOCK_SIZE:
+                self.split(index)
+                return
+        self.update(index, num)
+
+    def split(self, index):
+        """Splits a full block in two halves, the lock must be held"""
+        block = self.blocks[index]
+        counts = self.counts[index]
+        half = len(block) // 2
+        self.blocks[index:index + 1] = [block[:half], block[half:]]
+        self.counts[index:index + 1] = [counts[:half], counts[half:]]
+        self.maxes[index:index + 1] = [block[half - 1], block[-1]]
+        self.rebuild()
+
+    def update(self, index, num):
+        """Adds 'num' to the total frequency of a block in the Fenwick tree
+
+        Running Time: O(log b)
+        """
+        tree = self.tree
+        size = len(tree)
+        index += 1
+        while index < size:
+            tree[index] += num
+            index += index & -index
+
+    def rebuild(self):
+        """Builds the Fenwick tree from the counts of every block, the lock must be held
+
+        Running Time: O(v)
+        """
+        # linear construction, each node adds its partial sum to its parent
+        tree = [0]
+        tree.extend(sum(counts) for counts in self.counts)
+        size = len(tree)
+        for index in range(1, size):
+            parent = index + (index & -index)
+            if parent < size:
+                tree[parent] += tree[index]
+        self.tree = tree
+
+    def prefix(self, index):
+        """Returns the total frequency of the blocks before the given one"""
+        tree = self.tree
+        total = 0
+        while index > 0:
+            total += tree[index]
+            index -= index & -index
+        return total
+
+    def count_below(self, bound, inclusive):
+        """Returns the total frequency of the sort keys lower than a bound, or equal to it if
+        inclusive, the lock must be held
+
+        Running Time: O(log b + BLOCK_SIZE)
+        """
+        search = bisect.bisect_right if inclusive else bisect.bisect_left
+        index = search(self.maxes, bound)
+        total = self.prefix(index)
+        if index < len(self.blocks):
+            total += sum(self.counts[index][:search(self.blocks[index], bound)])
+        return total
+
+    def count(self, low=None, high=None, low_inclusive=True, high_inclusive=True):
+        """Retrieves the number of keys set to a value within a range
+
+        Running Time: O(log b + BLOCK_SIZE)
+        Being 'b' the number of blocks, about v / BLOCK_SIZE for 'v' distinct values
+
+        Args:
+            low: the lower bound of the range, as a sort key, or None if it is unbounded
+            high: the upper bound of the range, as a sort key, or None if it is unbounded
+            low_inclusive: a boolean, whether the lower bound belongs to the range
+            high_inclusive: a boolean, whether the upper bound belongs to the range
+
+        Returns:
+            an integer, the total frequency of the values within the range
+        """
+        with self.lock:
+            if high is None:
+                end = self.prefix(len(self.blocks))
+            else:
+                end = self.count_below(high, high_inclusive)
+            if low is None:
+                start = 0
+            else:
+                start = self.count_below(low, not low_inclusive)
+            return max(end - start, 0)
+
+    def contains(self, value, low=None, high=None, low_inclusive=True, high_inclusive=True):
+        """Returns whether a value is within a range, with the same arguments as count"""
+        try:
+            sort_key = self.sort_key(value)
+        except ValueError:
+            return False
+        if low is not None and (sort_key < low or (sort_key == low and not low_inclusive)):
+            return False
+        if high is not None and (sort_key > high or (sort_key == high and not high_inclusive)):
+            return False
+        return True
+
+
+
+class KeyList(object):
+    """Keys set to the same value in a ReverseIndex
+
+    Attributes:
+        keys: a list with the keys, in the order they were set, being None the positions of
+              the keys removed since the last compaction
+
+        removed: an integer, the number of removed positions
+
+        epoch: an integer, increased every time the list is compacted, which moves the keys
+    """
+    __slots__ = ('keys', 'removed', 'epoch')
+
+    def __init__(self):
+        self.keys = []
+        self.removed = 0
+        self.epoch = 0
+
+
+
+class ReverseIndex(object):
+    """Index from each value to the keys set to it
+
+    Each value maps to a KeyList, and each key to its position in the list of its value, so 
+    adding and removing a key run in O(1): a removed key leaves an empty position that is
+    dropped once half of the list is empty.
+
+    Keys are read in pages with a cursor (see scan), so values set to millions of keys are
+    read without copying them, and they can be modified between two pages. Like Redis
+    SCAN, a key set to the value during the whole scan is always returned, but it may be
+    returned more than once if the list is compacted in the middle of the scan.
+
+    Attributes:
+        values: a dictionary mapping each value to the KeyList of its keys
+
+        positions: a dictionary mapping each key to its position in the KeyList of its value
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Removes every key from the index"""
+        self.values = {}
+        self.positions = {}
+
+    def on_commit(self, changes):
+        """Moves each key of a list of (key, old_value, new_value) changes to the list of its new value"""
+        with self.lock:
+            for key, old_value, new_value in changes:
+                if old_value is not None:
+                    self.remove(key, old_value)
+                if new_value is not None:
+                    self.add(key, new_value)
+
+    def on_load(self, data):
+        """Rebuilds the index from the keys of the data
+
+        Running Time: O(n)
+        Being 'n' the number of keys
+        """
+        with self.lock:
+            self.clear()
+            for key, value in data.data.items():
+                self.add(key, value)
+
+    def add(self, key, value):
+        """Adds a key to the list of a value, the lock must be held
+
+        Running Time: O(1)
+        """
+        key_list = self.values.get(value)
+        if key_list is None:
+            key_list = self.values[value] = KeyList()
+        self.positions[key] = len(key_list.keys)
+        key_list.keys.append(key)
+
+    def remove(self, key, value):
+        """Removes a key from the list of a value, the lock must be held
+
+        Running Time: O(1)
+        Amortized, compacting a list of 'k' keys runs in O(k) once 'k / 2' keys are removed
+        """
+        key_list = self.values[value]
+        key_list.keys[self.positions.pop(key)] = None
+        key_list.removed += 1
+        if key_list.removed == len(key_list.keys):
+            del self.values[value]
+        elif key_list.removed > 64 and 2 * key_list.removed > len(key_list.keys):
+            keys = [listed_key for listed_key in key_list.keys if listed_key is not None]
+            positions = self.positions
+            for position, listed_key in enumerate(keys):
+                positions[listed_key] = position
+            key_list.keys = keys
+            key_list.removed = 0
+            key_list.epoch += 1
+
+    def count(self, value):
+        """Retrieves the number of keys set to a value"""
+        key_list = self.values.get(value)
+        if key_list is None:
+            return 0
+        return len(key_list.keys) - key_list.removed
+
+    def scan(self, value, cursor=0, count=100):
+        """Reads a page of the keys set to a value
+
+        The cursor encodes the position to continue from and the epoch of the list, if the
+        list was compacted since then the scan starts over.
+
+        Running Time: O(c)
+        Being 'c' the number of positions read, which is 'count' unless many keys were removed
+
+        Args:
+            value: an string representing the value
+            cursor: an integer, 0 to start the scan or the cursor returned by the previous page
+            count: an integer, the number of keys of the page
+
+        Returns:
+            a tuple, containing the cursor of the next page, which is 0 once the scan is
+            completed, and a list with the keys of the page
+        """
+        with self.lock:
+            key_list = self.values.get(value)
+            if key_list is None:
+                return (0, [])
+            position = cursor >> 16
+            if (cursor & 0xFFFF) != (key_list.epoch & 0xFFFF):
+                position = 0
+
+            listed_keys = key_list.keys
+            size = len(listed_keys)
+            keys = []
+            while position < size and len(keys) < count:
+                key = listed_keys[position]
+                position += 1
+                if key is not None:
+                    keys.append(key)
+            if position >= size:
+                return (0, keys)
+            return ((position << 16) | (key_list.epoch & 0xFFFF), keys)
+
+
+
+class KeyIndex(object):
+    """Index keeping all keys sorted, to read the keys within a range or with a prefix
+
+    Keys are stored in sorted blocks of up to twice 'load' keys, along with the greatest
+    key of each block, like a two-level B-tree. Finding a key runs two binary searches,
+    and inserting or removing a key only shifts the keys of its block.
+
+    Keys are read in chunks (see iterate): after each chunk the position is searched again
+    from the last key read, so keys can be modified while they are being read.
+
+    Running Time: 
+        Inserting or removing a key runs in O(log n + load)
+        Reading 'm' keys from a given key runs in O(log n + m)
+
+    Args:
+        load: an integer, the number of keys of a block once it is split
+
+    Attributes:
+        blocks: a list of sorted lists of keys, all keys of a block being smaller than the
+                keys of the next one
+
+        maxes: a list with the greatest key of each block
+    """
+    def __init__(self, load=1000):
+        self.load = load
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Removes every key from the index"""
+        self.blocks = []
+        self.maxes = []
+
+    def __len__(self):
+        return sum(len(block) for block in self.blocks)
+
+    def on_commit(self, changes):
+        """Inserts the keys set for the first time and removes the keys unset of a list of changes"""
+        with self.lock:
+            for key, old_value, new_value in changes:
+                if old_value is None:
+                    self.insert(key)
+                elif new_value is None:
+                    self.remove(key)
+
+    def on_load(self, data):
+        """Rebuilds the index from the keys of the data
+
+        Running Time: O(n log n)
+        Being 'n' the number of keys
+        """
+        keys = sorted(data.data)
+        load = self.load
+        with self.lock:
+            self.blocks = [keys[start:start + load] for start in range(0, len(keys), load)]
+            self.maxes = [block[-1] for block in self.blocks]
+
+    def insert(self, key):
+        """Inserts a key, the lock must be held"""
+        maxes = self.maxes
+        if not maxes:
+            self.blocks.append([key])
+            maxes.append(key)
+            return
+
+        index = bisect.bisect_left(maxes, key)
+        if index == len(maxes):
+            index -= 1
+            block = self.blocks[index]
+            block.append(key)
+            maxes[index] = key
+        else:
+            block = self.blocks[index]
+            bisect.insort(block, key)
+
+        if len(block) > 2 * self.load:
+            self.blocks.insert(index + 1, block[self.load:])
+            del block[self.load:]
+            maxes.insert(index, block[-1])
+
+    def remove(self, key):
+        """Removes a key, the lock must be held"""
+        maxes = self.maxes
+        index = bisect.bisect_left(maxes, key)
+        block = self.blocks[index]
+        position = bisect.bisect_left(block, key)
+        del block[position]
+        if not block:
+            del self.blocks[index]
+            del maxes[index]
+        elif position == len(block):
+            maxes[index] = block[-1]
+
+    def chunk(self, start, inclusive, limit):
+        """Returns a sorted list with up to 'limit' keys from a given key
+
+        Args:
+            start: an string, the key to start from, or None to start from the first key
+            inclusive: a boolean, whether the start key itself may be returned
+            limit: an integer, the maximum number of keys
+        """
+        with self.lock:
+            blocks = self.blocks
+            if start is None:
+                index = 0
+                position = 0
+            else:
+                search = bisect.bisect_left if inclusive else bisect.bisect_right
+                index = search(self.maxes, start)
+                if index == len(blocks):
+                    return []
+                position = search(blocks[index], start)
+
+            keys = []
+            while index < len(blocks) and len(keys) < limit:
+                block = blocks[index]
+                keys.extend(block[position:position + limit - len(keys)])
+                index += 1
+                position = 0
+            return keys
+
+    def iterate(self, after=None, prefix='', chunk_size=256):
+        """Generator that yields in order the keys greater than 'after' that start with a prefix
+
+        Running Time: O(log n + m)
+        Being 'm' the number of keys yielded
+
+        Args:
+            after: an string, only keys greater than it are yielded, or None
+            prefix: an string, only keys starting with it are yielded
+            chunk_size: an integer, the number of keys read at once
+        """
+        if after is None or after < prefix:
+            start = prefix or None
+            inclusive = True
+        else:
+            start = after
+            inclusive = False
+        while True:
+            keys = self.chunk(start, inclusive, chunk_size)
+            for key in keys:
+                if not key.startswith(prefix):
+                    return
+                yield key
+            if len(keys) < chunk_size:
+                return
+            start = keys[-1]
+            inclusive = False
+
+
+
+def glob_prefix(pattern):
+    """Returns the literal prefix of a glob-style pattern, before its first special character"""
+    for position, character in enumerate(pattern):
+        if character in '*?[\\':
+            return pattern[:position]
+    return pattern
@@ -0,0 +1,518 @@
+"""
+Persistence for the Simple Database
+
+    Append-only command log:
+        Every change committed into the database (SET and UNSET run outside a transaction,
+        MSET, and the flattened write set of a COMMIT) is appended to a log file using the
+        same grammar as the console. Changes applied together are wrapped in a
+        BEGIN ... COMMIT block, so the log can also be replayed as a regular command file.
+        Rolled back work never reaches the database, therefore it never reaches the log.
+
+        Example:
+            SET a 10
+            UNSET b
+            BEGIN
+            SET a 20
+            UNSET c
+            COMMIT
+
+    Fsync policies:
+        always      the log is flushed and synced to disk after every change (or group of changes)
+        everysec    the log is flushed after every change and synced to disk once per second
+        never       the log is flushed when its buffer fills, syncing is left to the operating system
+
+    Recovery:
+        On startup the log is read from the beginning and folded into a single write set
+        holding the latest value of each key, which is applied at once into the database.
+        A trailing block without COMMIT, or a last line without end of line, belongs to a
+        write interrupted by a crash and is discarded.
+
+    Snapshots:
+        A snapshot is a binary file with the data and the values frequency of the database
+        at a point in time, loading it does not require to rebuild any frequency.
+        When a snapshot is taken, the current log is rotated (renamed to 'log.1', 'log.2', ...)
+        and a new empty log is started at the same instant. Once the snapshot is safely
+        written the rotated logs are removed, so the log only holds the changes made after
+        the latest snapshot. Recovery is therefore: snapshot + rotated logs + current log.
+
+        Replaying a rotated log over a snapshot taken at the instant of its rotation is
+        harmless: the latest change of each key in that log is the value of the key in
+        the snapshot. Hence a crash at any point of the process never loses changes.
+
+        Background snapshots are written by a forked child process, which holds a copy-on-write
+        view of the data, so the database keeps serving writes meanwhile. On platforms
+        without fork, the data is copied in memory (a fast C level copy) and written by a thread.
+
+"""
+
+import os
+import pickle
+import threading
+import time
+from contextlib import contextmanager
+
+
+FSYNC_ALWAYS = 'always'
+FSYNC_EVERYSEC = 'everysec'
+FSYNC_NEVER = 'never'
+
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_EVERYSEC, FSYNC_NEVER)
+
+SNAPSHOT_HEADER = b'SIMPLEDB-SNAPSHOT-1\n'
+
+
+
+class CommandLog(object):
+    """Append-only log of the changes committed into a database
+
+    Instances are attached as listeners of a Data object, see Data.listeners.
+
+    Args:
+        path: an string representing the path of the log file, it is created if it does not exist
+        fsync: an string representing the fsync policy, one of FSYNC_POLICIES
+
+    Attributes:
+        path: an string representing the path of the log file
+
+        fsync: an string representing the fsync policy
+
+        pending: a list of strings with the records waiting to be written, used while a group
+                 of changes is being committed
+
+        grouping: an integer, the number of nested groups currently opened
+
+        dirty: a boolean, representing the existence of data written but not synced to disk
+
+        last_sync: a float, the time of the latest sync to disk
+    """
+    def __init__(self, path, fsync=FSYNC_EVERYSEC):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Invalid fsync policy: %s' % fsync)
+
+        self.path = path
+        self.fsync = fsync
+        self.file = open(path, 'a', encoding='utf-8', newline='\n')
+        self.lock = threading.Lock()
+        self.pending = []
+        self.grouping = 0
+        self.dirty = False
+        self.last_sync = time.monotonic()
+        self.closed = threading.Event()
+        self.sync_thread = None
+
+        if fsync == FSYNC_EVERYSEC:
+            self.sync_thread = threading.Thread(target=self.sync_every_second, daemon=True)
+            self.sync_thread.start()
+
+    @staticmethod
+    def encode(changes):
+        """Encodes a list of (key, old_value, new_value) changes applied together into a record
+
+        Running Time: O(k)
+        Being 'k' the number of changes
+        """
+        lines = []
+        for key, old_value, new_value in changes:
+            if new_value is None:
+                lines.append('UNSET %s\n' % key)
+            else:
+                lines.append('SET %s %s\n' % (key, new_value))
+        if len(lines) > 1:
+            lines.insert(0, 'BEGIN\n')
+            lines.append('COMMIT\n')
+        return ''.join(lines)
+
+    def on_commit(self, changes):
+        """Appends the changes committed into the database to the log
+
+        Args:
+            changes: a list of tuples (key, old_value, new_value) applied together
+        """
+        record = CommandLog.encode(changes)
+        with self.lock:
+            if self.grouping:
+                self.pending.append(record)
+            else:
+                self.write(record)
+
+    @contextmanager
+    def group(self):
+        """Context manager that commits all changes made within it as a group
+
+        The records are written with a single write call and, under the 'always' policy,
+        synced to disk once for the whole group instead of once per change.
+        """
+        with self.lock:
+            self.grouping += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.grouping -= 1
+                if not self.grouping and self.pending:
+                    record = ''.join(self.pending)
+                    self.pending = []
+                    self.write(record)
+
+    def write(self, record):
+        """Writes a record following the fsync policy, the lock must be held"""
+        self.file.write(record)
+        if self.fsync == FSYNC_NEVER:
+            return
+
+        self.file.flush()
+        if self.fsync == FSYNC_ALWAYS:
+            os.fsync(self.file.fileno())
+            self.last_sync = time.monotonic()
+        else:
+            self.dirty = True
+
+    def rotate(self, rotated_path):
+        """Renames the current log file and starts a new empty one in its place
+
+        Args:
+            rotated_path: an string representing the new path of the current log file
+        """
+        with self.lock:
+            if self.pending:
+                self.file.write(''.join(self.pending))
+                self.pending = []
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            os.rename(self.path, rotated_path)
+            self.file = open(self.path, 'a', encoding='utf-8', newline='\n')
+            self.dirty = False
+
+    def sync(self):
+        """Flushes and syncs to disk all data written to the log"""
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.dirty = False
+            self.last_sync = time.monotonic()
+
+    def sync_every_second(self):
+        """Background loop that syncs the log to disk once per second if there is new data"""
+        while not self.closed.wait(1.0):
+            if self.dirty:
+                self.sync()
+
+    def close(self):
+        """Writes any pending record, syncs the log to disk and closes it"""
+        if self.file.closed:
+            return
+        self.closed.set()
+        if self.sync_thread is not None:
+            self.sync_thread.join()
+        with self.lock:
+            if self.pending:
+                self.file.write(''.join(self.pending))
+                self.pending = []
+        self.sync()
+        with self.lock:
+            self.file.close()
+
+    @staticmethod
+    def replay(path):
+        """Reads a log file and folds all its changes into a single write set
+
+        Running Time: O(n)
+        Being 'n' the number of records of the log
+
+        Args:
+            path: an string representing the path of the log file
+
+        Returns:
+            a tuple, containing a dictionary that maps each key found in the log to its latest
+            value, being None the value of the keys that were removed, and an integer that
+            represents the size in bytes of the valid part of the log, that is, without
+            any record interrupted by a crash
+        """
+        changes = {}
+        if not os.path.exists(path):
+            return (changes, 0)
+
+        with open(path, 'rb') as log_file:
+            content = log_file.read()
+
+        lines = content.split(b'\n')
+        # the last element is only non empty if the last line was not completely written
+        lines.pop()
+
+        block = None
+        position = 0
+        valid_size = 0
+        for line in lines:
+            position += len(line) + 1
+            fields = line.decode('utf-8').split()
+            if not fields:
+                continue
+
+            name = fields[0]
+            target = changes if block is None else block
+            if name == 'SET' and len(fields) == 3:
+                target[fields[1]] = fields[2]
+            elif name == 'UNSET' and len(fields) == 2:
+                target[fields[1]] = None
+            elif name == 'BEGIN' and block is None:
+                block = {}
+            elif name == 'COMMIT' and block is not None:
+                changes.update(block)
+                block = None
+            else:
+                raise ValueError('Corrupted command log %s: %r' % (path, line))
+
+            if block is None:
+                valid_size = position
+        return (changes, valid_size)
+
+
+
+def open_command_log(database, path, fsync=FSYNC_EVERYSEC):
+    """Recovers a database from a command log and attaches the log to it
+
+    All changes found in the log are applied at once into the committed data of the
+    database, rebuilding both data and values_freq. Any record interrupted by a crash
+    is truncated from the log. Then, the log is attached as a listener so every new
+    change is appended to it.
+
+    Args:
+        database: an object of type Database, it should not have an open transaction
+        path: an string representing the path of the log file
+        fsync: an string representing the fsync policy, one of FSYNC_POLICIES
+
+    Returns:
+        an object of type CommandLog, which must be closed when the database is no longer used
+    """
+    changes = recover_log(path)
+    if changes:
+        database.database.apply(changes)
+
+    command_log = CommandLog(path, fsync)
+    database.database.listeners.append(command_log)
+    return command_log
+
+
+def recover_log(path):
+    """Reads a log file along with its rotated logs and truncates any record interrupted by a crash
+
+    Args:
+        path: an string representing the path of the log file
+
+    Returns:
+        a dictionary mapping each key found in the logs to its latest value, being None the 
+        value of the keys that were removed
+    """
+    changes = {}
+    for rotated_path in rotated_logs(path):
+        changes.update(CommandLog.replay(rotated_path)[0])
+
+    log_changes, valid_size = CommandLog.replay(path)
+    changes.update(log_changes)
+    if os.path.exists(path) and os.path.getsize(path) > valid_size:
+        with open(path, 'r+b') as log_file:
+            log_file.truncate(valid_size)
+    return changes
+
+
+def rotated_logs(path):
+    """Returns the paths of the rotated logs of a log file, from the oldest to the newest"""
+    directory, name = os.path.split(os.path.abspath(path))
+    prefix = name + '.'
+    numbers = []
+    for filename in os.listdir(directory):
+        suffix = filename[len(prefix):]
+        if filename.startswith(prefix) and suffix.isdigit():
+            numbers.append(int(suffix))
+    return [path + '.' + str(number) for number in sorted(numbers)]
+
+
+def write_snapshot(path, data, values_freq):
+    """Writes a snapshot file atomically
+
+    The snapshot is written into a temporary file that replaces the previous snapshot
+    only once it is completely synced to disk.
+
+    Running Time: O(n)
+    Being 'n' the number of keys
+
+    Args:
+        path: an string representing the path of the snapshot file
+        data: a dictionary mapping each key to its value
+        values_freq: a dictionary mapping each value to its frequency
+    """
+    if not isinstance(values_freq, dict):
+        values_freq = dict(values_freq)
+    temporary_path = '%s.tmp-%d' % (path, os.getpid())
+    with open(temporary_path, 'wb') as snapshot_file:
+        snapshot_file.write(SNAPSHOT_HEADER)
+        pickle.dump((data, values_freq), snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temporary_path, path)
+
+
+def read_snapshot(path):
+    """Reads a snapshot file
+
+    Running Time: O(n)
+    Being 'n' the number of keys. The dictionaries are rebuilt directly by the 
+    unpickler, no frequency is computed
+
+    Args:
+        path: an string representing the path of the snapshot file
+
+    Returns:
+        a tuple, containing the data and the values frequency dictionaries
+    """
+    with open(path, 'rb') as snapshot_file:
+        if snapshot_file.read(len(SNAPSHOT_HEADER)) != SNAPSHOT_HEADER:
+            raise ValueError('Invalid snapshot file %s' % path)
+        return pickle.load(snapshot_file)
+
+
+
+class Persistence(object):
+    """Handler that manages the snapshot and the command log of a database
+
+    Args:
+        database: an object of type Database to persist
+        log_path: an string representing the path of the command log, or None to disable it
+        snapshot_path: an string representing the path of the snapshot, or None to disable it
+        fsync: an string representing the fsync policy of the log, one of FSYNC_POLICIES
+
+    Attributes:
+        command_log: an object of type CommandLog attached to the database, None if the log
+                     is disabled or the persistence is not opened
+
+        saving: an object (thread) representing the background snapshot in progress, if any
+
+        last_save: a float, the time of the latest snapshot successfully written
+    """
+    def __init__(self, database, log_path=None, snapshot_path=None, fsync=FSYNC_EVERYSEC):
+        self.database = database
+        self.log_path = log_path
+        self.snapshot_path = snapshot_path
+        self.fsync = fsync
+        self.command_log = None
+        self.lock = threading.Lock()
+        self.saving = None
+        self.last_save = None
+
+    def open(self):
+        """Recovers the database from the snapshot and the logs, then attaches the command log
+
+        The snapshot, if any, is loaded directly into the committed data of the database.
+        Then all changes found in the logs are applied at once.
+        """
+        data = self.database.database
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            data.load(*read_snapshot(self.snapshot_path))
+
+        if self.log_path:
+            changes = recover_log(self.log_path)
+            if changes:
+                data.apply(changes)
+            self.command_log = CommandLog(self.log_path, self.fsync)
+            data.listeners.append(self.command_log)
+
+    def save(self):
+        """Takes a snapshot of the committed data in the foreground
+
+        Returns:
+            a boolean, representing the execution or not of the operation. It is not executed
+            if there is no snapshot path, a background snapshot is in progress or the data
+            holds uncommitted changes (see Data.is_dirty)
+        """
+        with self.lock:
+            if not self.snapshot_path or self.saving is not None or self.database.database.is_dirty():
+                return False
+            rotated_paths = self.rotate_log()
+            data = self.database.database
+            write_snapshot(self.snapshot_path, data.data, data.values_freq)
+            self.saved(rotated_paths)
+            return True
+
+    def bgsave(self):
+        """Takes a snapshot of the committed data in the background
+
+        Returns:
+            a boolean, representing whether the background snapshot started or not. It does
+            not start if there is no snapshot path, a background snapshot is in progress or
+            the data holds uncommitted changes (see Data.is_dirty)
+        """
+        with self.lock:
+            if not self.snapshot_path or self.saving is not None or self.database.database.is_dirty():
+                return False
+
+            rotated_paths = self.rotate_log()
+            data = self.database.database
+            if hasattr(os, 'fork'):
+                pid = os.fork()
+                if pid == 0:
+                    status = 0
+                    try:
+                        write_snapshot(self.snapshot_path, data.data, data.values_freq)
+                    except BaseException:
+                        status = 1
+                    finally:
+                        os._exit(status)
+                target = self.wait_child
+                arguments = (pid, rotated_paths)
+            else:
+                target = self.write_copy
+                arguments = (dict(data.data), dict(data.values_freq), rotated_paths)
+
+            self.saving = threading.Thread(target=target, args=arguments, daemon=True)
+            self.saving.start()
+            return True
+
+    def wait_child(self, pid, rotated_paths):
+        """Waits for the child process writing a background snapshot"""
+        _, status = os.waitpid(pid, 0)
+        with self.lock:
+            if status == 0:
+                self.saved(rotated_paths)
+            self.saving = None
+
+    def write_copy(self, data, values_freq, rotated_paths):
+        """Writes a background snapshot from a copy of the data"""
+        try:
+            write_snapshot(self.snapshot_path, data, values_freq)
+            with self.lock:
+                self.saved(rotated_paths)
+        finally:
+            with self.lock:
+                self.saving = None
+
+    def wait(self):
+        """Waits for the background snapshot in progress, if any"""
+        saving = self.saving
+        if saving is not None:
+            saving.join()
+
+    def rotate_log(self):
+        """Rotates the command log, returning the paths of all the rotated logs"""
+        if self.command_log is None:
+            return []
+        rotated_paths = rotated_logs(self.log_path)
+        number = 1
+        if rotated_paths:
+            number = int(rotated_paths[-1].rsplit('.', 1)[1]) + 1
+        rotated_path = '%s.%d' % (self.log_path, number)
+        self.command_log.rotate(rotated_path)
+        rotated_paths.append(rotated_path)
+        return rotated_paths
+
+    def saved(self, rotated_paths):
+        """Removes the logs already included into a snapshot"""
+        for rotated_path in rotated_paths:
+            os.remove(rotated_path)
+        self.last_save = time.time()
+
+    def close(self):
+        """Waits for any background snapshot and closes the command log"""
+        self.wait()
+        if self.command_log is not None:
+            self.command_log.close()
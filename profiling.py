@@ -0,0 +1,239 @@
+"""
+On-demand profiling of the Simple Database
+
+    A profile is started over live traffic by PROFILE START (or DBConsole.start_profile) and
+    stops after a number of seconds, a number of commands or at PROFILE STOP, writing its
+    results into a file:
+
+    cprofile    deterministic profile of every function call made by the thread running
+                the commands, written in the pstats format:
+                > python -m pstats profile.pstats
+    sampling    the stack of the thread running the commands is sampled every
+                SAMPLING_INTERVAL seconds by a background thread, written as collapsed
+                stacks ('frame;frame;frame count' per line) ready for flamegraph.pl or
+                speedscope. It costs far less than cprofile, but only reports where the
+                time goes in proportion. The thread switch interval of the interpreter is
+                lowered to the sampling interval meanwhile, otherwise the sampling thread
+                would only get the GIL every 5ms
+
+    Profiling is strictly opt-in: the commands are only counted while a profile runs, by
+    wrapping the handlers of the dispatch table of the console (see DBConsole.start_profile),
+    so the command loop runs exactly the same code when no profile is running.
+
+"""
+
+import cProfile
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+PROFILE_MODES = ('cprofile', 'sampling')
+
+SAMPLING_INTERVAL = 0.001
+
+
+
+class DeterministicProfiler(object):
+    """Profiler that records every function call with cProfile, see the cprofile mode
+
+    Attributes:
+        profile: an object of type cProfile.Profile
+    """
+    __slots__ = ('profile',)
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        """Starts profiling the current thread"""
+        self.profile.enable()
+
+    def stop(self):
+        """Stops profiling, it must be called from the thread that started it"""
+        self.profile.disable()
+
+    def write(self, path):
+        """Writes the results in the pstats format"""
+        self.profile.dump_stats(path)
+
+
+class SamplingProfiler(object):
+    """Profiler that samples the stack of a thread periodically, see the sampling mode
+
+    Args:
+        interval: a number, the seconds between two samples
+
+    Attributes:
+        thread_id: an integer, the identifier of the thread sampled, the one that started it
+
+        stacks: a Counter mapping each collapsed stack to the number of times it was sampled
+
+        stopped: an object of type threading.Event, set to stop the sampling thread
+
+        sampler: an object of type threading.Thread, the sampling thread
+
+        switch_interval: a float, the thread switch interval of the interpreter to restore
+    """
+    __slots__ = ('interval', 'thread_id', 'stacks', 'stopped', 'sampler', 'switch_interval')
+
+    def __init__(self, interval=SAMPLING_INTERVAL):
+        self.interval = interval
+        self.thread_id = None
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.sampler = None
+        self.switch_interval = None
+
+    def start(self):
+        """Starts sampling the current thread"""
+        self.thread_id = threading.get_ident()
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(self.switch_interval, self.interval))
+        self.sampler = threading.Thread(target=self.sample, name='profile-sampler', daemon=True)
+        self.sampler.start()
+
+    def sample(self):
+        """Samples the thread until the profiler is stopped or the thread finishes"""
+        current_frames = sys._current_frames
+        while not self.stopped.wait(self.interval):
+            frame = current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            self.stacks[collapse_stack(frame)] += 1
+
+    def stop(self):
+        """Stops sampling, waiting for the sampling thread"""
+        self.stopped.set()
+        if self.sampler is not None:
+            self.sampler.join()
+            sys.setswitchinterval(self.switch_interval)
+
+    def write(self, path):
+        """Writes the collapsed stacks, the most sampled first"""
+        with open(path, 'w', encoding='utf-8') as output_file:
+            for stack, count in self.stacks.most_common():
+                output_file.write('%s %d\n' % (stack, count))
+
+
+def collapse_stack(frame):
+    """Returns the stack of a frame as an string with a 'file:function' entry per frame,
+    separated by semicolons from the outermost one"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s:%s' % (os.path.basename(code.co_filename), getattr(code, 'co_qualname', code.co_name)))
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+
+def create_profiler(mode):
+    """Returns a new profiler of the given mode
+
+    Raises:
+        ValueError: if the mode is not one of PROFILE_MODES
+    """
+    mode = mode.lower()
+    if mode == 'cprofile':
+        return DeterministicProfiler()
+    if mode == 'sampling':
+        return SamplingProfiler()
+    raise ValueError('invalid profile mode %r, expected one of %s' % (mode, ', '.join(PROFILE_MODES)))
+
+
+
+class ProfileSession(object):
+    """A profile running until a number of seconds or commands is reached
+
+    Args:
+        profiler: a DeterministicProfiler or a SamplingProfiler, not started yet
+        path: an string, the file the results are written into
+        seconds: a number, the seconds after which the profile stops, or None
+        commands: an integer, the number of commands after which the profile stops, or None
+
+    Attributes:
+        deadline: a float, the time (time.perf_counter) the profile stops at, or None
+
+        count: an integer, the number of commands executed so far
+
+        started: a float, the time (time.perf_counter) the profile started at
+    """
+    __slots__ = ('profiler', 'path', 'seconds', 'commands', 'deadline', 'count', 'started')
+
+    def __init__(self, profiler, path, seconds=None, commands=None):
+        if (seconds is not None and seconds <= 0) or (commands is not None and commands <= 0):
+            raise ValueError('the seconds and commands of a profile must be positive')
+        self.profiler = profiler
+        self.path = path
+        self.seconds = seconds
+        self.commands = commands
+        self.deadline = None
+        self.count = 0
+        self.started = None
+
+    def start(self):
+        """Starts the profiler, creating the file first so an invalid path fails right away
+
+        Raises:
+            OSError: if the file cannot be written
+        """
+        open(self.path, 'wb').close()
+        self.started = time.perf_counter()
+        if self.seconds is not None:
+            self.deadline = self.started + self.seconds
+        self.profiler.start()
+
+    def tick(self, count=1):
+        """Counts executed commands
+
+        Returns:
+            a boolean, whether the profile reached its number of commands or seconds
+        """
+        self.count += count
+        if self.commands is not None and self.count >= self.commands:
+            return True
+        return self.deadline is not None and time.perf_counter() >= self.deadline
+
+    def stop(self):
+        """Stops the profiler and writes its results
+
+        Returns:
+            a tuple, containing the number of commands profiled, the seconds taken and the path
+        """
+        self.profiler.stop()
+        seconds = time.perf_counter() - self.started
+        self.profiler.write(self.path)
+        return (self.count, seconds, self.path)
+
+
+def parse_profile_arguments(arguments):
+    """Parses the arguments of PROFILE START: mode path [SECONDS n] [COMMANDS n]
+
+    Returns:
+        a tuple, containing the path, the mode, the seconds and the number of commands
+        (None if they are not given), as the arguments of DBConsole.start_profile
+
+    Raises:
+        ValueError: if the arguments are not valid
+    """
+    if len(arguments) < 2 or len(arguments) % 2:
+        raise ValueError('expected PROFILE START mode path [SECONDS n] [COMMANDS n]')
+    mode, path = arguments[0], arguments[1]
+    limits = {'SECONDS': None, 'COMMANDS': None}
+    for index in range(2, len(arguments), 2):
+        limit = arguments[index].upper()
+        if limit not in limits:
+            raise ValueError('expected SECONDS or COMMANDS, found %r' % arguments[index])
+        try:
+            limits[limit] = float(arguments[index + 1]) if limit == 'SECONDS' else int(arguments[index + 1])
+        except ValueError:
+            raise ValueError('%s must be a number' % limit)
+    return (path, mode, limits['SECONDS'], limits['COMMANDS'])
+
+
+def format_profile(result):
+    """Formats the result of a profile, see ProfileSession.stop"""
+    return 'OK %d commands profiled in %.2fs, written to %s' % result
@@ -0,0 +1,478 @@
+"""
+Primary-replica replication for the Simple Database
+
+    A server started with --replicaof follows another server (its primary): it keeps a copy
+    of the committed data of the primary and serves the reads of its clients, rejecting
+    any write. Any server accepts replicas, the replication stream only starts being
+    recorded once the first replica connects.
+
+    > python server.py --port 6380
+    > python server.py --port 6381 --replicaof 127.0.0.1:6380
+
+Replication stream:
+    The primary is a listener of its committed data (see Data.listeners), so it ships
+    exactly what a command log records: SET and UNSET run outside a transaction, and the
+    flattened write set of each COMMIT wrapped in BEGIN ... COMMIT, in the grammar of
+    CommandLog.encode. Uncommitted or rolled back work never reaches the data, hence it is
+    never shipped. Keys removed when their time to live is over are shipped as UNSET, so
+    replicas never expire keys by themselves.
+
+    Every byte of the stream has an offset, counted since the stream started. The primary
+    keeps the latest BACKLOG_SIZE bytes of the stream in a backlog.
+
+Protocol:
+    replica:  PSYNC replication_id offset         ('? -1' if it never synced)
+    primary:  CONTINUE replication_id offset      if the stream from that offset is still in
+                                                  the backlog, followed by it (partial resync)
+              FULLRESYNC replication_id offset n  otherwise, followed by a snapshot of n bytes
+                                                  (full sync) of the data at that offset
+    Then the primary sends the stream as changes are committed, along with a line
+    'PING time' every heartbeat interval, which is not part of the stream. The replica sends
+    a line 'REPLCONF ACK offset' every heartbeat interval with the offset it applied.
+
+    Replicas apply a BEGIN ... COMMIT block at once, and only count its offset once it is
+    applied, so a replica that reconnects in the middle of a block receives it again.
+    The snapshot is pickled, so a replica must only follow a trusted primary.
+
+Lag:
+    The primary reports, for each replica, the bytes of the stream it did not acknowledge
+    yet and the seconds since its latest acknowledgement. A replica reports the seconds
+    between the time a PING was sent and the time it applied it, that is, how long the
+    changes take to reach it, and the seconds since it last read from its primary.
+    Both are printed by the REPLICATION command.
+
+"""
+
+import asyncio
+import os
+import pickle
+import time
+
+from persistence import SNAPSHOT_HEADER, CommandLog
+
+
+BACKLOG_SIZE = 1 << 20
+
+REPLICA_OUTPUT_LIMIT = 1 << 26
+
+HEARTBEAT_INTERVAL = 1.0
+
+REPLICATION_TIMEOUT = 60.0
+
+RECONNECT_INTERVAL = 1.0
+
+READ_SIZE = 1 << 16
+
+READONLY = "ERR READONLY You can't write against a read only replica"
+
+READ_COMMANDS = frozenset(['GET', 'MGET', 'NUMEQUALTO', 'TTL', 'MEMORY', 'NUMRANGE', 'NUMGREATERTHAN', 'LEXRANGE',
+                           'KEYSWITHVALUE', 'SCANVALUE', 'KEYS', 'SCAN', 'EXPORT', 'INFO', 'STATS', 'SLOWLOG',
+                           'PROFILE', 'SAVE', 'BGSAVE', 'REPLICATION'])
+
+
+
+def encode_snapshot(data):
+    """Returns the committed data of a database as the bytes of a snapshot file, see persistence.py
+
+    Running Time: O(n)
+    Being 'n' the number of keys
+    """
+    values_freq = data.values_freq
+    if not isinstance(values_freq, dict):
+        values_freq = dict(values_freq)
+    return SNAPSHOT_HEADER + pickle.dumps((data.data, values_freq), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def decode_snapshot(payload):
+    """Returns a tuple with the data and the values frequency of a snapshot, see encode_snapshot
+
+    Raises:
+        ValueError: if the payload is not a snapshot
+    """
+    if not payload.startswith(SNAPSHOT_HEADER):
+        raise ValueError('invalid snapshot received from the primary')
+    return pickle.loads(payload[len(SNAPSHOT_HEADER):])
+
+
+def make_read_only(console):
+    """Makes a DBConsole reject every command that is not one of READ_COMMANDS"""
+    for name, operation in list(console.operations.items()):
+        if name not in READ_COMMANDS:
+            console.register(name, None, reject_write, str)
+
+
+def reject_write(*arguments):
+    """Handler of the write commands on a replica"""
+    return READONLY
+
+
+
+class ReplicaLink(object):
+    """Connection of the primary with one of its replicas
+
+    Attributes:
+        writer: an object of type asyncio.StreamWriter of the connection
+
+        address: an string, the address of the replica
+
+        ack_offset: an integer, the latest offset acknowledged by the replica
+
+        ack_time: a float, the time (time.monotonic) of the latest acknowledgement
+    """
+    __slots__ = ('writer', 'address', 'ack_offset', 'ack_time')
+
+    def __init__(self, writer, offset):
+        self.writer = writer
+        self.address = format_address(writer.get_extra_info('peername'))
+        self.ack_offset = offset
+        self.ack_time = time.monotonic()
+
+
+def format_address(address):
+    """Formats the address of a socket, a tuple (host, port, ...) or the path of a Unix socket"""
+    if isinstance(address, tuple):
+        return '%s:%d' % address[:2]
+    return str(address or 'unix')
+
+
+
+class Primary(object):
+    """Source of the replication stream of a database, see the module documentation
+
+    It must be used from the event loop thread that runs the commands of the database.
+
+    Args:
+        database: an object of type Database whose committed data is replicated
+        backlog_size: an integer, the number of bytes of the stream kept for partial resyncs
+        heartbeat_interval: a number, the seconds between two PING lines
+
+    Attributes:
+        data: an object of type Data, the committed data
+
+        replication_id: an string identifying the stream, random for each Primary
+
+        offset: an integer, the offset of the end of the stream
+
+        backlog: a bytearray with the latest bytes of the stream, up to backlog_size
+
+        links: a set of objects of type ReplicaLink, the replicas connected
+
+        attached: a boolean, whether the stream started (it is a listener of the data)
+
+        heartbeat: an object of type asyncio.Task sending the PING lines, or None
+    """
+    def __init__(self, database, backlog_size=BACKLOG_SIZE, heartbeat_interval=HEARTBEAT_INTERVAL):
+        self.data = database.database
+        self.backlog_size = backlog_size
+        self.heartbeat_interval = heartbeat_interval
+        self.replication_id = os.urandom(20).hex()
+        self.offset = 0
+        self.backlog = bytearray()
+        self.links = set()
+        self.attached = False
+        self.heartbeat = None
+
+    def attach(self):
+        """Starts the stream, listening to the changes committed into the data"""
+        if self.attached:
+            return
+        self.data.listeners.append(self)
+        self.attached = True
+        self.heartbeat = asyncio.get_running_loop().create_task(self.send_heartbeats())
+
+    def on_commit(self, changes):
+        """Appends the changes committed to the stream and sends them to every replica
+
+        A replica whose connection holds more than REPLICA_OUTPUT_LIMIT bytes not sent yet is
+        disconnected, it resyncs once it reconnects.
+
+        Running Time: O(k + r)
+        Being 'k' the number of changes and 'r' the number of replicas
+        """
+        record = CommandLog.encode(changes).encode('utf-8')
+        self.offset += len(record)
+        self.backlog += record
+        if len(self.backlog) > self.backlog_size:
+            del self.backlog[:len(self.backlog) - self.backlog_size]
+        for link in list(self.links):
+            link.writer.write(record)
+            if link.writer.transport.get_write_buffer_size() > REPLICA_OUTPUT_LIMIT:
+                self.links.discard(link)
+                link.writer.close()
+
+    def on_load(self, data):
+        """Starts a new stream once all the content of the data is replaced (a bulk import or a
+        full sync of a replica that is also a primary), every replica must do a full sync"""
+        self.replication_id = os.urandom(20).hex()
+        self.backlog = bytearray()
+        for link in self.links:
+            link.writer.close()
+        self.links = set()
+
+    def backlog_offset(self):
+        """Returns the offset of the first byte of the backlog"""
+        return self.offset - len(self.backlog)
+
+    async def serve_replica(self, reader, writer, arguments):
+        """Serves a replica that sent PSYNC until it disconnects
+
+        Args:
+            reader: an object of type asyncio.StreamReader of the connection
+            writer: an object of type asyncio.StreamWriter of the connection
+            arguments: a list with the arguments of PSYNC
+        """
+        try:
+            if len(arguments) != 2:
+                raise ValueError('expected PSYNC replication_id offset')
+            offset = int(arguments[1])
+        except ValueError as error:
+            writer.write(('ERR %s\n' % error).encode('utf-8'))
+            return
+
+        self.attach()
+        if arguments[0] == self.replication_id and self.backlog_offset() <= offset <= self.offset:
+            writer.write(('CONTINUE %s %d\n' % (self.replication_id, offset)).encode('utf-8'))
+            writer.write(self.backlog[offset - self.backlog_offset():])
+        else:
+            offset = self.offset
+            payload = encode_snapshot(self.data)
+            writer.write(('FULLRESYNC %s %d %d\n' % (self.replication_id, offset, len(payload))).encode('utf-8'))
+            writer.write(payload)
+        link = ReplicaLink(writer, offset)
+        self.links.add(link)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                fields = line.split()
+                if len(fields) == 3 and fields[0] == b'REPLCONF' and fields[1] == b'ACK':
+                    link.ack_offset = int(fields[2])
+                    link.ack_time = time.monotonic()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self.links.discard(link)
+
+    async def send_heartbeats(self):
+        """Sends a PING line to every replica every heartbeat interval, until it is cancelled"""
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            ping = ('PING %r\n' % time.time()).encode('utf-8')
+            for link in list(self.links):
+                link.writer.write(ping)
+
+    def info(self):
+        """Returns a dictionary with the state of the stream and the lag of each replica"""
+        now = time.monotonic()
+        info = {
+            'role': 'primary',
+            'replication_id': self.replication_id,
+            'replication_offset': self.offset,
+            'backlog_offset': self.backlog_offset(),
+            'connected_replicas': len(self.links)
+        }
+        for index, link in enumerate(sorted(self.links, key=lambda link: link.address)):
+            info['replica%d' % index] = 'address=%s,offset=%d,lag_bytes=%d,ack_seconds_ago=%.2f' % (
+                link.address, link.ack_offset, self.offset - link.ack_offset, now - link.ack_time)
+        return info
+
+    def close(self):
+        """Stops the stream and disconnects every replica"""
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+            self.heartbeat = None
+        if self.attached:
+            self.data.listeners.remove(self)
+            self.attached = False
+        for link in self.links:
+            link.writer.close()
+        self.links = set()
+
+
+
+class Replica(object):
+    """Follower that keeps the committed data of a database in sync with a primary server
+
+    The changes received are applied through Data.put and Data.apply, so the listeners of
+    the data (indexes, command log) are updated as usual, and a full sync replaces all the
+    content through Data.load.
+
+    Args:
+        database: an object of type Database, read only for its clients
+        host: an string, the host of the primary, or None to connect to a Unix socket
+        port: an integer, the port of the primary
+        unix_path: an string, the path of the Unix socket of the primary
+        heartbeat_interval: a number, the seconds between two acknowledgements
+        timeout: a number, the seconds without reading anything after which the connection
+                 with the primary is considered lost
+
+    Attributes:
+        replication_id: an string, the identifier of the stream followed, or None
+
+        offset: an integer, the offset of the stream applied, or -1 if it never synced
+
+        connected: a boolean, whether the replica is synced and following the stream
+
+        full_syncs: an integer, the number of full syncs done
+
+        partial_syncs: an integer, the number of partial resyncs done
+
+        lag: a float, the seconds the latest PING took to be applied
+
+        last_read: a float, the time (time.monotonic) the replica last read from its primary
+    """
+    def __init__(self, database, host=None, port=None, unix_path=None, heartbeat_interval=HEARTBEAT_INTERVAL,
+                 timeout=REPLICATION_TIMEOUT):
+        self.data = database.database
+        self.host = host
+        self.port = port
+        self.unix_path = unix_path
+        self.heartbeat_interval = heartbeat_interval
+        self.timeout = timeout
+        self.replication_id = None
+        self.offset = -1
+        self.connected = False
+        self.full_syncs = 0
+        self.partial_syncs = 0
+        self.lag = 0.0
+        self.last_read = None
+        self.block = None
+        self.block_size = 0
+
+    async def run(self):
+        """Follows the primary, reconnecting whenever the connection is lost, until it is cancelled"""
+        while True:
+            try:
+                await self.follow()
+            except (ConnectionError, OSError, EOFError, ValueError, asyncio.IncompleteReadError,
+                    asyncio.TimeoutError):
+                pass
+            self.connected = False
+            await asyncio.sleep(RECONNECT_INTERVAL)
+
+    async def connect(self):
+        """Opens a connection with the primary"""
+        if self.unix_path is not None:
+            return await asyncio.open_unix_connection(self.unix_path)
+        return await asyncio.open_connection(self.host, self.port)
+
+    async def follow(self):
+        """Syncs with the primary and applies its stream until the connection is lost"""
+        reader, writer = await self.connect()
+        acknowledger = None
+        try:
+            writer.write(('PSYNC %s %d\n' % (self.replication_id or '?', self.offset)).encode('utf-8'))
+            fields = (await asyncio.wait_for(reader.readline(), self.timeout)).decode('utf-8').split()
+            if len(fields) == 4 and fields[0] == 'FULLRESYNC':
+                payload = await asyncio.wait_for(reader.readexactly(int(fields[3])), self.timeout)
+                self.data.load(*decode_snapshot(payload))
+                self.full_syncs += 1
+            elif len(fields) == 3 and fields[0] == 'CONTINUE' and fields[1] == self.replication_id \
+                    and int(fields[2]) == self.offset:
+                self.partial_syncs += 1
+            else:
+                raise ValueError('unexpected reply from the primary: %r' % ' '.join(fields))
+            self.replication_id = fields[1]
+            self.offset = int(fields[2])
+            self.block = None
+            self.connected = True
+            self.last_read = time.monotonic()
+            acknowledger = asyncio.get_running_loop().create_task(self.acknowledge(writer))
+
+            pending = b''
+            while True:
+                chunk = await asyncio.wait_for(reader.read(READ_SIZE), self.timeout)
+                if not chunk:
+                    raise EOFError('the primary closed the connection')
+                self.last_read = time.monotonic()
+                pending += chunk
+                end = pending.rfind(b'\n')
+                if end >= 0:
+                    self.apply_lines(pending[:end].split(b'\n'))
+                    pending = pending[end + 1:]
+        finally:
+            if acknowledger is not None:
+                acknowledger.cancel()
+            writer.close()
+
+    def apply_lines(self, lines):
+        """Applies the complete lines of the stream received
+
+        Running Time: O(n)
+        Being 'n' the number of lines
+        """
+        data = self.data
+        for line in lines:
+            fields = line.decode('utf-8').split()
+            size = len(line) + 1
+            if not fields:
+                self.offset += size
+                continue
+            name = fields[0]
+            if name == 'PING':
+                self.lag = max(time.time() - float(fields[1]), 0.0)
+                continue
+            if self.block is not None:
+                self.block_size += size
+                if name == 'COMMIT':
+                    data.apply(self.block)
+                    self.offset += self.block_size
+                    self.block = None
+                elif name == 'SET':
+                    self.block[fields[1]] = fields[2]
+                elif name == 'UNSET':
+                    self.block[fields[1]] = None
+                else:
+                    raise ValueError('unexpected line in the replication stream: %r' % line)
+                continue
+            if name == 'SET':
+                data.put(fields[1], fields[2])
+            elif name == 'UNSET':
+                data.put(fields[1], None)
+            elif name == 'BEGIN':
+                self.block = {}
+                self.block_size = size
+                continue
+            else:
+                raise ValueError('unexpected line in the replication stream: %r' % line)
+            self.offset += size
+
+    async def acknowledge(self, writer):
+        """Sends the offset applied every heartbeat interval, until it is cancelled"""
+        while True:
+            writer.write(('REPLCONF ACK %d\n' % self.offset).encode('utf-8'))
+            await asyncio.sleep(self.heartbeat_interval)
+
+    def info(self):
+        """Returns a dictionary with the state of the replica and its lag"""
+        if self.unix_path is not None:
+            primary = self.unix_path
+        else:
+            primary = '%s:%d' % (self.host, self.port)
+        return {
+            'role': 'replica',
+            'primary': primary,
+            'link_status': 'up' if self.connected else 'down',
+            'replication_id': self.replication_id or '?',
+            'replication_offset': self.offset,
+            'full_syncs': self.full_syncs,
+            'partial_syncs': self.partial_syncs,
+            'lag_seconds': self.lag,
+            'last_read_seconds_ago': time.monotonic() - self.last_read if self.last_read is not None else -1.0
+        }
+
+
+def parse_address(address):
+    """Parses the address of a primary, 'host:port' or the path of a Unix socket
+
+    Returns:
+        a tuple, containing the host, the port and the Unix socket path (None the ones not used)
+
+    Raises:
+        ValueError: if the port is not a number
+    """
+    host, separator, port = address.rpartition(':')
+    if not separator or os.sep in address:
+        return (None, None, address)
+    return (host, int(port), None)
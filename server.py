@@ -0,0 +1,354 @@
+"""
+Network front end for the Simple Database
+
+    The server speaks the same grammar as the console: each line sent by a client is a
+    command, and each line printed by the console is sent back as a reply line.
+    Each connection runs on its own session (see Session), so the transactions of a
+    client never mix with the transactions of other clients.
+
+    > python server.py --port 6380
+    > python server.py --unix /tmp/simple_database.sock
+
+Pipelining:
+    Clients may send many commands without waiting for their replies. Every chunk read
+    from a connection is split into commands that are executed in order, and all their
+    replies are written back with a single write. A command split between two chunks is
+    kept until the rest of it arrives.
+
+Backpressure:
+    After writing the replies of a chunk, the server waits until the write buffer of the
+    connection drains below its high water mark before reading more commands. A client
+    that does not read its replies therefore stops being served, instead of making the
+    server buffer an unbounded amount of replies.
+
+Expiry:
+    Besides removing expired keys when they are accessed, the server sweeps them from the
+    event loop every expire_interval seconds, a bounded amount at a time.
+
+Profiling:
+    PROFILE START, sent by any connection, profiles the event loop thread, so it covers the
+    commands of all connections, and counts them until its number of commands is reached.
+    Its number of seconds is enforced by a timer of the event loop, even without traffic.
+
+File commands:
+    LOAD (IMPORT), EXPORT and PROFILE read or write a file at a path chosen by the client, as
+    the user running the server. They are disabled for the connections unless the server is
+    started with --allow-file-commands, and reply FILE_COMMANDS_DISABLED instead.
+
+Replication:
+    Any server is the primary of the replicas that connect to it and send PSYNC, and a
+    server started with --replicaof host:port (or a Unix socket path) is a read only replica
+    of another one, see replication.py. REPLICATION prints the role, offsets and lag.
+
+"""
+
+import argparse
+import asyncio
+
+from profiling import ProfileSession, create_profiler, format_profile, parse_profile_arguments
+from replication import Primary, Replica, make_read_only, parse_address
+from simple_database import INVALID_COMMAND, NO_PROFILE, DBConsole, add_arguments, open_database, open_stats
+from simple_database import format_message, parse_command
+from stats import format_info
+
+
+MAX_LINE_LENGTH = 1 << 20
+
+LINE_TOO_LONG = 'ERR line too long'
+
+FILE_COMMANDS = frozenset(['LOAD', 'IMPORT', 'EXPORT', 'PROFILE'])
+
+FILE_COMMANDS_DISABLED = 'ERR file commands are disabled, start the server with --allow-file-commands'
+
+
+
+class DatabaseServer(object):
+    """asyncio server that executes the commands of many connections from a single event loop
+
+    Args:
+        database: an object of type Database shared by all connections
+
+        persistence: an object of type Persistence of the database, or None
+
+        stats: an object of type Stats shared by the consoles of all connections, or None to
+               collect no statistics
+
+        read_size: an integer, the maximum number of bytes read at once from a connection
+
+        write_buffer_limit: an integer, the number of bytes of pending replies of a connection
+                            above which the server stops reading its commands
+
+        expire_interval: a number, the seconds between two sweeps of expired keys
+
+        expire_limit: an integer, the maximum number of expired keys removed by a sweep, so
+                      a large amount of keys expiring at once never blocks the event loop
+
+        replica_of: an string, the address of the primary to follow ('host:port' or the path
+                    of a Unix socket), or None if the server accepts writes
+
+        allow_file_commands: a boolean, if True the clients may run FILE_COMMANDS, which read
+                             and write any path the server user can access
+
+    Attributes:
+        connections: an integer, the number of connections currently opened
+
+        profile_session: an object of type ProfileSession of the running profile, or None
+
+        profile_timer: an object of type asyncio.TimerHandle that stops the running profile
+                       once its seconds are over, or None
+
+        primary: an object of type Primary serving the replicas of this server
+
+        replica: an object of type Replica following the primary of this server, or None
+
+    Raises:
+        ValueError: if the database uses the undo engine, which does not support the sessions
+                    of the connections, see Database.session
+    """
+    def __init__(self, database, persistence=None, read_size=1 << 16, write_buffer_limit=1 << 20,
+                 expire_interval=0.1, expire_limit=1000, stats=None, replica_of=None, allow_file_commands=False):
+        if database.transaction_handler.in_place:
+            raise ValueError('the server does not support the undo engine, each connection needs its own session')
+        self.database = database
+        self.persistence = persistence
+        self.stats = stats
+        self.read_size = read_size
+        self.write_buffer_limit = write_buffer_limit
+        self.expire_interval = expire_interval
+        self.expire_limit = expire_limit
+        self.allow_file_commands = allow_file_commands
+        self.connections = 0
+        self.server = None
+        self.profile_session = None
+        self.profile_timer = None
+        self.primary = Primary(database)
+        self.replica = None
+        if replica_of is not None:
+            self.replica = Replica(database, *parse_address(replica_of))
+
+    def create_console(self):
+        """Creates the console that executes the commands of a new connection on its own session"""
+        console = DBConsole(self.database.session(), persistence=self.persistence, stats=self.stats)
+        console.register('PROFILE', -1, self.profile, format_message)
+        console.register('REPLICATION', 0, self.replication_info, format_info)
+        console.end_operation.add('PSYNC')
+        if self.replica is not None:
+            make_read_only(console)
+        if not self.allow_file_commands:
+            for name in FILE_COMMANDS:
+                console.register(name, None, reject_file_command, str)
+        return console
+
+    def replication_info(self):
+        """Returns a dictionary with the state of the replication of this server, see REPLICATION"""
+        if self.replica is None:
+            return self.primary.info()
+        info = self.replica.info()
+        info['connected_replicas'] = len(self.primary.links)
+        return info
+
+    def execute_lines(self, console, lines):
+        """Executes a batch of command lines
+
+        Args:
+            console: an object of type DBConsole of the connection
+            lines: a list of strings, each one representing a command
+
+        Returns:
+            a tuple, containing a list of strings with the reply lines and the Command that
+            ends the connection (END, or PSYNC that turns it into a replication link), or None
+        """
+        replies = []
+        execute = console.execute
+        end_operation = console.end_operation
+        for line in lines:
+            command = parse_command(line)
+            if command is None:
+                continue
+            if command[0] in end_operation:
+                return (replies, command)
+
+            output = execute(command)
+            if output is not None:
+                replies.append(output)
+        return (replies, None)
+
+    def execute_lines_profiled(self, console, lines):
+        """Executes a batch of command lines as execute_lines does, counting them in the
+        running profile"""
+        replies, end = DatabaseServer.execute_lines(self, console, lines)
+        if self.profile_session.tick(len(lines)):
+            self.stop_profile()
+        return (replies, end)
+
+    def start_profile(self, path, mode='cprofile', seconds=None, commands=None):
+        """Starts profiling the event loop thread, see DBConsole.start_profile
+
+        It must be called from the event loop thread, and replaces the execute_lines method
+        of this server with execute_lines_profiled until the profile stops.
+
+        Raises:
+            ValueError: if a profile is already running or the arguments are not valid
+            OSError: if the file cannot be written
+        """
+        if self.profile_session is not None:
+            raise ValueError('a profile is already running')
+        session = ProfileSession(create_profiler(mode), path, seconds, commands)
+        session.start()
+        self.profile_session = session
+        self.execute_lines = self.execute_lines_profiled
+        if seconds is not None:
+            self.profile_timer = asyncio.get_running_loop().call_later(seconds, self.stop_profile)
+
+    def stop_profile(self):
+        """Stops the running profile, writing its results, see DBConsole.stop_profile"""
+        session = self.profile_session
+        if session is None:
+            return None
+        self.profile_session = None
+        del self.execute_lines
+        if self.profile_timer is not None:
+            self.profile_timer.cancel()
+            self.profile_timer = None
+        return session.stop()
+
+    def profile(self, subcommand, *arguments):
+        """Handles PROFILE START mode path [SECONDS n] [COMMANDS n] and PROFILE STOP"""
+        subcommand = subcommand.upper()
+        if subcommand == 'START':
+            try:
+                self.start_profile(*parse_profile_arguments(arguments))
+            except (OSError, ValueError) as error:
+                return 'ERR %s' % error
+            return 'OK'
+        if subcommand == 'STOP' and not arguments:
+            result = self.stop_profile()
+            if result is None:
+                return NO_PROFILE
+            return format_profile(result)
+        return INVALID_COMMAND
+
+    async def handle_connection(self, reader, writer):
+        """Serves a connection until the client closes it or sends END"""
+        console = None
+        try:
+            self.connections += 1
+            writer.transport.set_write_buffer_limits(high=self.write_buffer_limit)
+            console = self.create_console()
+            command_log = self.persistence.command_log if self.persistence is not None else None
+            pending = b''
+            while True:
+                chunk = await reader.read(self.read_size)
+                if not chunk:
+                    break
+
+                pending += chunk
+                end = pending.rfind(b'\n')
+                if end < 0:
+                    if len(pending) > MAX_LINE_LENGTH:
+                        writer.write((LINE_TOO_LONG + '\n').encode('utf-8'))
+                        break
+                    continue
+
+                lines = pending[:end].decode('utf-8', 'replace').split('\n')
+                pending = pending[end + 1:]
+
+                if command_log is not None:
+                    with command_log.group():
+                        replies, end = self.execute_lines(console, lines)
+                else:
+                    replies, end = self.execute_lines(console, lines)
+
+                if replies:
+                    replies.append('')
+                    writer.write('\n'.join(replies).encode('utf-8'))
+                    await writer.drain()
+                if end is not None:
+                    if end[0] == 'PSYNC':
+                        await self.primary.serve_replica(reader, writer, end[1])
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            if console is not None:
+                console.database.close()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def start(self, host=None, port=None, unix_path=None):
+        """Starts listening on a TCP address or on a Unix socket
+
+        Returns:
+            an object of type asyncio.Server
+        """
+        if unix_path is not None:
+            self.server = await asyncio.start_unix_server(self.handle_connection, path=unix_path)
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server
+
+    async def expire_periodically(self):
+        """Removes the expired keys in small sweeps until it is cancelled (active expiry)
+
+        A sweep that reaches its limit is followed by another one right away, otherwise
+        the next sweep waits for expire_interval.
+        """
+        while True:
+            if self.database.expire_due(self.expire_limit) < self.expire_limit:
+                await asyncio.sleep(self.expire_interval)
+            else:
+                await asyncio.sleep(0)
+
+    async def serve_forever(self, host=None, port=None, unix_path=None):
+        """Starts the server and serves connections until it is cancelled"""
+        server = await self.start(host, port, unix_path)
+        loop = asyncio.get_running_loop()
+        expiry = loop.create_task(self.expire_periodically())
+        replication = loop.create_task(self.replica.run()) if self.replica is not None else None
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            expiry.cancel()
+            if replication is not None:
+                replication.cancel()
+            self.primary.close()
+
+
+
+def reject_file_command(*arguments):
+    """Handler of FILE_COMMANDS when they are disabled"""
+    return FILE_COMMANDS_DISABLED
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simple In-Memory Database server')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=6380, help='TCP port to listen on (default: %(default)s)')
+    parser.add_argument('--unix', help='Unix socket path to listen on instead of TCP')
+    parser.add_argument('--replicaof', help='address of the primary to replicate, host:port or a Unix socket path')
+    parser.add_argument('--allow-file-commands', action='store_true',
+                        help='let the clients run LOAD, IMPORT, EXPORT and PROFILE on paths of this host')
+    add_arguments(parser)
+    args = parser.parse_args()
+    if args.engine == 'undo':
+        parser.error('the undo engine is not supported by the server, each connection needs its own session')
+
+    database, persistence = open_database(args)
+    server = DatabaseServer(database, persistence, stats=open_stats(args), replica_of=args.replicaof,
+                            allow_file_commands=args.allow_file_commands)
+    try:
+        asyncio.run(server.serve_forever(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if persistence is not None:
+            persistence.close()
+
+if __name__ == "__main__":
+    main()
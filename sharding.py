@@ -0,0 +1,511 @@
+"""
+Sharded deployment of the Simple Database
+
+    Keys are partitioned by hash across N worker processes, each one holding its own
+    Database. A coordinator (ShardedDatabase) routes GET, SET and UNSET to the shard of
+    the key, splits batches (MGET, MSET) by shard, and answers NUMEQUALTO by asking all
+    shards at once and summing their frequencies (scatter-gather).
+
+    > python sharding.py --shards 4 < filename.txt
+
+Transactions:
+    BEGIN is only forwarded to a shard when the transaction first touches one of its keys,
+    opening as many nested blocks as the coordinator has opened. ROLLBACK closes the
+    innermost block on the shards that reached that depth.
+    COMMIT runs a two-phase commit between the participant shards: all of them are asked
+    to PREPARE, and only if every one of them votes yes they are asked to COMMIT. Otherwise
+    all of them abort, discarding every block of the transaction, and COMMIT reports it.
+
+    A shard is only written through its coordinator, one request at a time, and the keys
+    modified by its open transaction can neither expire nor be evicted, so no other change
+    can conflict with its write set. PREPARE therefore votes no only when the blocks open in
+    the shard are not the ones the coordinator opened (a request failed halfway), besides
+    the shards that fail or cannot be reached.
+
+"""
+
+import argparse
+import heapq
+import multiprocessing
+
+from simple_database import Database, DBConsole
+
+
+
+def serve_shard(connection, options):
+    """Main loop of a shard process, executes the requests received from the coordinator
+
+    Every request is a tuple (operation, arguments) and every response a tuple
+    (ok, result), being 'ok' False if the operation raised an exception.
+
+    Args:
+        connection: an object of type multiprocessing.Connection to the coordinator
+        options: a dictionary with the keyword arguments of the Database of the shard
+    """
+    database = Database(**options)
+    prepared = False
+    operations = {
+        'get':                  database.get,
+        'set':                  database.set,
+        'unset':                database.unset,
+        'mget':                 database.mget,
+        'mset':                 lambda keys, values: database.mset(dict(zip(keys, values))),
+        'num_equal_to_many':    database.num_equal_to_many,
+        'expire':               database.expire,
+        'ttl':                  database.ttl,
+        'persist':              database.persist,
+        'setex':                database.setex,
+        'memory_stats':         database.memory_stats,
+        'count_range':          database.count_range,
+        'scan_keys_with_value': database.scan_keys_with_value,
+        'scan':                 database.scan,
+        'keys_with_prefix':     lambda prefix: list(database.keys_with_prefix(prefix)),
+        'rollback':             database.rollback,
+        'release':              database.release
+    }
+    while True:
+        try:
+            operation, arguments = connection.recv()
+        except EOFError:
+            return
+
+        try:
+            if operation == 'close':
+                connection.send((True, None))
+                return
+            elif prepared and operation not in ('commit', 'abort'):
+                raise RuntimeError('shard is prepared, only commit or abort are allowed')
+            elif operation == 'begin':
+                count, = arguments
+                for _ in range(count):
+                    database.begin()
+                result = None
+            elif operation == 'prepare':
+                depth, = arguments
+                prepared = database.is_transaction_active() and \
+                    database.transaction_handler.get_active_size() == depth
+                result = prepared
+            elif operation == 'commit':
+                prepared = False
+                result = database.commit()
+            elif operation == 'abort':
+                prepared = False
+                while database.rollback():
+                    pass
+                result = None
+            else:
+                result = operations[operation](*arguments)
+            connection.send((True, result))
+        except Exception as error:
+            connection.send((False, '%s: %s' % (type(error).__name__, error)))
+
+
+
+class Shard(object):
+    """Coordinator side of a shard process
+
+    Attributes:
+        depth: an integer, the number of transaction blocks opened in the shard
+    """
+    def __init__(self, context, options):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=serve_shard, args=(child_connection, options), daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.depth = 0
+
+    def send(self, operation, *arguments):
+        """Sends a request without waiting for its response"""
+        self.connection.send((operation, arguments))
+
+    def receive(self):
+        """Waits for the response of the oldest request sent, raising RuntimeError if it failed"""
+        ok, result = self.connection.recv()
+        if not ok:
+            raise RuntimeError(result)
+        return result
+
+    def call(self, operation, *arguments):
+        """Sends a request and waits for its response"""
+        self.send(operation, *arguments)
+        return self.receive()
+
+    def close(self):
+        """Stops the shard process"""
+        try:
+            self.call('close')
+        except (EOFError, OSError):
+            pass
+        self.connection.close()
+        self.process.join()
+
+
+
+class ShardedDatabase(object):
+    """Database partitioned by key hash across several processes
+
+    It supports the same operations as a Database, so it can be used by a DBConsole.
+
+    Args:
+        shards: an integer, the number of shard processes
+
+        options: the keyword arguments of the Database of each shard, such as range_index
+
+    Attributes:
+        shards: a list of objects of type Shard
+
+        depth: an integer, the number of transaction blocks opened by the coordinator
+
+        savepoints: a list with the name of each transaction block opened by the coordinator,
+                    being None for the ones opened by BEGIN
+    """
+    def __init__(self, shards=4, **options):
+        context = multiprocessing.get_context()
+        self.shards = [Shard(context, options) for _ in range(shards)]
+        self.depth = 0
+        self.savepoints = []
+
+    def shard_of(self, key):
+        """Returns the shard that holds a key
+
+        The shards live as long as the coordinator, so the built-in hash is stable enough
+        """
+        return self.shards[hash(key) % len(self.shards)]
+
+    def join(self, shard):
+        """Opens in a shard the transaction blocks of the coordinator it has not opened yet"""
+        if shard.depth < self.depth:
+            shard.call('begin', self.depth - shard.depth)
+            shard.depth = self.depth
+        return shard
+
+    def get(self, key):
+        """Fetches the latest value of a key from its shard"""
+        return self.shard_of(key).call('get', key)
+
+    def set(self, key, new_value):
+        """Assigns a new value for the given key in its shard"""
+        self.join(self.shard_of(key)).call('set', key, new_value)
+
+    def unset(self, key):
+        """Removes the key from its shard"""
+        self.join(self.shard_of(key)).call('unset', key)
+
+    def mget(self, keys):
+        """Fetches the latest value of several keys, querying all their shards in parallel"""
+        keys = list(keys)
+        shards = self.shards
+        count = len(shards)
+        positions = [[] for _ in range(count)]
+        for position, key in enumerate(keys):
+            positions[hash(key) % count].append(position)
+
+        for index, shard_positions in enumerate(positions):
+            if shard_positions:
+                shards[index].send('mget', [keys[position] for position in shard_positions])
+        values = [None] * len(keys)
+        for index, shard_positions in enumerate(positions):
+            if shard_positions:
+                for position, value in zip(shard_positions, shards[index].receive()):
+                    values[position] = value
+        return values
+
+    def mset(self, mapping):
+        """Assigns new values for several keys, modifying all their shards in parallel"""
+        shards = self.shards
+        count = len(shards)
+        keys = [[] for _ in range(count)]
+        values = [[] for _ in range(count)]
+        for key, value in mapping.items():
+            index = hash(key) % count
+            keys[index].append(key)
+            values[index].append(value)
+
+        touched = [index for index in range(count) if keys[index]]
+        for index in touched:
+            self.join(shards[index]).send('mset', keys[index], values[index])
+        for index in touched:
+            shards[index].receive()
+
+    def expire(self, key, seconds):
+        """Sets a time to live for a key in its shard, see Database.expire"""
+        return self.shard_of(key).call('expire', key, seconds)
+
+    def ttl(self, key):
+        """Retrieves the remaining time to live of a key from its shard, see Database.ttl"""
+        return self.shard_of(key).call('ttl', key)
+
+    def persist(self, key):
+        """Removes the time to live of a key in its shard, see Database.persist"""
+        return self.shard_of(key).call('persist', key)
+
+    def setex(self, key, seconds, new_value):
+        """Assigns a new value for the given key along with a time to live, outside of transactions"""
+        if self.depth:
+            return False
+        return self.shard_of(key).call('setex', key, seconds, new_value)
+
+    def num_equal_to(self, value):
+        """Retrieves the number of keys set to 'value', summing the frequency of all shards"""
+        return self.num_equal_to_many([value])[0]
+
+    def num_equal_to_many(self, values):
+        """Retrieves the number of keys set to each value, summing the frequencies of all shards"""
+        values = list(values)
+        for shard in self.shards:
+            shard.send('num_equal_to_many', values)
+        totals = [0] * len(values)
+        for shard in self.shards:
+            for index, freq in enumerate(shard.receive()):
+                totals[index] += freq
+        return totals
+
+    def count_range(self, index_name, low, high, low_inclusive=True, high_inclusive=True):
+        """Retrieves the number of keys set to a value within a range, summing the counts of all shards"""
+        for shard in self.shards:
+            shard.send('count_range', index_name, low, high, low_inclusive, high_inclusive)
+        counts = [shard.receive() for shard in self.shards]
+        if None in counts:
+            return None
+        return sum(counts)
+
+    def num_range(self, low, high):
+        """Retrieves the number of keys set to a number between low and high, both included"""
+        return self.count_range('numeric', float(low), float(high))
+
+    def num_greater_than(self, low):
+        """Retrieves the number of keys set to a number greater than low"""
+        return self.count_range('numeric', float(low), None, low_inclusive=False)
+
+    def lex_range(self, low, high):
+        """Retrieves the number of keys set to a string between low and high, both included"""
+        return self.count_range('lexicographic', low, high)
+
+    def scan_keys_with_value(self, value, cursor=0, count=100):
+        """Reads a page of the keys set to a value, scanning one shard after another
+
+        The cursor encodes the shard being scanned along with the cursor within that shard.
+        """
+        shards = self.shards
+        index = cursor % len(shards)
+        page = shards[index].call('scan_keys_with_value', value, cursor // len(shards), count)
+        if page is None:
+            return None
+        shard_cursor, keys = page
+        if shard_cursor:
+            return (shard_cursor * len(shards) + index, keys)
+        if index + 1 < len(shards):
+            return (index + 1, keys)
+        return (0, keys)
+
+    def keys_with_value(self, value, count=1000):
+        """Generator that yields every key set to a value, from all shards, see Database.keys_with_value"""
+        cursor = 0
+        while True:
+            page = self.scan_keys_with_value(value, cursor, count)
+            if page is None:
+                raise ValueError('reverse index disabled')
+            cursor, keys = page
+            for key in keys:
+                yield key
+            if not cursor:
+                return
+
+    def scan(self, cursor=None, match=None, count=10):
+        """Reads a page of the keys in order, from all shards at once, see Database.scan
+
+        Every shard reads a page from the same cursor. The next cursor is the smallest
+        cursor returned by the shards, so the keys of the other pages beyond it are
+        dropped and read again by the next page.
+        """
+        for shard in self.shards:
+            shard.send('scan', cursor, match, count)
+        pages = []
+        error = None
+        for shard in self.shards:
+            try:
+                pages.append(shard.receive())
+            except RuntimeError as shard_error:
+                error = shard_error
+        if error is not None:
+            raise ValueError(str(error))
+        cursors = [page_cursor for page_cursor, _ in pages if page_cursor is not None]
+        next_cursor = min(cursors) if cursors else None
+        keys = []
+        for _, page_keys in pages:
+            keys.extend([key for key in page_keys if next_cursor is None or key <= next_cursor])
+        keys.sort()
+        return (next_cursor, keys)
+
+    def keys(self, pattern):
+        """Generator that yields in order the keys matching a glob-style pattern, from all shards"""
+        cursor = None
+        while True:
+            cursor, keys = self.scan(cursor, pattern, 1000)
+            for key in keys:
+                yield key
+            if cursor is None:
+                return
+
+    def keys_with_prefix(self, prefix):
+        """Generator that yields in order the keys starting with a prefix, merging the keys of all shards"""
+        for shard in self.shards:
+            shard.send('keys_with_prefix', prefix)
+        return heapq.merge(*[shard.receive() for shard in self.shards])
+
+    def memory_stats(self):
+        """Returns the memory usage and eviction statistics of all shards, adding up their numbers"""
+        for shard in self.shards:
+            shard.send('memory_stats')
+        stats = {}
+        for shard in self.shards:
+            for name, value in shard.receive().items():
+                if isinstance(value, int) and name in stats:
+                    stats[name] += value
+                else:
+                    stats[name] = value
+        return stats
+
+    def begin(self, name=None):
+        """Opens a transaction block, it is forwarded to each shard once it is touched"""
+        self.depth += 1
+        self.savepoints.append(name)
+
+    def savepoint(self, name):
+        """Opens a transaction block named as a savepoint"""
+        self.begin(name)
+
+    def find_savepoint(self, name):
+        """Returns the number of blocks opened since the most recent savepoint with the given
+        name, including it, or 0 if there is no such savepoint"""
+        for index in range(len(self.savepoints) - 1, -1, -1):
+            if self.savepoints[index] == name:
+                return self.depth - index
+        return 0
+
+    def release(self, name=None):
+        """Merges the most recent transaction block, or up to the given savepoint, into its
+        parent on every shard that opened it, the outermost block is committed instead
+
+        Returns:
+            a boolean, representing the execution or not of the operation.
+        """
+        levels = 1 if name is None else self.find_savepoint(name)
+        if not self.depth or not levels:
+            return False
+        for _ in range(levels):
+            if self.depth == 1:
+                return self.commit()
+            for shard in self.shards:
+                if shard.depth == self.depth:
+                    shard.send('release')
+            for shard in self.shards:
+                if shard.depth == self.depth:
+                    shard.receive()
+                    shard.depth -= 1
+            self.depth -= 1
+            self.savepoints.pop()
+        return True
+
+    def rollback_to(self, name):
+        """Undo all operations since the given savepoint was opened, which stays open
+
+        Returns:
+            a boolean, representing the execution or not of the operation.
+        """
+        levels = self.find_savepoint(name)
+        if not levels:
+            return False
+        for _ in range(levels):
+            self.rollback()
+        self.begin(name)
+        return True
+
+    def rollback(self):
+        """Undo all operations from the most recent transaction block on every shard
+
+        Returns:
+            a boolean, representing the execution or not of the operation.
+        """
+        if not self.depth:
+            return False
+        for shard in self.shards:
+            if shard.depth == self.depth:
+                shard.send('rollback')
+        for shard in self.shards:
+            if shard.depth == self.depth:
+                shard.receive()
+                shard.depth -= 1
+        self.depth -= 1
+        self.savepoints.pop()
+        return True
+
+    def commit(self):
+        """Applies all the changes made by the transactions with a two-phase commit
+
+        A shard that cannot be reached, or fails to prepare, votes no. If any participant
+        votes no, the transaction is aborted in the rest of them.
+
+        Returns:
+            a boolean, False if there is no transaction or it was aborted
+        """
+        if not self.depth:
+            return False
+
+        participants = [shard for shard in self.shards if shard.depth]
+        failed = set()
+        for shard in participants:
+            try:
+                shard.send('prepare', shard.depth)
+            except OSError:
+                failed.add(shard)
+
+        votes = []
+        for shard in participants:
+            if shard in failed:
+                continue
+            try:
+                votes.append(shard.receive())
+            except (RuntimeError, EOFError, OSError):
+                failed.add(shard)
+
+        operation = 'commit' if all(votes) and not failed else 'abort'
+        reachable = [shard for shard in participants if shard not in failed]
+        for shard in reachable:
+            shard.send(operation)
+        for shard in reachable:
+            shard.receive()
+        for shard in participants:
+            shard.depth = 0
+        self.depth = 0
+        self.savepoints = []
+        return operation == 'commit'
+
+    def is_transaction_active(self):
+        """Returns the existance of a transaction"""
+        return self.depth > 0
+
+    def close(self):
+        """Stops all shard processes"""
+        for shard in self.shards:
+            shard.close()
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sharded Simple In-Memory Database')
+    parser.add_argument('--shards', type=int, default=4, help='number of shard processes (default: %(default)s)')
+    parser.add_argument('--range-index', action='store_true', help='index the values to count the keys within a range of values')
+    parser.add_argument('--reverse-index', action='store_true', help='index the keys by value to find the keys set to a value')
+    parser.add_argument('--key-index', action='store_true', help='keep the keys sorted to enable KEYS and SCAN')
+    args = parser.parse_args()
+
+    database = ShardedDatabase(args.shards, range_index=args.range_index, reverse_index=args.reverse_index,
+                               key_index=args.key_index)
+    try:
+        DBConsole(database).listen()
+    finally:
+        database.close()
+
+if __name__ == "__main__":
+    main()
@@ -44,6 +44,34 @@ Memory usage:
 
 """
 
+import argparse
+import array
+import fnmatch
+import functools
+import heapq
+import math
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from collections.abc import Mapping
+
+from bulk import export_file, import_file
+from indexes import KeyIndex, RangeIndex, ReverseIndex, glob_prefix
+from persistence import FSYNC_EVERYSEC, FSYNC_POLICIES, Persistence
+from profiling import ProfileSession, create_profiler, format_profile, parse_profile_arguments
+from spill import BloomFilter, SortedRun, merge_runs
+from stats import SLOWLOG_MAX_LENGTH, SUB_BUCKET_BITS, UNKNOWN_COMMAND, SlowLog, Stats
+from stats import database_info, format_info, keys_touched, transaction_depth, write_set_size
+
+
+
+ENGINES = ('redo', 'undo')
+
+SPILL_BATCH_SIZE = 1 << 16
+
+SPILL_MAX_RUNS = 8
 
 
 
@@ -57,10 +85,98 @@ class Database(object):
         transaction_handler: ab object of type TransactionHandler that handles all methods related 
                              with transactions for the current database
 
+        new_handler: a callable receiving the committed data and returning a new transaction
+                     handler, used by the sessions as well
+
+    Args:
+        mvcc: a boolean, if True the committed data is stored as a VersionedData, so
+              transactions and batch reads work against a stable snapshot that is never
+              affected by commits running concurrently in other threads
+
+        thread_safe: a boolean, if True the committed data is stored as a StripedData, so
+                     it can be modified concurrently from several threads. Each thread must
+                     use its own session (see session) to run transactions.
+                     A database with mvcc is already thread-safe, since its commits are serialized
+
+        stripes: an integer, the number of lock stripes of a thread-safe database
+
+        maxmemory: an integer, if given the committed data is stored as a BoundedData, which
+                   evicts keys once their estimated memory exceeds this number of bytes.
+                   It is only supported by single-threaded databases (without mvcc nor thread_safe)
+
+        eviction_policy: an string, the policy used to choose the keys to evict, one of
+                         EVICTION_POLICIES
+
+        compact: a boolean, if True the committed values are interned (see Data.intern_values),
+                 which saves most of the memory of the values when many keys share a few of them
+
+        range_index: a boolean, if True the committed values are indexed by a numeric and a
+                     lexicographic RangeIndex, which enable num_range, num_greater_than and
+                     lex_range
+
+        reverse_index: a boolean, if True the committed keys are indexed by their value in a
+                       ReverseIndex, which enables keys_with_value and scan_keys_with_value.
+                       It costs about as much memory as the keys themselves
+
+        key_index: a boolean, if True the committed keys are kept sorted in a KeyIndex, which
+                   enables iterate_keys, keys_with_prefix, keys and scan
+
+        engine: an string, the transaction engine, one of ENGINES:
+                    redo: changes are kept apart by a TransactionHandler and applied by COMMIT
+                    undo: changes are written in place by an UndoTransactionHandler, so COMMIT
+                          runs in constant time. It does not support sessions, mvcc, 
+                          thread_safe, maxmemory nor secondary indexes
+
+        spill_threshold: an integer, if given the transactions are handled by a
+                         SpillingTransactionHandler, which moves the changes of the outermost
+                         transaction to disk once it modifies more than this number of keys.
+                         It is only supported by single-threaded databases with the redo
+                         engine, without reverse_index nor key_index
+
+        spill_directory: an string, the directory of the files of the spilled changes, or None
+                         for the default temporary directory
     """
-    def __init__(self):
-        self.database = Data()
-        self.transaction_handler = TransactionHandler(self.database)
+    __slots__ = ('database', 'transaction_handler', 'new_handler')
+
+    def __init__(self, mvcc=False, thread_safe=False, stripes=64, maxmemory=None, eviction_policy='lru',
+                 compact=False, range_index=False, reverse_index=False, key_index=False, engine='redo',
+                 spill_threshold=None, spill_directory=None):
+        if mvcc and thread_safe:
+            raise ValueError('mvcc and thread_safe are exclusive, a database with mvcc is already thread-safe')
+        if maxmemory is not None and (mvcc or thread_safe):
+            raise ValueError('maxmemory is only supported by single-threaded databases')
+        if engine not in ENGINES:
+            raise ValueError('invalid engine %r, expected one of %s' % (engine, ', '.join(ENGINES)))
+        if engine == 'undo' and (mvcc or thread_safe or maxmemory is not None or range_index or reverse_index or key_index):
+            raise ValueError('the undo engine writes in place, it does not support mvcc, thread_safe, maxmemory nor indexes')
+        if spill_threshold is not None and (mvcc or thread_safe or engine == 'undo' or reverse_index or key_index):
+            raise ValueError('spill_threshold is only supported by single-threaded databases with the redo engine, '
+                             'without reverse_index nor key_index')
+
+        if maxmemory is not None:
+            self.database = BoundedData(maxmemory, eviction_policy)
+        elif mvcc:
+            self.database = VersionedData()
+        elif thread_safe:
+            self.database = StripedData(stripes)
+        else:
+            self.database = Data()
+        self.database.intern_values = compact
+        if range_index:
+            self.database.add_index('numeric', RangeIndex(numeric=True))
+            self.database.add_index('lexicographic', RangeIndex())
+        if reverse_index:
+            self.database.add_index('reverse', ReverseIndex())
+        if key_index:
+            self.database.add_index('keys', KeyIndex())
+        if engine == 'undo':
+            self.new_handler = UndoTransactionHandler
+        elif spill_threshold is not None:
+            self.new_handler = functools.partial(SpillingTransactionHandler, spill_threshold=spill_threshold,
+                                                 spill_directory=spill_directory)
+        else:
+            self.new_handler = TransactionHandler
+        self.transaction_handler = self.new_handler(self.database)
 
     def get(self, key):
         """Fetches the latest value of a key from the database
@@ -91,7 +207,11 @@ class Database(object):
             value, found = self.transaction_handler.get(key)
             if found: 
                 return value
-        return self.database.data.get(key, None)
+            return self.transaction_handler.view.get(key)
+        database = self.database
+        if database.expires and key in database.expires:
+            database.expire(key)
+        return database.data.get(key, None)
 
     def set(self, key, new_value):
         """Assigns a new value for the given key
@@ -120,14 +240,12 @@ class Database(object):
             key: an string representing the key to modify
             new_value: an string representing the new value for the given key
         """
-        old_value = self.get(key)       
-        if old_value != new_value:
-            if self.is_transaction_active():
+        if self.is_transaction_active():
+            old_value = self.get(key)
+            if old_value != new_value:
                 self.transaction_handler.set(key, old_value, new_value)
-            else:
-                self.database.data[key] = new_value
-                Data.decrease_freq(self.database.values_freq, old_value)
-                Data.increase_freq(self.database.values_freq, new_value)
+        else:
+            self.database.put(key, new_value)
             
     def unset(self, key):
         """Removes the key from the database, like it was never set
@@ -150,12 +268,10 @@ class Database(object):
         Args:
             key: an string representing the key to remove
         """
-        old_value = self.get(key)
         if self.is_transaction_active():
-            self.transaction_handler.unset(key, old_value)
+            self.transaction_handler.unset(key, self.get(key))
         else:
-            self.data.pop(key, None)
-            Data.decrease_freq(self.database.values_freq, old_value)
+            self.database.put(key, None)
 
     def num_equal_to(self, value):
         """Retrieves the number of keys (variables) currently set to 'value'
@@ -179,9 +295,444 @@ class Database(object):
         Returns:
             an integer, representing the total frequency of this value
         """
-        return self.database.values_freq.get(value, 0) + self.transaction_handler.num_equal_to(value)
+        if self.is_transaction_active():
+            return self.transaction_handler.view.num_equal_to(value) + self.transaction_handler.num_equal_to(value)
+        database = self.database
+        if database.expires:
+            database.expire_due()
+        return database.values_freq.get(value, 0)
+
+    def mget(self, keys):
+        """Fetches the latest value of several keys at once
+
+        Works like calling get for each key, but the status of the database is checked
+        only once for the whole batch.
+
+        Running Time: O(k)
+        Being 'k' the number of keys requested
+
+        Args:
+            keys: an iterable of strings representing the keys to fetch
+
+        Returns:
+            a list of strings with the value of each key, in the same order, being None
+            the value of the keys that are not set
+        """
+        if not self.is_transaction_active():
+            view = self.database.read_view()
+            if view is self.database:
+                if self.database.expires:
+                    return [view.get(key) for key in keys]
+                data_get = self.database.data.get
+                return [data_get(key) for key in keys]
+            try:
+                return [view.get(key) for key in keys]
+            finally:
+                view.close()
+
+        transaction_get = self.transaction_handler.get
+        view_get = self.transaction_handler.view.get
+        values = []
+        for key in keys:
+            value, found = transaction_get(key)
+            if not found:
+                value = view_get(key)
+            values.append(value)
+        return values
+
+    def mset(self, mapping):
+        """Assigns new values for several keys at once
+
+        Works like calling set (or unset, for the keys mapped to None) for each pair, but
+        the status of the database is checked only once for the whole batch and the
+        frequency of each value is updated once with the aggregated changes of the batch.
+
+        Running Time: O(k)
+        Being 'k' the number of keys to modify
+
+        Args:
+            mapping: a dictionary mapping each key to modify to its new value, being None the
+                     value of the keys to remove
+        """
+        if self.is_transaction_active():
+            self.transaction_handler.apply(mapping)
+        else:
+            self.database.apply(mapping)
+
+    def num_equal_to_many(self, values):
+        """Retrieves the number of keys (variables) currently set to each of the values
+
+        Running Time: O(v)
+        Being 'v' the number of values requested
+
+        Args:
+            values: an iterable of strings representing the values to request
+
+        Returns:
+            a list of integers with the total frequency of each value, in the same order
+        """
+        if not self.is_transaction_active():
+            view = self.database.read_view()
+            if view is self.database:
+                if self.database.expires:
+                    self.database.expire_due()
+                database_freq = self.database.values_freq.get
+                return [database_freq(value, 0) for value in values]
+            try:
+                return [view.num_equal_to(value) for value in values]
+            finally:
+                view.close()
+
+        view_freq = self.transaction_handler.view.num_equal_to
+        transaction_freq = self.transaction_handler.freq_deltas().get
+        return [view_freq(value) + transaction_freq(value, 0) for value in values]
+
+    def execute_many(self, commands):
+        """Executes a batch of commands in order
+
+        Consecutive 'set' and 'unset' commands are gathered and applied at once through
+        mset, only the latest change of each key matters for the final state. Any other
+        command applies the gathered changes before being executed.
+
+        Running Time: O(n)
+        Being 'n' the number of commands, plus the running time of each of them
+
+        Args:
+            commands: an iterable of tuples (method_name, arguments), being 'method_name' 
+                      the name of a method of the database, such as 'set' or 'num_equal_to',
+                      and 'arguments' a list with its arguments
+
+        Returns:
+            a list with the result of each command, in the same order
+        """
+        methods = {
+            'get':                  self.get,
+            'num_equal_to':         self.num_equal_to,
+            'begin':                self.begin,
+            'rollback':             self.rollback,
+            'commit':               self.commit,
+            'mget':                 self.mget,
+            'mset':                 self.mset,
+            'num_equal_to_many':    self.num_equal_to_many
+        }
+        results = []
+        pending = {}
+        for method_name, arguments in commands:
+            if method_name == 'set':
+                key, value = arguments
+                pending[key] = value
+                results.append(None)
+            elif method_name == 'unset':
+                key, = arguments
+                pending[key] = None
+                results.append(None)
+            else:
+                if pending:
+                    self.mset(pending)
+                    pending = {}
+                results.append(methods[method_name](*arguments))
+        if pending:
+            self.mset(pending)
+        return results
+
+    def count_range(self, index_name, low, high, low_inclusive=True, high_inclusive=True):
+        """Retrieves the number of keys (variables) currently set to a value within a range
+
+        The committed frequencies are counted by the index, and the frequencies modified
+        by the open transactions are merged the same way num_equal_to does.
+        In a database with mvcc, the committed frequencies are the latest ones, not the 
+        ones of the snapshot read by the transactions.
+
+        Running Time: O(log v + t)
+        Being 'v' the number of distinct committed values and 't' the number of distinct values
+        modified by the open transactions
+
+        Args:
+            index_name: an string, the name of the RangeIndex, see Data.indexes
+            low: the lower bound of the range, or None if it is unbounded
+            high: the upper bound of the range, or None if it is unbounded
+            low_inclusive: a boolean, whether the lower bound belongs to the range
+            high_inclusive: a boolean, whether the upper bound belongs to the range
+
+        Returns:
+            an integer, representing the total frequency of the values within the range, or
+            None if the database has no such index
+        """
+        database = self.database
+        index = database.indexes.get(index_name)
+        if index is None:
+            return None
+        if database.expires:
+            database.expire_due()
+        total = index.count(low, high, low_inclusive, high_inclusive)
+        if self.is_transaction_active():
+            contains = index.contains
+            for value, freq in self.transaction_handler.freq_deltas().items():
+                if contains(value, low, high, low_inclusive, high_inclusive):
+                    total += freq
+        return total
+
+    def num_range(self, low, high):
+        """Retrieves the number of keys set to a number between low and high, both included, see count_range"""
+        return self.count_range('numeric', float(low), float(high))
+
+    def num_greater_than(self, low):
+        """Retrieves the number of keys set to a number greater than low, see count_range"""
+        return self.count_range('numeric', float(low), None, low_inclusive=False)
+
+    def lex_range(self, low, high):
+        """Retrieves the number of keys set to a string between low and high, both included, see count_range"""
+        return self.count_range('lexicographic', low, high)
+
+    def scan_keys_with_value(self, value, cursor=0, count=100):
+        """Reads a page of the keys (variables) currently set to 'value', see ReverseIndex.scan
+
+        The committed keys are read from the index. Within a transaction, the keys modified
+        by it are skipped from the pages of the index, and the ones it sets to the value are
+        added to the last page, so rolling back never touches the index.
+        In a database with mvcc, the committed keys are the latest ones, not the ones of the
+        snapshot read by the transactions.
+
+        Running Time: O(c + m)
+        Being 'c' the number of keys of the page and 'm' the number of keys modified by the
+        open transactions, which are only visited by the last page
+
+        Args:
+            value: an string representing the value
+            cursor: an integer, 0 to start or the cursor returned by the previous page
+            count: an integer, the number of committed keys read for the page
+
+        Returns:
+            a tuple, containing the cursor of the next page (0 once the scan is completed)
+            and a list with the keys of the page, or None if the database has no reverse index
+        """
+        database = self.database
+        index = database.indexes.get('reverse')
+        if index is None:
+            return None
+        if database.expires:
+            database.expire_due()
+        cursor, keys = index.scan(value, cursor, count)
+        if self.is_transaction_active():
+            transaction_data = self.transaction_handler.transactions.data
+            keys = [key for key in keys if key not in transaction_data]
+            if not cursor:
+                keys.extend([key for key, key_list in transaction_data.items() if key_list[-1] == value])
+        return (cursor, keys)
+
+    def keys_with_value(self, value, count=1000):
+        """Generator that yields every key (variable) currently set to 'value'
+
+        Keys are read in pages of 'count' keys through scan_keys_with_value, so the data
+        may be modified while the generator is consumed.
+
+        Raises:
+            ValueError: if the database has no reverse index
+        """
+        cursor = 0
+        while True:
+            page = self.scan_keys_with_value(value, cursor, count)
+            if page is None:
+                raise ValueError('reverse index disabled')
+            cursor, keys = page
+            for key in keys:
+                yield key
+            if not cursor:
+                return
+
+    def iterate_keys(self, after=None, prefix=''):
+        """Generator that yields in order the keys (variables) currently set, see KeyIndex.iterate
+
+        The committed keys are read from the index. Within a transaction, the keys it
+        unsets are skipped and the keys it sets are merged in order with them.
+        In a database with mvcc, the committed keys are the latest ones, not the ones of the
+        snapshot read by the transactions.
+
+        Running Time: O(log n + m + w log w)
+        Being 'n' the number of committed keys, 'm' the number of keys yielded and 'w' the
+        number of keys modified by the open transactions
+
+        Args:
+            after: an string, only keys greater than it are yielded, or None
+            prefix: an string, only keys starting with it are yielded
+
+        Raises:
+            ValueError: if the database has no key index
+        """
+        database = self.database
+        index = database.indexes.get('keys')
+        if index is None:
+            raise ValueError('key index disabled')
+        if database.expires:
+            database.expire_due()
+        committed = index.iterate(after, prefix)
+        if not self.is_transaction_active():
+            return committed
+
+        transaction_data = self.transaction_handler.transactions.data
+        added = sorted([key for key, key_list in transaction_data.items()
+                        if key_list[-1] is not None and key.startswith(prefix) and (after is None or key > after)])
+        committed = (key for key in committed if key not in transaction_data)
+        return heapq.merge(committed, added)
+
+    def keys_with_prefix(self, prefix):
+        """Generator that yields in order the keys (variables) starting with a prefix, see iterate_keys
+
+        Running Time: O(log n + m)
+        Being 'm' the number of matching keys
+        """
+        return self.iterate_keys(prefix=prefix)
+
+    def keys(self, pattern):
+        """Generator that yields in order the keys (variables) matching a glob-style pattern
+
+        Only the keys starting with the literal prefix of the pattern are visited, so
+        patterns such as 'user:*' run in O(log n + m), being 'm' the number of keys with 
+        that prefix.
+        """
+        prefix = glob_prefix(pattern)
+        for key in self.iterate_keys(prefix=prefix):
+            if fnmatch.fnmatchcase(key, pattern):
+                yield key
+
+    def scan(self, cursor=None, match=None, count=10):
+        """Reads a page of the keys (variables) in order
+
+        The cursor is the last key visited by the previous page, so the scan is valid while
+        keys are modified between pages: every key set during the whole scan is returned
+        exactly once.
+
+        Running Time: O(log n + c)
+        Being 'c' the number of keys visited
+
+        Args:
+            cursor: an string, None to start or the cursor returned by the previous page
+            match: an string, a glob-style pattern the keys returned must match, or None
+            count: an integer, the number of keys visited for the page. With a pattern the
+                   page may return less keys, only the keys with its literal prefix are visited
+
+        Returns:
+            a tuple, containing the cursor of the next page, or None once the scan is
+            completed, and a list with the keys of the page
+        """
+        prefix = glob_prefix(match) if match is not None else ''
+        keys = []
+        visited = None
+        for visited_count, key in enumerate(self.iterate_keys(cursor, prefix), 1):
+            visited = key
+            if match is None or fnmatch.fnmatchcase(key, match):
+                keys.append(key)
+            if visited_count == count:
+                return (visited, keys)
+        return (None, keys)
+
+    def expire(self, key, seconds):
+        """Sets a time to live for a key, after which it is removed
+
+        Time to live applies to the committed data, even if a transaction is opened, so it
+        is rejected for the keys modified by the open transactions, see is_shadowed.
+        An expired key is removed on its next access (lazy expiry), by any operation that
+        counts the values, and by expire_due, which should be called periodically to
+        reclaim the memory of keys that are never accessed again (active expiry).
+        Setting or unsetting the key removes its time to live, and a key modified by an 
+        open transaction does not expire until the transaction is closed.
+
+        Running Time: O(log n)
+        Being 'n' the number of keys with a time to live
+
+        Args:
+            key: an string representing the key
+            seconds: a number, the time to live of the key. If it is not positive, the key 
+                     is removed at once
+
+        Returns:
+            a boolean, representing whether the key is set, or None if the key is modified by
+            the open transactions
+        """
+        if self.is_shadowed(key):
+            return None
+        if self.get(key) is None:
+            return False
+        database = self.database
+        if not database.set_expire(key, database.clock() + seconds):
+            return False
+        if seconds <= 0:
+            database.expire(key)
+        return True
+
+    def ttl(self, key):
+        """Retrieves the remaining time to live of a key
+
+        The key is read as get does, so a key removed by the open transactions is not set.
+        A key they set has no time to live, since committing it removes the one of the
+        committed key.
+
+        Running Time: O(1)
+
+        Returns:
+            an integer, the number of seconds left rounded up, -1 if the key has no time to
+            live or -2 if it is not set
+        """
+        if self.get(key) is None:
+            return -2
+        if self.is_shadowed(key):
+            return -1
+        database = self.database
+        deadline = database.expires.get(key)
+        if deadline is None:
+            return -1
+        return max(0, int(math.ceil(deadline - database.clock())))
+
+    def persist(self, key):
+        """Removes the time to live of a key
+
+        Running Time: O(1)
+
+        Returns:
+            a boolean, representing whether the key had a time to live, always False for
+            the keys modified by the open transactions, see ttl
+        """
+        if self.get(key) is None or self.is_shadowed(key):
+            return False
+        return self.database.persist(key)
+
+    def is_shadowed(self, key):
+        """Returns whether the open transactions have modified the key, so the time to live
+        of the committed key does not apply to the value they read
+
+        Running Time: O(1)
+        """
+        return self.is_transaction_active() and self.transaction_handler.is_modified(key)
+
+    def setex(self, key, seconds, new_value):
+        """Assigns a new value for the given key along with a time to live
+
+        Since time to live applies to the committed data, it is not allowed within a transaction.
+
+        Running Time: O(log n)
+        Being 'n' the number of keys with a time to live
+
+        Returns:
+            a boolean, representing the execution or not of the operation.
+        """
+        if self.is_transaction_active():
+            return False
+        self.database.put(key, new_value)
+        return self.expire(key, seconds)
+
+    def expire_due(self, limit=None):
+        """Removes the committed keys whose time to live is over, see Data.expire_due
+
+        Returns:
+            an integer, the number of keys removed
+        """
+        return self.database.expire_due(limit)
+
+    def memory_stats(self):
+        """Returns a dictionary with the memory usage and eviction statistics of the committed data"""
+        return self.database.memory_stats()
 
-    def begin(self):
+    def begin(self, name=None):
         """Opens a transaction
 
         This method opens a new transaction block. Each of this transactions can be 'nested',
@@ -191,8 +742,11 @@ class Database(object):
         Running Time: O(1)
         This operation is transfered to the transaction handler which opens a new 
         transaction in constant time
+
+        Args:
+            name: an string, the name of the savepoint opened by the transaction, or None
         """
-        self.transaction_handler.begin()
+        self.transaction_handler.begin(name)
 
     def rollback(self):
         """Undo all operations from the most recent transaction
@@ -235,6 +789,73 @@ class Database(object):
         else:
             return False
 
+    def savepoint(self, name):
+        """Opens a transaction named as a savepoint, see release and rollback_to
+
+        Running Time: O(1)
+
+        Args:
+            name: an string, the name of the savepoint. It may repeat the name of an open
+                  savepoint, which is hidden until the new one is closed
+        """
+        self.begin(name)
+
+    def release(self, name=None):
+        """Closes the most recent transaction, or up to the given savepoint, keeping the changes
+
+        Unlike COMMIT, the changes of each transaction closed are merged into its parent,
+        which is still open, instead of being applied into the database. Releasing the
+        outermost transaction has no parent to merge into, so it commits the changes.
+
+        Running Time: O(m)
+        Being 'm' a variable that represents the number of keys modified in the
+        transactions closed
+
+        Args:
+            name: an string, the name of the savepoint to release along with every transaction
+                  opened after it, or None to release only the most recent transaction
+
+        Returns:
+            a boolean, representing the execution or not of the operation. It is not executed
+            if there is no transaction or no savepoint with the given name
+        """
+        if not self.is_transaction_active():
+            return False
+        levels = 1
+        if name is not None:
+            levels = self.transaction_handler.find_savepoint(name)
+            if not levels:
+                return False
+        for _ in range(levels):
+            if self.transaction_handler.is_one_active():
+                return self.commit()
+            self.transaction_handler.release()
+        return True
+
+    def rollback_to(self, name):
+        """Undo all operations since the given savepoint was opened, which stays open
+
+        Running Time: O(m)
+        Being 'm' a variable that represents the number of keys modified in the
+        transactions rolled back
+
+        Args:
+            name: an string, the name of the savepoint
+
+        Returns:
+            a boolean, representing the execution or not of the operation. It is not executed
+            if there is no transaction or no savepoint with the given name
+        """
+        if not self.is_transaction_active():
+            return False
+        levels = self.transaction_handler.find_savepoint(name)
+        if not levels:
+            return False
+        for _ in range(levels):
+            self.rollback()
+        self.begin(name)
+        return True
+
     def is_transaction_active(self):
         """Returns the existance of a transaction
 
@@ -244,6 +865,113 @@ class Database(object):
         """
         return self.transaction_handler.is_active()
 
+    def session(self):
+        """Creates a new session over the committed data of this database
+
+        Returns:
+            an object of type Session
+
+        Raises:
+            ValueError: if the database uses the undo engine, whose uncommitted changes 
+                        would be visible to other sessions
+        """
+        if self.transaction_handler.in_place:
+            raise ValueError('sessions are not supported by the undo engine')
+        return Session(self)
+
+
+
+class Session(Database):
+    """Transaction context of a single client over the committed data of a shared database
+
+    A session supports exactly the same operations as a Database, but its transactions 
+    are its own: the changes made within them are only visible to this session until they
+    are committed, and BEGIN, ROLLBACK and COMMIT never affect other sessions.
+    Data committed by any session (or directly into the database) is visible to all of them.
+
+    The transaction handler is only created when a transaction is opened and it is dropped
+    once all transactions are closed. Therefore a session without open transactions holds
+    no data at all and its operations go straight to the committed data.
+
+    Concurrent changes are resolved as 'last commit wins': a commit applies the latest
+    value of each key modified by the session, computing the frequencies of the values
+    against the committed data at that time. Until then, the frequencies read by the
+    session follow the keys it modified that other sessions commit, see
+    TransactionHandler.rebase.
+
+    Args:
+        database: an object of type Database whose committed data is shared
+
+    Attributes:
+        database: an object of type Data, the committed data shared with the database
+
+        transaction_handler: an object of type TransactionHandler, or None if there is no
+                             open transaction
+    """
+    __slots__ = ()
+
+    def __init__(self, database):
+        self.database = database.database
+        self.transaction_handler = None
+        self.new_handler = database.new_handler
+
+    def begin(self, name=None):
+        """Opens a transaction, creating the transaction handler if required
+
+        Running Time: O(1)
+        """
+        if self.transaction_handler is None:
+            self.transaction_handler = self.new_handler(self.database)
+        self.transaction_handler.begin(name)
+
+    def rollback(self):
+        """Undo all operations from the most recent transaction of this session
+
+        Running Time: O(1 + m)
+        Being 'm' a variable that represents the number of keys modified in the latest
+        transaction
+
+        Returns:
+            a boolean, representing the execution or not of the operation.
+        """
+        done = Database.rollback(self)
+        self.release_handler()
+        return done
+
+    def commit(self):
+        """Applies all the changes made by the transactions of this session
+
+        Running Time: O(m)
+        Being 'm' a varable that represents the number of keys modified globally by all
+        transactions of this session
+
+        Returns:
+            a boolean, representing the execution or not of the operation.
+        """
+        done = Database.commit(self)
+        self.release_handler()
+        return done
+
+    def is_transaction_active(self):
+        """Returns the existance of a transaction in this session"""
+        return self.transaction_handler is not None and self.transaction_handler.is_active()
+
+    def release_handler(self):
+        """Drops the transaction handler once there are no open transactions"""
+        if not self.is_transaction_active():
+            self.transaction_handler = None
+
+    def close(self):
+        """Rolls back all the open transactions of this session, such as when its client is gone
+
+        The handler stops pinning the keys it modified and releases its read view.
+
+        Running Time: O(1)
+        """
+        if self.transaction_handler is not None:
+            self.transaction_handler.clear()
+            self.transaction_handler = None
+
 
 
 
@@ -289,12 +1017,33 @@ class TransactionHandler(object):
                                 set: ['a', 'z']
                              ]
 
+        view: the read view of the committed data used while transactions are opened,
+              an object with the methods get(key) and num_equal_to(value). It is the
+              database itself, or a Snapshot of it if the database is a VersionedData
+
+        savepoints: a list with the name of each open transaction, in the same order as
+                    transactions_opened, being None for the ones opened by BEGIN
+
+        stale: a list of tuples (old_value, new_value), the committed values of the keys
+               modified by the transactions that other writers changed since the frequencies
+               were computed, see rebase
+
+        committing: a boolean, True while the changes are being applied by commit
+
     """
+    __slots__ = ('database', 'view', 'transactions', 'transactions_opened', 'savepoints', 'stale', 'committing')
+
+    in_place = False
+
     def __init__(self, database):
         self.database = database
+        self.view = database
 
         self.transactions = Data()
         self.transactions_opened = []
+        self.savepoints = []
+        self.stale = []
+        self.committing = False
 
     def get(self, key):
         """Fetches the latest value of a key from the transaction data
@@ -387,6 +1136,52 @@ class TransactionHandler(object):
 
             Data.decrease_freq(self.transactions.values_freq, old_value)
 
+    def apply(self, changes):
+        """Assigns new values for several keys at once within the transaction data
+
+        Records each change in the most recent transaction like set and unset do, but the
+        frequencies of the values are aggregated for the whole batch and updated once per
+        distinct value.
+
+        Running Time: O(k)
+        Being 'k' the number of keys to modify
+
+        Args:
+            changes: a dictionary mapping each key to modify to its new value, being None the
+                     value of the keys to remove
+        """
+        if self.is_active():
+            latest_transaction = self.transactions_opened[-1]
+            transaction_data = self.transactions.data
+            view_get = self.previous_value_reader()
+            freq_changes = Counter()
+
+            for key, new_value in changes.items():
+                key_list = transaction_data.get(key)
+                if key_list:
+                    old_value = key_list[-1]
+                else:
+                    old_value = view_get(key)
+                if old_value == new_value:
+                    continue
+
+                if key_list is None:
+                    key_list = transaction_data[key] = []
+                if key in latest_transaction:
+                    key_list[-1] = new_value
+                else:
+                    key_list.append(new_value)
+                    latest_transaction.add(key)
+
+                freq_changes[old_value] -= 1
+                freq_changes[new_value] += 1
+
+            Data.merge_freq(self.transactions.values_freq, freq_changes)
+
+    def previous_value_reader(self):
+        """Returns the function reading the value of the keys not found in the transaction data"""
+        return self.view.get
+
     def num_equal_to(self, value):
         """Retrieves the number of keys (variables) currently set to 'value'
 
@@ -405,18 +1200,68 @@ class TransactionHandler(object):
         Returns:
             an integer, representing the total frequency of this value
         """
-        return self.transactions.values_freq.get(value, 0)
+        return self.freq_deltas().get(value, 0)
 
-    def begin(self):
+    def freq_deltas(self):
+        """Returns the dictionary with the difference of the frequency of each value against the
+        read view, once the stale committed values are rebased, see rebase
+
+        Running Time: O(1)
+        Plus O(s), being 's' the number of stale values since the previous call
+        """
+        values_freq = self.transactions.values_freq
+        stale = self.stale
+        while stale:
+            old_value, new_value = stale.pop()
+            Data.increase_freq(values_freq, old_value)
+            Data.decrease_freq(values_freq, new_value)
+        return values_freq
+
+    def rebase(self, changes):
+        """Records the keys modified by the transactions whose committed value was changed by
+        another writer, such as another Session, while the read view is the committed data
+
+        The frequencies of the transactions are the difference between their latest values
+        and the committed ones they were computed against. When another writer commits one of
+        these keys, the difference must be moved from the previous committed value to the new
+        one. It is only recorded here, since this may run in the thread of the other writer,
+        and applied by freq_deltas before the frequencies are read.
+        The changes made by commit itself are not recorded.
+
+        Running Time: O(k)
+        Being 'k' the number of changes
+
+        Args:
+            changes: a list of tuples (key, old_value, new_value) committed
+        """
+        if self.committing:
+            return
+        is_modified = self.is_modified
+        stale = [(old_value, new_value) for key, old_value, new_value in changes if is_modified(key)]
+        if stale:
+            self.stale.extend(stale)
+
+    def begin(self, name=None):
         """Opens a transaction
 
         This method opens a new transaction block. Each of this transactions can be 'nested',
         in other words, there can be transactions opened one after another, 
         having more relevance the transactions lastly created.
 
+        The first transaction acquires the read view of the committed data used by all
+        of them, see Data.read_view, and registers the handler so the keys it modifies
+        do not expire while it is open, see Data.handlers
+
         Running Time: O(1)
+
+        Args:
+            name: an string, the name of the savepoint opened by the transaction, or None
         """
+        if not self.transactions_opened:
+            self.view = self.database.read_view()
+            self.database.handlers.add(self)
         self.transactions_opened.append(set([]))
+        self.savepoints.append(name)
 
     def rollback(self):
         """Undo all operations from the most recent transaction
@@ -433,13 +1278,14 @@ class TransactionHandler(object):
                 self.clear()                
             else:
                 latest_transaction = self.transactions_opened.pop()             
+                self.savepoints.pop()
                 for modified_key in latest_transaction:
                     key_list = self.transactions.data[modified_key]
 
                     modified_value = key_list.pop()
                     previous_value, found = self.get(modified_key)
                     if not found: 
-                        previous_value = self.database.data.get(modified_key, None)
+                        previous_value = self.view.get(modified_key)
 
                     Data.increase_freq(self.transactions.values_freq, previous_value)
                     Data.decrease_freq(self.transactions.values_freq, modified_value)
@@ -452,7 +1298,9 @@ class TransactionHandler(object):
 
         It applies all the changes from the most recent transaction to the oldest, having more
         relevance changes from recent transactions than olders.
-        All these changes are set into the database modifying its values and frequencies.
+        All these changes are flattened into a single write set with the latest value of 
+        each key, which is applied at once into the database modifying its values and 
+        frequencies.
         Lastly, it clears the transaction handler data
 
         Running Time: O(m)
@@ -460,22 +1308,53 @@ class TransactionHandler(object):
         transactions
         """
         if self.is_active():
+            changes = {}
             for key, key_list in self.transactions.data.items():
-                value = key_list.pop()              
-                if value:
-                    self.database.data[key] = value
-                else:
-                    self.database.data.pop(key, None)
+                changes[key] = key_list[-1]
 
-            for value, freq in self.transactions.values_freq.items():
-                Data.modify_freq(self.database.values_freq, value, freq)
-            
+            self.committing = True
+            try:
+                self.database.apply(changes)
+            finally:
+                self.committing = False
             self.clear()
 
+    def release(self):
+        """Merges the most recent transaction into its parent, keeping its changes uncommitted
+
+        Each key modified by the most recent transaction either was modified by the parent
+        as well, so the value of the parent is replaced by the latest one and the entry of
+        the most recent transaction is dropped from the value list, or it is recorded as
+        modified by the parent. The frequencies do not change, since the latest value of
+        every key is the same.
+        The outermost transaction has no parent, it must be committed instead.
+
+        Running Time: O(m)
+        Being 'm' a variable that represents the number of keys modified in the latest
+        transaction
+        """
+        if self.get_active_size() > 1:
+            latest_transaction = self.transactions_opened.pop()
+            self.savepoints.pop()
+            parent_transaction = self.transactions_opened[-1]
+            transaction_data = self.transactions.data
+            for modified_key in latest_transaction:
+                if modified_key in parent_transaction:
+                    key_list = transaction_data[modified_key]
+                    key_list[-1] = key_list.pop()
+                else:
+                    parent_transaction.add(modified_key)
+
     def clear(self):
-        """Clears all transaction data, value frequencies and open transactions"""
+        """Clears all transaction data, value frequencies and open transactions, releasing the read view"""
+        self.database.handlers.discard(self)
         self.transactions = Data()
         self.transactions_opened = []
+        self.savepoints = []
+        self.stale = []
+        if self.view is not self.database:
+            self.view.close()
+            self.view = self.database
 
     def is_active(self):
         """Returns the existance of an opened transaction"""
@@ -489,41 +1368,1746 @@ class TransactionHandler(object):
         """Returns the number of opened transactions"""
         return (len(self.transactions_opened))
 
+    def get_write_set_size(self):
+        """Returns the number of keys modified by the open transactions
 
+        Running Time: O(1)
+        """
+        return len(self.transactions.data)
 
-class Data(object):
-    def __init__(self):
-        self.data = {}
-        self.values_freq = {}
-
-    @staticmethod
-    def increase_freq(values_freq, key_of_value):
-        """Increases the frequency a value is present in the data
+    def find_savepoint(self, name):
+        """Returns the number of transactions opened since the most recent savepoint with the
+        given name, including it, or 0 if there is no such savepoint
 
-        Running Time: O(1)
+        Running Time: O(t)
+        Being 't' the number of open transactions
         """
-        Data.modify_freq(values_freq, key_of_value, 1)
+        for index in range(len(self.savepoints) - 1, -1, -1):
+            if self.savepoints[index] == name:
+                return len(self.savepoints) - index
+        return 0
+
+    def is_modified(self, key):
+        """Returns whether the open transactions have modified the key"""
+        return key in self.transactions.data
+
+
+
+class SpillingTransactionHandler(TransactionHandler):
+    """Transaction handler that moves the changes of large transactions to disk
+
+    Once the outermost transaction holds more than spill_threshold modified keys in memory,
+    their values are written into a SortedRun and dropped from the transaction data, along
+    with their value lists and the set of keys of the outermost transaction. The changes of
+    nested transactions always stay in memory, since rolling them back needs the value
+    list of each key, and they are spilled once released into the outermost transaction.
+
+    The runs are older than any value of the transaction data, so the latest value of a key
+    is the one of the transaction data, or the one of the most recent run holding it. The
+    frequencies of the values are kept in memory as usual, they only take one entry per 
+    distinct value.
+
+    COMMIT streams the runs into the committed data in batches of SPILL_BATCH_SIZE keys, 
+    so the committed data is not modified atomically: listeners (such as a command log) are 
+    notified once per batch. Therefore it is only supported by single-threaded databases.
+
+    Args:
+        database: an object of type Data, the committed data
+        spill_threshold: an integer, the number of keys modified by the outermost transaction
+                         kept in memory before they are spilled
+        spill_directory: an string, the directory of the runs, or None for the default one
+
+    Attributes:
+        runs: a list of objects of type SortedRun with the values spilled, from the oldest
+              to the most recent. Once there are more than SPILL_MAX_RUNS they are merged
+              into a single one, so reading a key costs at most SPILL_MAX_RUNS searches
+
+        spilled: an object of type BloomFilter with the keys of the runs, so reading most
+                 of the keys that were not spilled does not search the runs. It is rebuilt
+                 twice as large once the runs hold more keys than its capacity
+                 
+        spilled_capacity: an integer, the capacity of the filter
+    """
+    __slots__ = ('spill_threshold', 'spill_directory', 'runs', 'spilled', 'spilled_capacity')
+
+    def __init__(self, database, spill_threshold, spill_directory=None):
+        TransactionHandler.__init__(self, database)
+        self.spill_threshold = spill_threshold
+        self.spill_directory = spill_directory
+        self.runs = []
+        self.spilled = None
+        self.spilled_capacity = 0
+
+    def get(self, key):
+        """Fetches the latest value of a key from the transaction data, or else from the runs
+
+        Running Time: O(1), or O(r log n) if the key is not in memory
+        Being 'r' the number of runs and 'n' the number of keys spilled
+        """
+        key_list = self.transactions.data.get(key)
+        if key_list:
+            return (key_list[-1], True)
+        if self.runs and key in self.spilled:
+            for run in reversed(self.runs):
+                value, found = run.get(key)
+                if found:
+                    return (value, True)
+        return (None, False)
+
+    def set(self, key, old_value, new_value):
+        """Assigns a new value for the given key, see TransactionHandler.set"""
+        TransactionHandler.set(self, key, old_value, new_value)
+        if self.transactions_opened and len(self.transactions_opened[0]) > self.spill_threshold:
+            self.spill()
+
+    def unset(self, key, old_value):
+        """Records the removal of the key, see TransactionHandler.unset"""
+        TransactionHandler.unset(self, key, old_value)
+        if self.transactions_opened and len(self.transactions_opened[0]) > self.spill_threshold:
+            self.spill()
+
+    def apply(self, changes):
+        """Assigns new values for several keys at once, see TransactionHandler.apply"""
+        TransactionHandler.apply(self, changes)
+        if self.transactions_opened and len(self.transactions_opened[0]) > self.spill_threshold:
+            self.spill()
+
+    def previous_value_reader(self):
+        """Returns the function reading the value of the keys not found in the transaction data,
+        from the runs or else from the read view"""
+        view_get = self.view.get
+        if not self.runs:
+            return view_get
+        runs = self.runs[::-1]
+        spilled = self.spilled
+
+        def read(key):
+            if key in spilled:
+                for run in runs:
+                    value, found = run.get(key)
+                    if found:
+                        return value
+            return view_get(key)
+        return read
+
+    def release(self):
+        """Merges the most recent transaction into its parent, see TransactionHandler.release"""
+        TransactionHandler.release(self)
+        if self.transactions_opened and len(self.transactions_opened[0]) > self.spill_threshold:
+            self.spill()
+
+    def spill(self):
+        """Moves the values of the keys modified by the outermost transaction into a new run
+
+        The value of the outermost transaction is the first one of the value list of each of
+        its keys. The keys whose value list becomes empty are removed from the transaction data.
+
+        Running Time: O(m log m)
+        Being 'm' the number of keys of the outermost transaction kept in memory
+        """
+        outermost_transaction = self.transactions_opened[0]
+        transaction_data = self.transactions.data
+        items = sorted([(key, transaction_data[key][0]) for key in outermost_transaction])
+        self.runs.append(SortedRun(items, self.spill_directory))
+        del items
+
+        spilled_count = sum([len(run) for run in self.runs])
+        if spilled_count > self.spilled_capacity:
+            self.spilled_capacity = 2 * spilled_count
+            self.spilled = BloomFilter(self.spilled_capacity)
+            for run in self.runs[:-1]:
+                for key in run.keys():
+                    self.spilled.add(key)
+        for key in outermost_transaction:
+            self.spilled.add(key)
+
+        for key in outermost_transaction:
+            key_list = transaction_data[key]
+            if len(key_list) == 1:
+                del transaction_data[key]
+            else:
+                del key_list[0]
+        self.transactions_opened[0] = set([])
+
+        if len(self.runs) > SPILL_MAX_RUNS:
+            merged = SortedRun(merge_runs(self.runs), self.spill_directory)
+            for run in self.runs:
+                run.close()
+            self.runs = [merged]
+
+    def commit(self):
+        """Applies all the changes made by the transactions, streaming the runs first
+
+        Running Time: O(m + n log r)
+        Being 'm' the number of keys modified in memory, 'n' the number of keys spilled and
+        'r' the number of runs
+        """
+        if self.is_active() and self.runs:
+            transaction_data = self.transactions.data
+            batch = {}
+            self.committing = True
+            try:
+                for key, value in merge_runs(self.runs):
+                    if key not in transaction_data:
+                        batch[key] = value
+                        if len(batch) == SPILL_BATCH_SIZE:
+                            self.database.apply(batch)
+                            batch = {}
+                if batch:
+                    self.database.apply(batch)
+            finally:
+                self.committing = False
+        TransactionHandler.commit(self)
+
+    def clear(self):
+        """Clears all transaction data and removes the runs, see TransactionHandler.clear"""
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.spilled = None
+        self.spilled_capacity = 0
+        TransactionHandler.clear(self)
+
+    def is_modified(self, key):
+        """Returns whether the open transactions have modified the key, in memory or in the runs"""
+        return self.get(key)[1]
+
+    def get_write_set_size(self):
+        """Returns the number of keys modified by the open transactions, counting a key once
+        for each run holding it besides the transaction data
+
+        Running Time: O(r)
+        Being 'r' the number of runs
+        """
+        return len(self.transactions.data) + sum([len(run) for run in self.runs])
+
+
+
+class UndoTransactionHandler(object):
+    """Handler that manages all transaction operations writing in place (undo log engine)
+
+    Alternative to TransactionHandler for workloads that commit far more often than they
+    roll back. Every change is written directly into the committed data, and the previous
+    value of the key is recorded in the undo log of the most recent transaction the first
+    time the key is modified in it. Therefore COMMIT only drops the undo logs, and ROLLBACK
+    restores the previous values recorded in the undo log of the transaction closed.
+
+    It supports the same methods as TransactionHandler, so a Database uses either of them
+    the same way. Since the committed data holds uncommitted changes while a transaction is
+    opened, it requires that nobody else reads the data meanwhile: it is not supported by
+    sessions, mvcc, thread-safe or memory-bounded databases, nor secondary indexes, and
+    snapshots are not taken within a transaction (see Data.is_dirty).
+    Listeners are only notified by COMMIT, with the net changes of all the transactions.
+
+    Attributes:
+        database: an object of type Data, the committed data modified in place
+
+        view: the read view of the committed data, always the data itself
+
+        transactions: an object of type Data that is always empty, since the changes are
+                      already in the committed data
+
+        undo_logs: a list (or stack) of undo logs, one for each open transaction. Each undo log
+                   is a dictionary mapping each key modified by the transaction to its value
+                   before the transaction, being None if it was not set
+
+                   Example:
+                   [
+                        {'a': '1', 'z': None}
+                   ]
+
+        savepoints: a list with the name of each open transaction, in the same order as
+                    undo_logs, being None for the ones opened by BEGIN
+    """
+    __slots__ = ('database', 'view', 'transactions', 'undo_logs', 'savepoints')
+
+    in_place = True
+
+    def __init__(self, database):
+        self.database = database
+        self.view = database
+        self.transactions = Data()
+        self.undo_logs = []
+        self.savepoints = []
+
+    def get(self, key):
+        """The latest value of every key is in the committed data, so it is never found here
+
+        Running Time: O(1)
+        """
+        return (None, False)
+
+    def write(self, key, old_value, new_value):
+        """Writes a new value in place, recording the previous one in the most recent undo log
+
+        Running Time: O(1)
+        """
+        undo_log = self.undo_logs[-1]
+        if key not in undo_log:
+            undo_log[key] = old_value
+
+        database = self.database
+        if new_value is None:
+            del database.data[key]
+        else:
+            if database.intern_values:
+                new_value = sys.intern(new_value)
+            database.data[key] = new_value
+        Data.decrease_freq(database.values_freq, old_value)
+        Data.increase_freq(database.values_freq, new_value)
+
+    def set(self, key, old_value, new_value):
+        """Assigns a new value for the given key in place, see write
+
+        Running Time: O(1)
+        """
+        if self.is_active():
+            self.write(key, old_value, new_value)
+
+    def unset(self, key, old_value):
+        """Removes the key in place, see write
+
+        Running Time: O(1)
+        """
+        if self.is_active() and old_value is not None:
+            self.write(key, old_value, None)
+
+    def apply(self, changes):
+        """Assigns new values for several keys at once in place, see write
+
+        Running Time: O(k)
+        Being 'k' the number of keys to modify
+        """
+        if self.is_active():
+            data_get = self.database.data.get
+            for key, new_value in changes.items():
+                old_value = data_get(key)
+                if old_value != new_value:
+                    self.write(key, old_value, new_value)
+
+    def num_equal_to(self, value):
+        """The frequencies are updated in place as well, so there is no difference to add"""
+        return 0
+
+    def freq_deltas(self):
+        """Returns an empty dictionary, there is no difference of frequencies, see num_equal_to"""
+        return self.transactions.values_freq
+
+    def begin(self, name=None):
+        """Opens a transaction with an empty undo log
+
+        Running Time: O(1)
+
+        Args:
+            name: an string, the name of the savepoint opened by the transaction, or None
+        """
+        if not self.undo_logs:
+            self.database.handlers.add(self)
+        self.undo_logs.append({})
+        self.savepoints.append(name)
+
+    def rollback(self):
+        """Undo all operations from the most recent transaction, restoring its undo log
+
+        Running Time: O(m)
+        Being 'm' a variable that represents the number of keys modified in the latest
+        transaction
+        """
+        if self.is_active():
+            undo_log = self.undo_logs.pop()
+            self.savepoints.pop()
+            database = self.database
+            data = database.data
+            values_freq = database.values_freq
+            for key, previous_value in undo_log.items():
+                modified_value = data.get(key)
+                if previous_value is None:
+                    data.pop(key, None)
+                else:
+                    data[key] = previous_value
+                Data.decrease_freq(values_freq, modified_value)
+                Data.increase_freq(values_freq, previous_value)
+            if not self.undo_logs:
+                self.clear()
+
+    def commit(self):
+        """Keeps all the changes made by the transactions, dropping the undo logs
+
+        Running Time: O(1)
+        If the data has listeners or keys with a time to live, the net changes of all the
+        transactions are computed from the undo logs, in O(m) being 'm' the number of keys
+        modified, to notify the listeners and to remove the time to live of the keys modified
+        """
+        if self.is_active():
+            database = self.database
+            if database.listeners or database.expires:
+                originals = {}
+                for undo_log in reversed(self.undo_logs):
+                    originals.update(undo_log)
+                data_get = database.data.get
+                changes = []
+                for key, old_value in originals.items():
+                    new_value = data_get(key)
+                    if old_value != new_value:
+                        changes.append((key, old_value, new_value))
+                if database.expires:
+                    database.forget_expires(originals)
+                if changes and database.listeners:
+                    database.notify(changes)
+            self.clear()
+
+    def release(self):
+        """Merges the undo log of the most recent transaction into the one of its parent
+
+        The value recorded by the parent is older, so it is kept for the keys modified by
+        both of them. The smaller undo log is merged into the larger one.
+
+        Running Time: O(min(m, p))
+        Being 'm' and 'p' the number of keys modified in the latest transaction and in its
+        parent respectively
+        """
+        if self.get_active_size() > 1:
+            undo_log = self.undo_logs.pop()
+            self.savepoints.pop()
+            parent_log = self.undo_logs[-1]
+            if len(undo_log) > len(parent_log):
+                undo_log.update(parent_log)
+                self.undo_logs[-1] = undo_log
+            else:
+                for key, previous_value in undo_log.items():
+                    if key not in parent_log:
+                        parent_log[key] = previous_value
+
+    def clear(self):
+        """Drops the undo logs"""
+        self.database.handlers.discard(self)
+        self.undo_logs = []
+        self.savepoints = []
+
+    def is_active(self):
+        """Returns the existance of an opened transaction"""
+        return len(self.undo_logs) > 0
+
+    def is_one_active(self):
+        """Returns the existance of a single opened transaction"""
+        return len(self.undo_logs) == 1
+
+    def get_active_size(self):
+        """Returns the number of opened transactions"""
+        return len(self.undo_logs)
+
+    def get_write_set_size(self):
+        """Returns the number of keys modified by the open transactions, counting a key once
+        for each transaction that modified it
+
+        Running Time: O(t)
+        Being 't' the number of open transactions
+        """
+        return sum([len(undo_log) for undo_log in self.undo_logs])
+
+    find_savepoint = TransactionHandler.find_savepoint
+
+    def is_modified(self, key):
+        """Returns whether the open transactions have modified the key
+
+        Running Time: O(t)
+        Being 't' the number of open transactions
+        """
+        for undo_log in self.undo_logs:
+            if key in undo_log:
+                return True
+        return False
+
+
+
+class Data(object):
+    """Key-value storage along with the frequency of each value
+
+    Attributes:
+        data: a dictionary mapping each key to its value
+
+        values_freq: a dictionary mapping each value to the number of keys set to it
+
+        listeners: a list of objects notified of every change made through put and apply,
+                   such as a command log. Each listener implements a method 
+                   on_commit(changes), receiving a list of tuples (key, old_value, new_value)
+                   that were applied together. Changes that do not modify a key are not
+                   notified. A listener may also implement on_load(data), called once all
+                   the content is replaced by load
+
+        indexes: a dictionary mapping the name of each secondary index to the index, which
+                 is also a listener, see add_index
+
+        expires: a dictionary mapping each key with a time to live to its deadline, measured
+                 by clock. Any change made to a key through put or apply removes its deadline
+
+        expires_heap: a list of tuples (deadline, key) arranged as a min-heap, used to find
+                      the keys whose deadline is over without scanning all of them.
+                      Entries are not removed when a deadline changes, an entry is only 
+                      valid if it matches the current deadline of its key
+
+        handlers: a set with the transaction handlers that have open transactions over this
+                  data. A key modified by any of them is pinned: it does not expire until
+                  the transaction is closed, since its changes were computed against it.
+                  The ones reading this data directly are told about the keys committed
+                  by other writers, see stale_readers
+
+        clock: a callable returning the current time in seconds
+
+        intern_values: a boolean, if True every value stored is replaced by its interned
+                       string (sys.intern), so all the keys set to the same value, and the
+                       values frequency, share a single string instead of a copy each.
+                       Keys are not interned: each key is already stored once, and the
+                       interpreter table of interned strings would cost more than it saves
+    """
+    __slots__ = ('data', 'values_freq', 'listeners', 'indexes', 'expires', 'expires_heap', 'expiry_lock',
+                 'handlers', 'clock', 'intern_values')
+
+    def __init__(self):
+        self.data = {}
+        self.values_freq = {}
+        self.listeners = []
+        self.indexes = {}
+        self.expires = {}
+        self.expires_heap = []
+        self.expiry_lock = threading.Lock()
+        self.handlers = set()
+        self.clock = time.monotonic
+        self.intern_values = False
+
+    def get(self, key):
+        """Fetches the value of a key, or None if it is not set
+
+        A key whose time to live is over is removed before reading it (lazy expiry)
+
+        Running Time: O(1)
+        """
+        if self.expires and key in self.expires:
+            self.expire(key)
+        return self.data.get(key, None)
+
+    def num_equal_to(self, value):
+        """Retrieves the number of keys currently set to 'value'
+
+        The keys whose time to live is over are removed first, see expire_due
+
+        Running Time: O(1)
+        Plus the running time of expire_due, if any key has a time to live
+        """
+        if self.expires:
+            self.expire_due()
+        return self.values_freq.get(value, 0)
+
+    def read_view(self):
+        """Returns an object to read the data from, see VersionedData.read_view
+
+        Plain data is always read directly, therefore it returns the data itself
+        """
+        return self
+
+    def load(self, data, values_freq):
+        """Replaces all the content, for instance with the one read from a snapshot
+
+        Listeners are not notified, and every time to live is dropped.
+
+        Args:
+            data: a dictionary mapping each key to its value
+            values_freq: a dictionary mapping each value to the number of keys set to it
+        """
+        if self.intern_values:
+            Data.intern_data(data)
+            values_freq = dict((sys.intern(value), freq) for value, freq in values_freq.items())
+        self.data = data
+        self.values_freq = values_freq
+        with self.expiry_lock:
+            self.expires = {}
+            self.expires_heap = []
+        self.notify_load()
+
+    def notify_load(self):
+        """Notifies the listeners implementing on_load(data) that all the content was replaced"""
+        for listener in self.listeners:
+            on_load = getattr(listener, 'on_load', None)
+            if on_load is not None:
+                on_load(self)
+
+    def add_index(self, name, index):
+        """Adds a secondary index, built from the current content and kept updated as a listener
+
+        Args:
+            name: an string, the name to look the index up in indexes
+            index: an object implementing on_commit(changes) and on_load(data)
+        """
+        index.on_load(self)
+        self.indexes[name] = index
+        self.listeners.append(index)
+
+    def set_expire(self, key, deadline):
+        """Sets the deadline of a key, after which it expires
+
+        Running Time: O(log n)
+        Being 'n' the number of keys with a time to live. Once the heap holds more than
+        twice as many entries as deadlines, it is rebuilt in O(n) without the outdated ones,
+        which is amortized by the entries pushed since the last time
+
+        Args:
+            key: an string representing the key
+            deadline: a number, the time measured by clock at which the key expires
+
+        Returns:
+            a boolean, representing whether the key is set
+        """
+        if key not in self.data:
+            return False
+        with self.expiry_lock:
+            expires = self.expires
+            expires[key] = deadline
+            heap = self.expires_heap
+            heapq.heappush(heap, (deadline, key))
+            if len(heap) > 2 * len(expires) + 64:
+                heap = [(key_deadline, expiring_key) for expiring_key, key_deadline in expires.items()]
+                heapq.heapify(heap)
+                self.expires_heap = heap
+        return True
+
+    def persist(self, key):
+        """Removes the deadline of a key
+
+        Running Time: O(1)
+
+        Returns:
+            a boolean, representing whether the key had a deadline
+        """
+        return self.expires.pop(key, None) is not None
+
+    def is_pinned(self, key):
+        """Returns whether an open transaction has modified the key, see handlers
+
+        Running Time: O(h)
+        Being 'h' the number of handlers with open transactions
+        """
+        for handler in list(self.handlers):
+            if handler.is_modified(key):
+                return True
+        return False
+
+    def is_dirty(self):
+        """Returns whether the data holds uncommitted changes, see UndoTransactionHandler"""
+        for handler in list(self.handlers):
+            if handler.in_place:
+                return True
+        return False
+
+    def expire(self, key):
+        """Removes a key if its deadline is over and it is not pinned
+
+        The key is removed through put, so the frequency of its value is updated and
+        listeners are notified like for any other removal.
+
+        Running Time: O(1)
+
+        Returns:
+            a boolean, representing whether the key was removed
+        """
+        deadline = self.expires.get(key)
+        if deadline is None or deadline > self.clock() or self.is_pinned(key):
+            return False
+        return self.remove_expired(key, deadline)
+
+    def remove_expired(self, key, deadline):
+        """Removes a key through put if its deadline is still the given one
+
+        Running Time: O(1)
+
+        Returns:
+            a boolean, representing whether the key was removed
+        """
+        if self.expires.get(key) != deadline:
+            return False
+        self.put(key, None)
+        return True
+
+    def expire_due(self, limit=None):
+        """Removes the keys whose deadline is over, except the pinned ones (active expiry)
+
+        The heap is popped only while its earliest deadline is over, so keys that have
+        not expired are never visited. Pinned keys are pushed back and retried later.
+
+        Running Time: O(1 + k log n)
+        Being 'k' the number of keys removed and 'n' the number of keys with a time to live
+
+        Args:
+            limit: an integer, the maximum number of keys to remove, or None to remove all of
+                   them. A limit allows sweeping the expired keys incrementally
+
+        Returns:
+            an integer, the number of keys removed
+        """
+        expires = self.expires
+        now = self.clock()
+        due = []
+        with self.expiry_lock:
+            heap = self.expires_heap
+            while heap and heap[0][0] <= now and (limit is None or len(due) < limit):
+                entry = heapq.heappop(heap)
+                if expires.get(entry[1]) == entry[0]:
+                    due.append(entry)
+
+        removed = 0
+        pinned = []
+        for deadline, key in due:
+            if self.is_pinned(key):
+                pinned.append((deadline, key))
+            elif self.remove_expired(key, deadline):
+                removed += 1
+        if pinned:
+            with self.expiry_lock:
+                for entry in pinned:
+                    heapq.heappush(self.expires_heap, entry)
+        return removed
+
+    def put(self, key, new_value):
+        """Assigns a new value for the given key, removing it if the new value is None
+
+        Running Time: O(1)
+        Plus the running time of the listeners, if any
+
+        Args:
+            key: an string representing the key to modify
+            new_value: an string representing the new value for the given key, or None
+        """
+        if self.expires:
+            self.expires.pop(key, None)
+        if self.intern_values and new_value is not None:
+            new_value = sys.intern(new_value)
+        data = self.data
+        old_value = data.get(key, None)
+        if old_value == new_value:
+            return
+
+        if new_value is None:
+            del data[key]
+        else:
+            data[key] = new_value
+        Data.decrease_freq(self.values_freq, old_value)
+        Data.increase_freq(self.values_freq, new_value)
+
+        if self.listeners:
+            self.notify([(key, old_value, new_value)])
+        if self.handlers:
+            for handler in self.stale_readers():
+                handler.rebase([(key, old_value, new_value)])
+
+    def stale_readers(self):
+        """Returns a list with the transaction handlers whose read view is this data, except
+        the one committing, see TransactionHandler.rebase
+
+        Running Time: O(h)
+        Being 'h' the number of handlers with open transactions
+        """
+        return [handler for handler in list(self.handlers)
+                if handler.view is self and not handler.in_place and not handler.committing]
+
+    def memory_stats(self):
+        """Returns a dictionary with the memory usage, see BoundedData.memory_stats"""
+        return {'keys': len(self.data)}
+
+    def notify(self, changes):
+        """Notifies all listeners about a list of (key, old_value, new_value) changes applied together"""
+        for listener in self.listeners:
+            listener.on_commit(changes)
+
+    def apply(self, changes):
+        """Assigns new values for several keys at once
+
+        The frequencies of the values are aggregated for the whole batch and updated
+        once per distinct value.
+
+        Running Time: O(k)
+        Being 'k' the number of keys to modify, plus the running time of the listeners, if any
+
+        Args:
+            changes: a dictionary mapping each key to modify to its new value, being None the
+                     value of the keys to remove
+        """
+        if self.intern_values:
+            changes = Data.interned(changes)
+        data = self.data
+        freq_changes = Counter()
+        readers = self.stale_readers() if self.handlers else None
+        applied = [] if self.listeners or readers else None
+        for key, new_value in changes.items():
+            old_value = data.get(key, None)
+            if old_value == new_value:
+                continue
+
+            if new_value is None:
+                del data[key]
+            else:
+                data[key] = new_value
+            freq_changes[old_value] -= 1
+            freq_changes[new_value] += 1
+            if applied is not None:
+                applied.append((key, old_value, new_value))
+
+        Data.merge_freq(self.values_freq, freq_changes)
+        if self.expires:
+            self.forget_expires(changes)
+        if applied:
+            if self.listeners:
+                self.notify(applied)
+            for handler in readers or ():
+                handler.rebase(applied)
+
+    @staticmethod
+    def intern_data(data):
+        """Interns in place the values of a dictionary, see intern_values
+
+        Running Time: O(n)
+        Being 'n' the number of keys
+        """
+        intern = sys.intern
+        for key, value in data.items():
+            data[key] = intern(value)
+
+    @staticmethod
+    def interned(changes):
+        """Returns a copy of a dictionary of changes with their values interned, see intern_values"""
+        intern = sys.intern
+        return dict((key, None if value is None else intern(value)) for key, value in changes.items())
+
+    def forget_expires(self, keys):
+        """Removes the deadline of several keys, once they are modified
+
+        Running Time: O(k)
+        Being 'k' the number of keys
+        """
+        expires = self.expires
+        for key in keys:
+            expires.pop(key, None)
+
+    @staticmethod
+    def merge_freq(values_freq, freq_changes):
+        """Modifies the frequency of several values at once
+
+        Running Time: O(v)
+        Being 'v' the number of values in freq_changes
+
+        Args:
+            values_freq: a dictionary mapping values to their frequencies
+            freq_changes: a dictionary mapping values to the number of times their frequency changes
+        """
+        for key_of_value, num in freq_changes.items():
+            if num:
+                Data.modify_freq(values_freq, key_of_value, num)
+
+    @staticmethod
+    def increase_freq(values_freq, key_of_value):
+        """Increases the frequency a value is present in the data
+
+        Running Time: O(1)
+        """
+        Data.modify_freq(values_freq, key_of_value, 1)
+
+    @staticmethod
+    def decrease_freq(values_freq, key_of_value):
+        """Decreases the frequency a value is present in the data
+
+        Running Time: O(1)
+        """
+        Data.modify_freq(values_freq, key_of_value, -1)
+        
+    @staticmethod
+    def modify_freq(values_freq, key_of_value, num):
+        """Modifies the frequency a value is present in the data by 'num' times
+        If the new value frequence is equal to 0, the record is removed in order to save memory
+
+        Running Time: O(1)
+        """
+        if key_of_value is not None:
+            values_freq[key_of_value] = values_freq.get(key_of_value, 0) + num
+
+            if values_freq[key_of_value] == 0:
+                values_freq.pop(key_of_value, None)
+
+
+
+class VersionedData(Data):
+    """Multi-version key-value storage, readers work against stable snapshots
+
+    Every commit (put or apply) gets a commit sequence number. Before modifying a key or
+    the frequency of a value, the previous version is recorded in the history along with
+    the sequence of the commit that replaces it. The commit is published by increasing
+    the sequence once all its changes are applied.
+
+    A Snapshot reads the current value and then looks up the history: the oldest version
+    replaced by a commit newer than the snapshot is the value it must see. Hence a reader
+    never sees half of a commit, and it never waits for a commit to finish.
+
+    The history is only required by open snapshots, every commit drops the versions that 
+    no open snapshot can read anymore.
+
+    Commits are serialized by a lock, so concurrent writers from several threads are safe.
+
+    Attributes:
+        sequence: an integer, the sequence number of the latest published commit
+
+        history: a dictionary mapping each key to a list of tuples (sequence, previous_value),
+                 sorted by sequence, being 'previous_value' the value of the key before the
+                 commit with that sequence
+
+        freq_history: a dictionary mapping each value to a list of tuples (sequence, previous_freq),
+                      the same as history for the frequencies of the values
+
+        snapshots: a dictionary mapping the sequence of the open snapshots to the number of 
+                   snapshots opened at that sequence
+
+        versions: a deque of tuples (sequence, keys, values) with the keys and values
+                  recorded in the history by each commit, in order, used to drop them
+    """
+    def __init__(self):
+        Data.__init__(self)
+        self.sequence = 0
+        self.history = {}
+        self.freq_history = {}
+        self.snapshots = {}
+        self.versions = deque()
+        self.write_lock = threading.Lock()
+        self.snapshot_lock = threading.Lock()
+
+    def read_view(self):
+        """Opens a snapshot of the latest published commit
+
+        Running Time: O(1)
+
+        Returns:
+            an object of type Snapshot, which must be closed once it is not used anymore
+        """
+        with self.snapshot_lock:
+            sequence = self.sequence
+            self.snapshots[sequence] = self.snapshots.get(sequence, 0) + 1
+        return Snapshot(self, sequence)
+
+    def close_snapshot(self, sequence):
+        """Closes a snapshot opened at the given sequence"""
+        with self.snapshot_lock:
+            count = self.snapshots[sequence] - 1
+            if count:
+                self.snapshots[sequence] = count
+            else:
+                del self.snapshots[sequence]
+
+        # readers never wait for a commit, if one is running it will collect the versions
+        if self.write_lock.acquire(False):
+            try:
+                self.collect()
+            finally:
+                self.write_lock.release()
+
+    def load(self, data, values_freq):
+        """Replaces all the content, dropping the history"""
+        with self.write_lock:
+            Data.load(self, data, values_freq)
+            self.sequence += 1
+            self.history = {}
+            self.freq_history = {}
+            self.versions = deque()
+
+    def put(self, key, new_value):
+        """Assigns a new value for the given key as a new commit, see Data.put
+
+        Running Time: O(1)
+        """
+        if self.intern_values and new_value is not None:
+            new_value = sys.intern(new_value)
+        with self.write_lock:
+            if self.expires:
+                self.expires.pop(key, None)
+            old_value = self.data.get(key, None)
+            if old_value == new_value:
+                return
+            changes = [(key, old_value, new_value)]
+            freq_changes = {}
+            if old_value is not None:
+                freq_changes[old_value] = -1
+            if new_value is not None:
+                freq_changes[new_value] = 1
+            self.publish(changes, freq_changes)
+
+    def apply(self, changes):
+        """Assigns new values for several keys at once as a single commit, see Data.apply
+
+        Running Time: O(k)
+        Being 'k' the number of keys to modify
+        """
+        if self.intern_values:
+            changes = Data.interned(changes)
+        with self.write_lock:
+            data = self.data
+            applied = []
+            freq_changes = Counter()
+            for key, new_value in changes.items():
+                old_value = data.get(key, None)
+                if old_value != new_value:
+                    applied.append((key, old_value, new_value))
+                    freq_changes[old_value] -= 1
+                    freq_changes[new_value] += 1
+            freq_changes.pop(None, None)
+            if self.expires:
+                self.forget_expires(changes)
+            if applied:
+                self.publish(applied, freq_changes)
+
+    def publish(self, changes, freq_changes):
+        """Records the previous versions, applies the changes and publishes them
+
+        The write lock must be held.
+
+        Args:
+            changes: a list of tuples (key, old_value, new_value)
+            freq_changes: a dictionary mapping values to the number of times their frequency changes
+        """
+        sequence = self.sequence + 1
+        data = self.data
+        values_freq = self.values_freq
+        history = self.history
+        freq_history = self.freq_history
+
+        keys = []
+        for key, old_value, new_value in changes:
+            history.setdefault(key, []).append((sequence, old_value))
+            keys.append(key)
+        values = []
+        for value, num in freq_changes.items():
+            if num:
+                freq_history.setdefault(value, []).append((sequence, values_freq.get(value, 0)))
+                values.append(value)
+        self.versions.append((sequence, keys, values))
+
+        for key, old_value, new_value in changes:
+            if new_value is None:
+                del data[key]
+            else:
+                data[key] = new_value
+        for value in values:
+            Data.modify_freq(values_freq, value, freq_changes[value])
+
+        self.sequence = sequence
+        self.collect()
+        if self.listeners:
+            self.notify(changes)
+
+    def collect(self):
+        """Drops the versions that no open snapshot can read anymore, the write lock must be held
+
+        A version replaced by the commit with sequence 's' is only read by snapshots
+        opened before 's', that is, with a sequence lower than 's'.
+
+        Lists of the history are replaced instead of modified, since snapshots
+        may be iterating over them.
+        """
+        with self.snapshot_lock:
+            if self.snapshots:
+                oldest = min(self.snapshots)
+            else:
+                oldest = self.sequence
+            versions = self.versions
+            history = self.history
+            freq_history = self.freq_history
+            while versions and versions[0][0] <= oldest:
+                sequence, keys, values = versions.popleft()
+                for key in keys:
+                    VersionedData.drop_version(history, key, sequence)
+                for value in values:
+                    VersionedData.drop_version(freq_history, value, sequence)
 
     @staticmethod
-    def decrease_freq(values_freq, key_of_value):
-        """Decreases the frequency a value is present in the data
+    def drop_version(history, key, sequence):
+        """Drops from the history of a key every version replaced up to the given sequence"""
+        entries = history.get(key)
+        if entries is None:
+            return
+        index = 0
+        while index < len(entries) and entries[index][0] <= sequence:
+            index += 1
+        if index == len(entries):
+            del history[key]
+        elif index:
+            history[key] = entries[index:]
+
+
+
+class Snapshot(object):
+    """Read view of a VersionedData at a given commit sequence
+
+    Args:
+        database: an object of type VersionedData
+        sequence: an integer, the sequence of the latest commit visible to the snapshot
+    """
+    def __init__(self, database, sequence):
+        self.database = database
+        self.sequence = sequence
+        self.closed = False
+
+    @staticmethod
+    def version(entries, sequence, current):
+        """Returns the version visible at the given sequence from the history entries of an item"""
+        if entries:
+            for replaced_by, previous in entries:
+                if replaced_by > sequence:
+                    return previous
+        return current
+
+    def get(self, key):
+        """Fetches the value of a key as it was at the sequence of the snapshot
+
+        Running Time: O(1 + h)
+        Being 'h' the number of versions of the key kept in the history
+        """
+        current = self.database.data.get(key, None)
+        return Snapshot.version(self.database.history.get(key), self.sequence, current)
+
+    def num_equal_to(self, value):
+        """Retrieves the number of keys set to 'value' at the sequence of the snapshot
+
+        Running Time: O(1 + h)
+        Being 'h' the number of versions of the frequency kept in the history
+        """
+        current = self.database.values_freq.get(value, 0)
+        return Snapshot.version(self.database.freq_history.get(value), self.sequence, current)
+
+    def close(self):
+        """Closes the snapshot, allowing its versions to be dropped"""
+        if not self.closed:
+            self.closed = True
+            self.database.close_snapshot(self.sequence)
+
+
+class StripedData(Data):
+    """Thread-safe key-value storage using lock striping
+
+    Keys are distributed into stripes by their hash, each stripe having its own lock.
+    Changes to a key are made while holding the lock of its stripe, so threads modifying
+    keys of different stripes never wait for each other.
+
+    The frequency of the values is sharded by stripe as well: each stripe counts the
+    values of its own keys, and the frequency of a value is the sum of all shards.
+    Reading a frequency never takes a lock.
+
+    Batches (apply) hold the locks of all the stripes they modify, acquired in order, so
+    concurrent batches never deadlock and are applied atomically with respect to other writers.
+
+    Only the operations on a key are striped. The data and the deadlines (expires) are
+    single dictionaries shared by all stripes, whose operations are atomic one by one, and
+    every change of a key or of its deadline, including its expiry, holds the lock of its
+    stripe. Operations over all the keys, such as iterating over them, take no lock and do
+    not see a consistent state while other threads write. The heap of deadlines is guarded
+    by expiry_lock, which is always acquired after a stripe lock, never before.
+
+    Args:
+        stripes: an integer, the number of stripes
+
+    Attributes:
+        locks: a list with the lock of each stripe
+
+        freq_shards: a list with the values frequency dictionary of each stripe
+
+        values_freq: an object of type ShardedFreq, a read-only mapping that aggregates
+                     the frequency of the values from all shards
+    """
+    def __init__(self, stripes=64):
+        Data.__init__(self)
+        self.stripes = stripes
+        self.locks = [threading.Lock() for _ in range(stripes)]
+        self.freq_shards = [{} for _ in range(stripes)]
+        self.values_freq = ShardedFreq(self.freq_shards)
+
+    def load(self, data, values_freq):
+        """Replaces all the content, rebuilding the shards of the values frequency from the data
+
+        Running Time: O(n)
+        Being 'n' the number of keys
+        """
+        if self.intern_values:
+            Data.intern_data(data)
+        freq_shards = [{} for _ in range(self.stripes)]
+        stripes = self.stripes
+        for key, value in data.items():
+            shard = freq_shards[hash(key) % stripes]
+            shard[value] = shard.get(value, 0) + 1
+        self.data = data
+        self.freq_shards = freq_shards
+        self.values_freq = ShardedFreq(freq_shards)
+        with self.expiry_lock:
+            self.expires = {}
+            self.expires_heap = []
+        self.notify_load()
+
+    def num_equal_to(self, value):
+        """Retrieves the number of keys currently set to 'value' from all shards
+
+        Running Time: O(s)
+        Being 's' the number of stripes
+        """
+        if self.expires:
+            self.expire_due()
+        return self.values_freq.get(value, 0)
+
+    def put(self, key, new_value):
+        """Assigns a new value for the given key holding the lock of its stripe, see Data.put
 
         Running Time: O(1)
         """
-        Data.modify_freq(values_freq, key_of_value, -1)
+        if self.intern_values and new_value is not None:
+            new_value = sys.intern(new_value)
+        stripe = hash(key) % self.stripes
+        with self.locks[stripe]:
+            self.change(stripe, key, new_value)
+
+    def change(self, stripe, key, new_value):
+        """Assigns a new value for the given key, the lock of its stripe must be held"""
+        if self.expires:
+            self.expires.pop(key, None)
+        data = self.data
+        old_value = data.get(key, None)
+        if old_value == new_value:
+            return
+
+        if new_value is None:
+            del data[key]
+        else:
+            data[key] = new_value
+        shard = self.freq_shards[stripe]
+        Data.decrease_freq(shard, old_value)
+        Data.increase_freq(shard, new_value)
+
+        if self.listeners:
+            self.notify([(key, old_value, new_value)])
+        if self.handlers:
+            for handler in self.stale_readers():
+                handler.rebase([(key, old_value, new_value)])
+
+    def set_expire(self, key, deadline):
+        """Sets the deadline of a key holding the lock of its stripe, see Data.set_expire"""
+        with self.locks[hash(key) % self.stripes]:
+            return Data.set_expire(self, key, deadline)
+
+    def persist(self, key):
+        """Removes the deadline of a key holding the lock of its stripe, see Data.persist"""
+        with self.locks[hash(key) % self.stripes]:
+            return Data.persist(self, key)
+
+    def remove_expired(self, key, deadline):
+        """Removes a key if its deadline is still the given one, checking it while holding the
+        lock of its stripe so a concurrent change of the key is never undone, see Data.remove_expired
+        """
+        stripe = hash(key) % self.stripes
+        with self.locks[stripe]:
+            if self.expires.get(key) != deadline:
+                return False
+            self.change(stripe, key, None)
+            return True
+
+    def apply(self, changes):
+        """Assigns new values for several keys at once holding the locks of their stripes, see Data.apply
+
+        Running Time: O(k)
+        Being 'k' the number of keys to modify
+        """
+        if self.intern_values:
+            changes = Data.interned(changes)
+        stripes = self.stripes
+        by_stripe = {}
+        for key, new_value in changes.items():
+            by_stripe.setdefault(hash(key) % stripes, []).append((key, new_value))
+
+        locked = sorted(by_stripe)
+        for stripe in locked:
+            self.locks[stripe].acquire()
+        try:
+            data = self.data
+            readers = self.stale_readers() if self.handlers else None
+            applied = [] if self.listeners or readers else None
+            for stripe in locked:
+                freq_changes = Counter()
+                for key, new_value in by_stripe[stripe]:
+                    old_value = data.get(key, None)
+                    if old_value == new_value:
+                        continue
+
+                    if new_value is None:
+                        del data[key]
+                    else:
+                        data[key] = new_value
+                    freq_changes[old_value] -= 1
+                    freq_changes[new_value] += 1
+                    if applied is not None:
+                        applied.append((key, old_value, new_value))
+                Data.merge_freq(self.freq_shards[stripe], freq_changes)
+
+            if self.expires:
+                self.forget_expires(changes)
+            if applied:
+                if self.listeners:
+                    self.notify(applied)
+                for handler in readers or ():
+                    handler.rebase(applied)
+        finally:
+            for stripe in locked:
+                self.locks[stripe].release()
+
+
+
+class ShardedFreq(Mapping):
+    """Read-only mapping with the aggregated frequency of the values of several shards
+
+    Looking up a value sums its frequency in every shard, without taking any lock.
+    Iterating over it merges all shards.
+
+    Args:
+        shards: a list of dictionaries mapping values to their frequencies
+    """
+    def __init__(self, shards):
+        self.shards = shards
+
+    def get(self, value, default=None):
+        """Returns the aggregated frequency of a value, or default if no key is set to it
+
+        Running Time: O(s)
+        Being 's' the number of shards
+        """
+        total = 0
+        for shard in self.shards:
+            total += shard.get(value, 0)
+        if total:
+            return total
+        return default
+
+    def __getitem__(self, value):
+        total = self.get(value, 0)
+        if not total:
+            raise KeyError(value)
+        return total
+
+    def merged(self):
+        """Returns a dictionary with the aggregated frequencies of all values"""
+        total = Counter()
+        for shard in self.shards:
+            total.update(shard)
+        return dict((value, freq) for value, freq in total.items() if freq)
+
+    def __iter__(self):
+        return iter(self.merged())
+
+    def __len__(self):
+        return len(self.merged())
+
+
+EVICTION_POLICIES = ('lru', 'lfu', 'random', 'ttl')
+
+ENTRY_OVERHEAD = 120
+
+LFU_INIT = 5
+
+LFU_LOG_FACTOR = 10
+
+LFU_DECAY_SHIFT = 16
+
+
+class BoundedData(Data):
+    """Key-value storage limited to an estimated amount of memory
+
+    Once a commit makes the estimated memory exceed the limit, keys are evicted until
+    it fits again. Evicted keys are removed exactly like an unset (the frequency of their
+    values is updated and listeners are notified), and a key modified by an open 
+    transaction is never evicted, see Data.is_pinned.
+
+    The memory of a key is estimated as the size of its key and value strings plus a fixed
+    overhead for the hash table entries and the eviction metadata.
+
+    Like Redis, eviction is approximate: a few keys are sampled at random and the best
+    candidate among them is evicted. To sample keys in constant time, they are also kept
+    in a list along with their position in it, and the access metadata of each key is a
+    single unsigned integer stored in an array at that same position:
+        lru: the logical time of the latest access
+        lfu: a logarithmic access counter in the lowest 8 bits, decremented once for each
+             period of 2^16 accesses without accessing the key, whose latest period is
+             stored in the rest of the bits
+    The 'random' policy keeps no metadata, and the 'ttl' policy evicts the key with the
+    earliest deadline first, falling back to 'lru' for keys without time to live.
+
+    Args:
+        maxmemory: an integer, the maximum estimated number of bytes
+        policy: an string, one of EVICTION_POLICIES
+        samples: an integer, the number of keys sampled for each eviction
+
+    Attributes:
+        used_memory: an integer, the estimated number of bytes used by the keys
+
+        evicted_keys: an integer, the number of keys evicted so far
+
+        keys: a list with every key
         
+        positions: a dictionary mapping each key to its position in keys
+
+        accesses: an array with the access metadata of each key, in the same order as keys
+
+        tick: an integer, the logical time, increased by every access
+    """
+    def __init__(self, maxmemory, policy='lru', samples=5):
+        if policy not in EVICTION_POLICIES:
+            raise ValueError('invalid eviction policy %r, expected one of %s' % (policy, ', '.join(EVICTION_POLICIES)))
+        Data.__init__(self)
+        self.maxmemory = maxmemory
+        self.policy = policy
+        self.samples = samples
+        self.used_memory = 0
+        self.evicted_keys = 0
+        self.keys = []
+        self.positions = {}
+        self.accesses = array.array('I')
+        self.tick = 0
+        self.random = random.Random()
+        self.data = self.track_dict({})
+
+    def track_dict(self, data):
+        """Returns the dictionary to store the data, which records reads unless the policy is 'random'"""
+        if self.policy == 'random':
+            return data
+        return TrackedDict(data, self.touch)
+
+    def load(self, data, values_freq):
+        """Replaces all the content, rebuilding the eviction metadata and evicting keys if required
+
+        Running Time: O(n)
+        Being 'n' the number of keys
+        """
+        Data.load(self, self.track_dict(data), values_freq)
+        self.keys = []
+        self.positions = {}
+        self.accesses = array.array('I')
+        self.used_memory = 0
+        for key, value in data.items():
+            self.account(key, None, value)
+        self.evict()
+
     @staticmethod
-    def modify_freq(values_freq, key_of_value, num):
-        """Modifies the frequency a value is present in the data by 'num' times
-        If the new value frequence is equal to 0, the record is removed in order to save memory
+    def size_of(key, value):
+        """Returns the estimated number of bytes used by a key set to a value"""
+        return sys.getsizeof(key) + sys.getsizeof(value) + ENTRY_OVERHEAD
+
+    def put(self, key, new_value):
+        """Assigns a new value for the given key, evicting keys if required, see Data.put
 
         Running Time: O(1)
+        Plus the running time of evict
         """
-        if key_of_value is not None:
-            values_freq[key_of_value] = values_freq.get(key_of_value, 0) + num
+        old_value = dict.get(self.data, key)
+        Data.put(self, key, new_value)
+        self.account(key, old_value, new_value)
+        if self.used_memory > self.maxmemory:
+            self.evict()
 
-            if values_freq[key_of_value] == 0:
-                values_freq.pop(key_of_value, None)
+    def apply(self, changes):
+        """Assigns new values for several keys at once, evicting keys if required, see Data.apply
+
+        Running Time: O(k)
+        Being 'k' the number of keys to modify, plus the running time of evict
+        """
+        data = self.data
+        old_values = [dict.get(data, key) for key in changes]
+        Data.apply(self, changes)
+        for old_value, (key, new_value) in zip(old_values, changes.items()):
+            self.account(key, old_value, new_value)
+        if self.used_memory > self.maxmemory:
+            self.evict()
+
+    def account(self, key, old_value, new_value):
+        """Updates the estimated memory and the eviction metadata after a key changes
+
+        Running Time: O(1)
+        """
+        if old_value == new_value:
+            return
+        if old_value is None:
+            self.positions[key] = len(self.keys)
+            self.keys.append(key)
+            self.accesses.append(self.initial_access())
+            self.used_memory += BoundedData.size_of(key, new_value)
+        elif new_value is None:
+            position = self.positions.pop(key)
+            last_key = self.keys.pop()
+            last_access = self.accesses.pop()
+            if last_key != key:
+                self.keys[position] = last_key
+                self.accesses[position] = last_access
+                self.positions[last_key] = position
+            self.used_memory -= BoundedData.size_of(key, old_value)
+        else:
+            self.used_memory += sys.getsizeof(new_value) - sys.getsizeof(old_value)
+
+    def initial_access(self):
+        """Returns the access metadata of a new key, setting it counts as an access"""
+        tick = self.tick + 1
+        self.tick = tick
+        if self.policy == 'lfu':
+            return ((tick >> LFU_DECAY_SHIFT) << 8 | LFU_INIT) & 0xFFFFFFFF
+        if tick > 0xFFFFFFFF:
+            tick = self.renumber()
+        return tick
+
+    def touch(self, key):
+        """Records an access to a key
+
+        Running Time: O(1)
+        """
+        position = self.positions.get(key)
+        if position is None:
+            return
+        tick = self.tick + 1
+        self.tick = tick
+        if self.policy == 'lfu':
+            counter = self.lfu_counter(self.accesses[position])
+            if counter < 255:
+                base = counter - LFU_INIT
+                if base <= 0 or self.random.random() < 1.0 / (base * LFU_LOG_FACTOR + 1):
+                    counter += 1
+            self.accesses[position] = ((tick >> LFU_DECAY_SHIFT) << 8 | counter) & 0xFFFFFFFF
+        else:
+            if tick > 0xFFFFFFFF:
+                tick = self.renumber()
+            self.accesses[position] = tick
+
+    def renumber(self):
+        """Halves the logical time of every access once it does not fit in 32 bits, keeping their order
+
+        Only used by the 'lru' policy, the 'lfu' policy stores the periods modulo 2^24
+
+        Running Time: O(n)
+        Being 'n' the number of keys, once every 2^31 accesses
+
+        Returns:
+            an integer, the new logical time
+        """
+        accesses = self.accesses
+        for position in range(len(accesses)):
+            accesses[position] >>= 1
+        self.tick = (self.tick >> 1) + 1
+        return self.tick
+
+    def lfu_counter(self, access):
+        """Returns the access counter of a key, decremented by the periods elapsed since its latest access"""
+        elapsed = ((self.tick >> LFU_DECAY_SHIFT) - (access >> 8)) & 0xFFFFFF
+        return max(0, (access & 0xFF) - elapsed)
+
+    def evict(self):
+        """Evicts keys until the estimated memory fits the limit
+
+        It stops if every candidate is pinned by an open transaction.
+
+        Running Time: O(e * s)
+        Being 'e' the number of keys evicted and 's' the number of samples
+        """
+        while self.used_memory > self.maxmemory and self.keys:
+            key = self.candidate()
+            if key is None:
+                return
+            old_value = dict.get(self.data, key)
+            Data.put(self, key, None)
+            self.account(key, old_value, None)
+            self.evicted_keys += 1
+
+    def candidate(self):
+        """Chooses the key to evict according to the policy, or None if all candidates are pinned"""
+        if self.policy == 'ttl' and self.expires:
+            with self.expiry_lock:
+                heap = self.expires_heap
+                while heap and self.expires.get(heap[0][1]) != heap[0][0]:
+                    heapq.heappop(heap)
+                if heap and not self.is_pinned(heap[0][1]):
+                    return heap[0][1]
+
+        keys = self.keys
+        accesses = self.accesses
+        randrange = self.random.randrange
+        best = None
+        best_rank = None
+        for _ in range(self.samples):
+            position = randrange(len(keys))
+            key = keys[position]
+            if self.is_pinned(key):
+                continue
+            if self.policy == 'random':
+                return key
+            if self.policy == 'lfu':
+                rank = (self.lfu_counter(accesses[position]), accesses[position])
+            else:
+                rank = accesses[position]
+            if best is None or rank < best_rank:
+                best = key
+                best_rank = rank
+        return best
+
+    def memory_stats(self):
+        """Returns a dictionary with the memory usage and the eviction statistics"""
+        stats = Data.memory_stats(self)
+        stats['used_memory'] = self.used_memory
+        stats['maxmemory'] = self.maxmemory
+        stats['maxmemory_policy'] = self.policy
+        stats['evicted_keys'] = self.evicted_keys
+        return stats
+
+
+
+class TrackedDict(dict):
+    """Dictionary that reports every key read through get, used by BoundedData to record accesses
+
+    It is pickled as a plain dictionary, streaming its items.
+
+    Args:
+        data: a dictionary with the initial items
+        touch: a callable receiving every key found by get
+    """
+    __slots__ = ('touch',)
+
+    def __init__(self, data, touch):
+        dict.__init__(self, data)
+        self.touch = touch
+
+    def get(self, key, default=None):
+        value = dict.get(self, key, default)
+        if value is not default:
+            self.touch(key)
+        return value
+
+    def __reduce__(self):
+        return (dict, (), None, None, iter(self.items()))
+
+
+INVALID_COMMAND = 'Invalid method or number of arguments'
+
+NO_TRANSACTION = 'NO TRANSACTION'
+
+TRANSACTION_ABORTED = 'ERR transaction aborted'
+
+NOT_AN_INTEGER = 'ERR value is not an integer'
+
+NOT_A_NUMBER = 'ERR value is not a number'
+
+REVERSE_INDEX_DISABLED = 'ERR reverse index disabled'
+
+KEY_INDEX_DISABLED = 'ERR key index disabled'
+
+NO_SAVEPOINT = 'ERR no such savepoint'
+
+KEY_SHADOWED = 'ERR EXPIRE is not allowed for a key modified within the transaction'
+
+SNAPSHOT_UNAVAILABLE = 'ERR snapshot disabled, in progress or blocked by an in place transaction'
+
+SLOWLOG_DISABLED = 'ERR slow log disabled'
+
+NO_PROFILE = 'ERR no profile running'
+
+TRANSACTION_COMMANDS = frozenset(['BEGIN', 'SAVEPOINT', 'COMMIT', 'ROLLBACK', 'RELEASE'])
+
+NEVER_SLOW = 1 << 64
+
+SLOWLOG_GET_COUNT = 10
+
+
+def parse_command(line):
+    """Parses a command line into a Command
+
+    Splits the line by whitespaces, the first field being the method name and the
+    rest its arguments. This parser is shared by every front end of the database.
+
+    A Command is a plain tuple (name, arguments), being 'name' the upper-cased method
+    name and 'arguments' a list of strings. A tuple is used instead of a class since it
+    is the cheapest object to build and unpack for every single command.
+
+    Running Time: O(n)
+    Being 'n' the number of characters of the line
+
+    Args:
+        line: an string representing a command, such as 'SET a 10'
+
+    Returns:
+        a Command tuple, or None if the line does not contain any field
+    """
+    fields = line.split()
+    if fields:
+        return (fields[0].upper(), fields[1:])
+    return None
+
+
+def format_value(value):
+    """Formats the output of GET, printing NULL for values that are not set"""
+    if not value:
+        return 'NULL'
+    return value
+
+
+def format_message(message):
+    """Formats the output of methods that already return the text to print, if any"""
+    return message
+
+
+def format_boolean(done):
+    """Formats the output of methods that print 1 if they succeed or 0 otherwise, such as EXPIRE"""
+    if done:
+        return '1'
+    return '0'
+
+
+def format_stats(stats):
+    """Formats a dictionary of statistics, printing a line 'name:value' for each of them"""
+    return '\n'.join(['%s:%s' % item for item in stats.items()])
+
+
+def format_range(count):
+    """Formats the output of NUMRANGE, NUMGREATERTHAN and LEXRANGE"""
+    if count is None:
+        return 'ERR range index disabled'
+    return str(count)
+
+
+def format_transaction(done):
+    """Formats the output of ROLLBACK and COMMIT, printing only if there is no transaction"""
+    if not done:
+        return NO_TRANSACTION
+    return None
+
+
+
+def format_bulk(rows, seconds):
+    """Formats the output of LOAD and EXPORT, with the number of rows and their rate"""
+    return 'OK %d rows in %.2fs (%d rows/sec)' % (rows, seconds, rows / seconds if seconds else 0)
+
+
+
+def format_slow_entry(entry):
+    """Formats an entry of the slow log, see stats.SlowLog
+
+    Example:
+        '4 1700000000 152340us depth=1 keys=100000 COMMIT'
+    """
+    entry_id, timestamp, microseconds, name, arguments, depth, keys = entry
+    return ' '.join(['%d %d %dus depth=%d keys=%d %s' % (entry_id, timestamp, microseconds, depth, keys, name)]
+                    + list(arguments))
+
+
+def format_save(done):
+    """Formats the output of SAVE"""
+    if done:
+        return 'OK'
+    return SNAPSHOT_UNAVAILABLE
+
+
+def format_background_save(started):
+    """Formats the output of BGSAVE"""
+    if started:
+        return 'Background saving started'
+    return SNAPSHOT_UNAVAILABLE
 
 
 
@@ -532,98 +3116,696 @@ class DBConsole(object):
 
     This class performs and controls all console operations for the simple database.
 
+    Args:
+        database: an object of type Database to run the commands against, a new empty
+                  one is created if not given
+
+        persistence: an object of type Persistence of the database, which enables the
+                     SAVE and BGSAVE methods, or None
+
+        stats: an object of type Stats collecting the statistics of the commands executed,
+               or None to collect none, see enable_stats
+
     Attributes:
         database: an object of type Database representing an existent database.
 
         end_operation: a set of strings representing all methods that may finish the execution
                        of the process
 
-        valid_operations_arguments: a set of tuples representing all valid operations and the
-                                    number of arguments required for them to be valid
+        operations: a dictionary (dispatch table) mapping each valid method name to a tuple
+                    with the number of arguments it requires, the bound method of the database
+                    that handles it and the function that formats its output (None if the
+                    method does not print anything)
+                    A negative number of arguments -n means that the method requires at
+                    least n arguments, and None that its handler validates them
+
+        chunk_size: an integer, the number of characters read at once from the input stream
+                    when running in bulk mode
+
+        flush_threshold: an integer, the number of buffered output characters that forces
+                         a write to the output stream when running in bulk mode
+
+        stats: an object of type Stats, or None if the statistics are disabled
+
+        latencies: the dictionary of Stats.latencies while the statistics are enabled, or None
+
+        slow_threshold: an integer, the nanoseconds above which a command is written into the
+                        slow log of the statistics, NEVER_SLOW if there is none
+
+        profile_session: an object of type ProfileSession of the running profile, or None
+
+        unprofiled_operations: the dispatch table without the wrappers that count the commands
+                               of the running profile, or None
     """
-    def __init__(self):
-        self.database = Database()
+    def __init__(self, database=None, chunk_size=1 << 16, flush_threshold=1 << 16, persistence=None,
+                 stats=None):
+        if database is None:
+            database = Database()
+        self.database = database
         self.end_operation = set(['END'])
-        self.valid_operations_arguments = set([
-            ('GET',         1),
-            ('SET',         2),
-            ('UNSET',       1),
-            ('NUMEQUALTO',  1),
-            ('BEGIN',       0),
-            ('ROLLBACK',    0),
-            ('COMMIT',      0)
-        ])
+        self.operations = {
+            'GET':          (1, database.get,           format_value),
+            'SET':          (2, database.set,           None),
+            'UNSET':        (1, database.unset,         None),
+            'NUMEQUALTO':   (-1, self.num_equal_to,     format_message),
+            'MGET':         (-1, self.mget,             format_message),
+            'MSET':         (-2, self.mset,             format_message),
+            'BEGIN':        (0, database.begin,         None),
+            'ROLLBACK':     (None, self.rollback,       format_message),
+            'COMMIT':       (0, self.commit,            format_message),
+            'SAVEPOINT':    (1, database.savepoint,     None),
+            'RELEASE':      (None, self.release,        format_message),
+            'EXPIRE':       (2, self.expire,            format_message),
+            'SETEX':        (3, self.setex,             format_message),
+            'TTL':          (1, database.ttl,           str),
+            'PERSIST':      (1, database.persist,       format_boolean),
+            'MEMORY':       (0, database.memory_stats,  format_stats),
+            'NUMRANGE':     (2, self.num_range,         format_range),
+            'NUMGREATERTHAN': (1, self.num_greater_than, format_range),
+            'LEXRANGE':     (2, database.lex_range,     format_range),
+            'KEYSWITHVALUE': (1, self.keys_with_value,  format_message),
+            'SCANVALUE':    (-2, self.scan_value,       format_message),
+            'KEYS':         (1, self.keys,              format_message),
+            'SCAN':         (-1, self.scan,             format_message),
+            'LOAD':         (-1, self.load,             format_message),
+            'IMPORT':       (-1, self.load,             format_message),
+            'EXPORT':       (-1, self.export,           format_message),
+            'INFO':         (None, self.info,           format_message),
+            'STATS':        (None, self.info,           format_message),
+            'SLOWLOG':      (-1, self.slowlog,          format_message),
+            'PROFILE':      (-1, self.profile,          format_message)
+        }
+        self.chunk_size = chunk_size
+        self.flush_threshold = flush_threshold
+        self.stats = None
+        self.latencies = None
+        self.slow_threshold = NEVER_SLOW
+        self.profile_session = None
+        self.unprofiled_operations = None
+        if persistence is not None:
+            self.register('SAVE',   0, persistence.save,   format_save)
+            self.register('BGSAVE', 0, persistence.bgsave, format_background_save)
+        if stats is not None:
+            self.enable_stats(stats)
+
+    def register(self, name, arguments_count, handler, formatter=None):
+        """Adds a method to the dispatch table, replacing it if it already exists
 
-    def read_from_stdin(self):
-        """Reads from stdin and executes the specified command
+        Args:
+            name: an string representing the upper-cased method name
+            arguments_count: an integer, the number of arguments the method requires, or -n if
+                             it requires at least n arguments, or None if the handler validates
+                             them
+            handler: a callable receiving the arguments of the command
+            formatter: a callable converting the result of the handler into the line to print,
+                       or None if the method does not print anything
+        """
+        self.operations[name] = (arguments_count, handler, formatter)
+        if self.unprofiled_operations is not None:
+            self.unprofiled_operations[name] = (arguments_count, handler, formatter)
 
-        Reads from input stdin and parses each line command. It compares its content 
-        with the valid operations and if so executes it.
-        Moreover, if input comes from a file, it handles 'end of file' events and completes
-        the execution 
+    def is_end(self, command):
+        """Returns whether the command finishes the execution"""
+        return command[0] in self.end_operation
+
+    def execute(self, command):
+        """Executes a pre-parsed command
+
+        Looks up the method in the dispatch table and, if the number of arguments
+        is valid, calls its handler and formats its result.
 
-        Avoided using getattr for function calls due to performance is reduced as per python documentation.
+        Running Time: O(1)
+        Dispatching costs a single lookup in a hash table, plus the running time
+        of the method executed
+
+        Args:
+            command: a Command tuple, as returned by parse_command
+
+        Returns:
+            an string representing the line to be printed for this command, or None if
+            the command does not print anything
         """
-        try: 
-            fields = input().split()
+        name, arguments = command
+        operation = self.operations.get(name)
+        if operation is None:
+            return INVALID_COMMAND
+        arguments_count = operation[0]
+        if arguments_count != len(arguments) and arguments_count is not None and \
+                (arguments_count >= 0 or len(arguments) < -arguments_count):
+            return INVALID_COMMAND
+
+        result = operation[1](*arguments)
+        formatter = operation[2]
+        if formatter is None:
+            return None
+        return formatter(result)
+
+    def execute_with_stats(self, command):
+        """Executes a pre-parsed command as execute does, recording its latency in the statistics
+
+        The dispatch of execute is inlined and the latency is recorded straight into the counts
+        of the histogram of the command (see stats.bucket_of), so the overhead is mostly reading
+        the clock twice. The first call of each command, the transaction commands and the
+        invalid ones go through execute_tracked.
+        """
+        name, arguments = command
+        operation = self.operations.get(name)
+        counts = self.latencies.get(name)
+        if operation is None or counts is None or name in TRANSACTION_COMMANDS:
+            return self.execute_tracked(command)
+        arguments_count, handler, formatter = operation
+        if arguments_count != len(arguments) and arguments_count is not None and \
+                (arguments_count >= 0 or len(arguments) < -arguments_count):
+            return self.execute_tracked(command)
+
+        started = time.perf_counter_ns()
+        output = handler(*arguments)
+        if formatter is not None:
+            output = formatter(output)
+        elapsed = time.perf_counter_ns() - started
+        shift = elapsed.bit_length() - SUB_BUCKET_BITS - 1
+        if shift > 0:
+            counts[(shift << SUB_BUCKET_BITS) + (elapsed >> shift)] += 1
+        else:
+            counts[elapsed] += 1
+        if elapsed >= self.slow_threshold:
+            self.stats.slowlog.record(command, elapsed, transaction_depth(self.database), keys_touched(command))
+        return output
 
-            if fields:
-                method_name = fields[0].upper()
-                arguments = fields[1:]
-                arguments_count = len(arguments)
+    def execute_tracked(self, command):
+        """Executes a pre-parsed command recording its latency, along with the write set of
+        COMMIT and the transaction depth reached by BEGIN and SAVEPOINT
 
-                if method_name in self.end_operation: 
-                    return False
+        The transaction commands measure the write set before they run, so a slow one is
+        logged with the number of keys it committed or rolled back.
+        """
+        name = command[0]
+        stats = self.stats
+        database = self.database
+        transaction = name in TRANSACTION_COMMANDS
+        if transaction:
+            depth = transaction_depth(database)
+            write_set = write_set_size(database)
+            if name == 'COMMIT' and depth:
+                stats.write_sets.record(write_set)
+        started = time.perf_counter_ns()
+        output = DBConsole.execute(self, command)
+        elapsed = time.perf_counter_ns() - started
+        stats.histogram(name if name in self.operations else UNKNOWN_COMMAND).record(elapsed)
+        if transaction:
+            stats.record_depth(database)
+            if elapsed >= self.slow_threshold:
+                stats.slowlog.record(command, elapsed, depth, max(write_set - write_set_size(database), 0))
+        elif elapsed >= self.slow_threshold:
+            stats.slowlog.record(command, elapsed, transaction_depth(database), keys_touched(command))
+        return output
+
+    def enable_stats(self, stats=None):
+        """Starts collecting statistics of the commands executed
+
+        Replaces the execute method of this console with execute_with_stats, so a console
+        without statistics does not check whether they are enabled for each command.
 
+        Args:
+            stats: an object of type Stats, which may be shared by several consoles, or None
+                   to create a new one
 
-                if (method_name, arguments_count) in self.valid_operations_arguments:
+        Returns:
+            the object of type Stats
+        """
+        self.stats = stats if stats is not None else Stats()
+        self.latencies = self.stats.latencies
+        if self.stats.slowlog is not None:
+            self.slow_threshold = self.stats.slowlog.threshold
+        self.execute = self.execute_with_stats
+        return self.stats
+
+    def disable_stats(self):
+        """Stops collecting statistics, restoring the regular execute method"""
+        self.stats = None
+        self.latencies = None
+        self.slow_threshold = NEVER_SLOW
+        self.__dict__.pop('execute', None)
+
+    def start_profile(self, path, mode='cprofile', seconds=None, commands=None):
+        """Starts profiling the commands executed by this console, see profiling.py
+
+        The handlers of the dispatch table are wrapped to count the commands while the profile
+        runs, and restored once it stops. The profile stops by itself at the first command
+        after the given number of seconds, or after the given number of commands.
 
-                    if method_name == 'GET': 
-                        output = self.database.get(*arguments)
-                        if not output:  output = 'NULL'
-                        print (output)
+        Args:
+            path: an string, the file the results are written into
+            mode: an string, one of PROFILE_MODES
+            seconds: a number, or None to run without time limit
+            commands: an integer, or None to run without commands limit
+
+        Raises:
+            ValueError: if a profile is already running or the arguments are not valid
+            OSError: if the file cannot be written
+        """
+        if self.profile_session is not None:
+            raise ValueError('a profile is already running')
+        session = ProfileSession(create_profiler(mode), path, seconds, commands)
+        session.start()
+        self.profile_session = session
+        self.unprofiled_operations = self.operations
+        self.operations = dict([(name, (operation[0], self.profiled(operation[1]), operation[2]))
+                                for name, operation in self.operations.items() if name != 'PROFILE'])
+        self.operations['PROFILE'] = self.unprofiled_operations['PROFILE']
+
+    def profiled(self, handler):
+        """Wraps the handler of an operation so it counts the commands of the running profile"""
+        session = self.profile_session
+
+        def profiled_handler(*arguments):
+            result = handler(*arguments)
+            if session.tick() and self.profile_session is session:
+                self.stop_profile()
+            return result
+        return profiled_handler
+
+    def stop_profile(self):
+        """Stops the running profile, writing its results
 
-                    elif method_name == 'SET':
-                        self.database.set(*arguments)
+        Returns:
+            a tuple, containing the number of commands profiled, the seconds taken and the path
+            of the results, or None if no profile is running
+        """
+        session = self.profile_session
+        if session is None:
+            return None
+        self.profile_session = None
+        self.operations = self.unprofiled_operations
+        self.unprofiled_operations = None
+        return session.stop()
+
+    def num_equal_to(self, *values):
+        """Handles NUMEQUALTO value [value ...], printing the frequency of each value in its own line"""
+        if len(values) == 1:
+            return str(self.database.num_equal_to(values[0]))
+        return '\n'.join([str(freq) for freq in self.database.num_equal_to_many(values)])
+
+    def mget(self, *keys):
+        """Handles MGET key [key ...], printing the value of each key in its own line"""
+        return '\n'.join([format_value(value) for value in self.database.mget(keys)])
+
+    def mset(self, *arguments):
+        """Handles MSET key value [key value ...], the arguments must be pairs"""
+        if len(arguments) % 2:
+            return INVALID_COMMAND
+        self.database.mset(dict(zip(arguments[::2], arguments[1::2])))
+        return None
+
+    def rollback(self, *arguments):
+        """Handles ROLLBACK, or ROLLBACK TO name to roll back up to a savepoint"""
+        if not arguments:
+            return format_transaction(self.database.rollback())
+        if len(arguments) != 2 or arguments[0].upper() != 'TO':
+            return INVALID_COMMAND
+        if not self.database.is_transaction_active():
+            return NO_TRANSACTION
+        if not self.database.rollback_to(arguments[1]):
+            return NO_SAVEPOINT
+        return None
 
-                    elif method_name == 'UNSET':
-                        self.database.unset(*arguments)
+    def commit(self):
+        """Handles COMMIT, printing only if there is no transaction or it was aborted, such
+        as by a two-phase commit of a ShardedDatabase"""
+        if not self.database.is_transaction_active():
+            return NO_TRANSACTION
+        if not self.database.commit():
+            return TRANSACTION_ABORTED
+        return None
+
+    def release(self, *arguments):
+        """Handles RELEASE, or RELEASE name to release up to a savepoint"""
+        if len(arguments) > 1:
+            return INVALID_COMMAND
+        if not self.database.is_transaction_active():
+            return NO_TRANSACTION
+        if not self.database.release(*arguments):
+            if not self.database.is_transaction_active():
+                return TRANSACTION_ABORTED
+            return NO_SAVEPOINT
+        return None
+
+    def info(self, *arguments):
+        """Handles INFO (or STATS), printing the statistics, and INFO RESET to drop them
+
+        Without statistics enabled only the size of the data and the transactions is printed.
+        """
+        if arguments:
+            if len(arguments) != 1 or arguments[0].upper() != 'RESET':
+                return INVALID_COMMAND
+            if self.stats is not None:
+                self.stats.reset()
+            return 'OK'
+        if self.stats is None:
+            return format_info(database_info(self.database))
+        return format_info(self.stats.info(self.database))
+
+    def slowlog(self, subcommand, *arguments):
+        """Handles SLOWLOG GET [count], printing the latest slow commands one per line from the
+        most recent, SLOWLOG LEN and SLOWLOG RESET"""
+        if self.stats is None or self.stats.slowlog is None:
+            return SLOWLOG_DISABLED
+        slowlog = self.stats.slowlog
+        subcommand = subcommand.upper()
+        if subcommand == 'GET' and len(arguments) <= 1:
+            try:
+                count = int(arguments[0]) if arguments else SLOWLOG_GET_COUNT
+            except ValueError:
+                return NOT_AN_INTEGER
+            return '\n'.join([format_slow_entry(entry) for entry in slowlog.get(count)]) or None
+        if arguments:
+            return INVALID_COMMAND
+        if subcommand == 'LEN':
+            return str(len(slowlog))
+        if subcommand == 'RESET':
+            slowlog.reset()
+            return 'OK'
+        return INVALID_COMMAND
+
+    def profile(self, subcommand, *arguments):
+        """Handles PROFILE START mode path [SECONDS n] [COMMANDS n] and PROFILE STOP, see start_profile"""
+        subcommand = subcommand.upper()
+        if subcommand == 'START':
+            try:
+                self.start_profile(*parse_profile_arguments(arguments))
+            except (OSError, ValueError) as error:
+                return 'ERR %s' % error
+            return 'OK'
+        if subcommand == 'STOP' and not arguments:
+            result = self.stop_profile()
+            if result is None:
+                return NO_PROFILE
+            return format_profile(result)
+        return INVALID_COMMAND
+
+    def load(self, path, *format):
+        """Handles LOAD path [format] (or IMPORT), printing the number of rows imported, see bulk.import_file"""
+        if len(format) > 1:
+            return INVALID_COMMAND
+        try:
+            return format_bulk(*import_file(self.database, path, *format))
+        except (OSError, ValueError) as error:
+            return 'ERR %s' % error
+
+    def export(self, path, *format):
+        """Handles EXPORT path [format], printing the number of rows written, see bulk.export_file"""
+        if len(format) > 1:
+            return INVALID_COMMAND
+        try:
+            return format_bulk(*export_file(self.database, path, *format))
+        except (OSError, ValueError) as error:
+            return 'ERR %s' % error
+
+    def expire(self, key, seconds):
+        """Handles EXPIRE key seconds, printing 1 if the key is set or 0 otherwise, which is
+        not allowed for the keys modified by the open transactions"""
+        try:
+            seconds = int(seconds)
+        except ValueError:
+            return NOT_AN_INTEGER
+        done = self.database.expire(key, seconds)
+        if done is None:
+            return KEY_SHADOWED
+        return format_boolean(done)
+
+    def setex(self, key, seconds, value):
+        """Handles SETEX key seconds value, which is not allowed within a transaction"""
+        try:
+            seconds = int(seconds)
+        except ValueError:
+            return NOT_AN_INTEGER
+        if not self.database.setex(key, seconds, value):
+            return 'ERR SETEX is not allowed within a transaction'
+        return None
+
+    def num_range(self, low, high):
+        """Handles NUMRANGE low high, the bounds must be numbers"""
+        try:
+            return self.database.num_range(float(low), float(high))
+        except ValueError:
+            return NOT_A_NUMBER
+
+    def num_greater_than(self, low):
+        """Handles NUMGREATERTHAN low, the bound must be a number"""
+        try:
+            return self.database.num_greater_than(float(low))
+        except ValueError:
+            return NOT_A_NUMBER
+
+    def keys_with_value(self, value):
+        """Handles KEYSWITHVALUE value, printing each key set to the value in its own line"""
+        try:
+            keys = list(self.database.keys_with_value(value))
+        except ValueError:
+            return REVERSE_INDEX_DISABLED
+        if not keys:
+            return None
+        return '\n'.join(keys)
+
+    def scan_value(self, value, cursor, *count):
+        """Handles SCANVALUE value cursor [count], printing the next cursor and then a key per line"""
+        if len(count) > 1:
+            return INVALID_COMMAND
+        try:
+            cursor = int(cursor)
+            count = int(count[0]) if count else 100
+        except ValueError:
+            return NOT_AN_INTEGER
+        page = self.database.scan_keys_with_value(value, cursor, count)
+        if page is None:
+            return REVERSE_INDEX_DISABLED
+        cursor, keys = page
+        return '\n'.join([str(cursor)] + keys)
+
+    def keys(self, pattern):
+        """Handles KEYS pattern, printing each matching key in its own line"""
+        try:
+            keys = list(self.database.keys(pattern))
+        except ValueError:
+            return KEY_INDEX_DISABLED
+        if not keys:
+            return None
+        return '\n'.join(keys)
+
+    def scan(self, cursor, *options):
+        """Handles SCAN cursor [MATCH pattern] [COUNT count]
+
+        Prints the cursor of the next page, and then each key of the page in its own line.
+        The cursor is 0 to start and once the scan is completed, otherwise it is the last
+        key visited preceded by '>'.
+        """
+        if len(options) % 2:
+            return INVALID_COMMAND
+        match = None
+        count = 10
+        for option, argument in zip(options[::2], options[1::2]):
+            option = option.upper()
+            if option == 'MATCH':
+                match = argument
+            elif option == 'COUNT':
+                try:
+                    count = int(argument)
+                except ValueError:
+                    return NOT_AN_INTEGER
+            else:
+                return INVALID_COMMAND
 
-                    elif method_name == 'NUMEQUALTO':
-                        output = self.database.num_equal_to(*arguments)
-                        print (output)
+        if cursor == '0':
+            cursor = None
+        elif cursor.startswith('>'):
+            cursor = cursor[1:]
+        else:
+            return 'ERR invalid cursor'
+        try:
+            cursor, keys = self.database.scan(cursor, match, max(count, 1))
+        except ValueError:
+            return KEY_INDEX_DISABLED
+        return '\n'.join(['0' if cursor is None else '>' + cursor] + keys)
 
+    def read_from_stdin(self):
+        """Reads from stdin and executes the specified command
 
-                    elif method_name == 'BEGIN':
-                        self.database.begin()
+        Reads from input stdin and parses each line command, executing it and printing 
+        its output if any.
+        Moreover, if input comes from a file, it handles 'end of file' events and completes
+        the execution 
+        """
+        try: 
+            command = parse_command(input())
 
-                    elif method_name == 'ROLLBACK':
-                        output = self.database.rollback()
-                        if not output:
-                            print ("NO TRANSACTION")
+            if command is not None:
+                if self.is_end(command): 
+                    return False
 
-                    elif method_name == 'COMMIT':
-                        output = self.database.commit()
-                        if not output:
-                            print ("NO TRANSACTION")
-                else:
-                    print ('Invalid method or number of arguments')
+                output = self.execute(command)
+                if output is not None:
+                    print (output)
             return True
         except EOFError:
             return False
 
+    def read_lines(self, stream):
+        """Generator that yields every line of a stream, reading it in large chunks
+
+        Running Time: O(n)
+        Being 'n' the number of characters of the stream. Each chunk is split by the
+        str methods implemented in C, avoiding one call per line to the stream.
+
+        Args:
+            stream: a file-like object opened in text mode
+        """
+        pending = ''
+        read = stream.read
+        chunk_size = self.chunk_size
+        while True:
+            chunk = read(chunk_size)
+            if not chunk:
+                break
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line
+        if pending:
+            yield pending
+
+    def read_commands(self, stream):
+        """Generator that yields a Command tuple for every non empty line of a stream
+
+        Args:
+            stream: a file-like object opened in text mode
+        """
+        for line in self.read_lines(stream):
+            command = parse_command(line)
+            if command is not None:
+                yield command
+
+    def process_stream(self, input_stream, output_stream):
+        """Executes every command of an input stream, buffering its output
+
+        Bulk alternative to calling read_from_stdin once per command. Commands are read
+        in chunks and the printed lines are collected in a buffer that is written to the
+        output stream once it reaches the flush threshold, and lastly at END or at the
+        end of the input. The output is exactly the same as the one printed by 
+        read_from_stdin for the same commands.
+
+        Args:
+            input_stream: a file-like object opened in text mode to read commands from
+            output_stream: a file-like object opened in text mode to write the output to
+        """
+        buffer = []
+        buffer_size = 0
+        flush_threshold = self.flush_threshold
+        end_operation = self.end_operation
+        execute = self.execute
+        try:
+            for command in self.read_commands(input_stream):
+                if command[0] in end_operation:
+                    break
+
+                output = execute(command)
+                if output is not None:
+                    buffer.append(output)
+                    buffer_size += len(output) + 1
+                    if buffer_size >= flush_threshold:
+                        buffer.append('')
+                        output_stream.write('\n'.join(buffer))
+                        buffer = []
+                        buffer_size = 0
+        finally:
+            if buffer:
+                buffer.append('')
+                output_stream.write('\n'.join(buffer))
+            output_stream.flush()
+
     def listen(self):
         """Consistently listens for commands
 
         This method stays running until a value from the end of operation set is 
-        sent from stdin.        
+        sent from stdin.
+        If stdin is not interactive (for instance a file redirected to it), the commands
+        are processed in bulk mode.
         """
+        if not sys.stdin.isatty():
+            self.process_stream(sys.stdin, sys.stdout)
+            return
+
         active = True       
         while active:
             active = self.read_from_stdin()
             
+def add_arguments(parser):
+    """Adds the command line arguments that configure a database to an argument parser"""
+    parser.add_argument('--log', help='append-only command log used to persist and recover the database')
+    parser.add_argument('--fsync', choices=FSYNC_POLICIES, default=FSYNC_EVERYSEC,
+                        help='fsync policy of the command log (default: %(default)s)')
+    parser.add_argument('--snapshot', help='snapshot file used to persist and recover the database')
+    parser.add_argument('--maxmemory', type=int, help='maximum estimated bytes used by the keys before evicting them')
+    parser.add_argument('--maxmemory-policy', choices=EVICTION_POLICIES, default='lru',
+                        help='eviction policy once maxmemory is reached (default: %(default)s)')
+    parser.add_argument('--compact', action='store_true', help='intern the values to save memory when many keys share them')
+    parser.add_argument('--range-index', action='store_true', help='index the values to count the keys within a range of values')
+    parser.add_argument('--reverse-index', action='store_true', help='index the keys by value to find the keys set to a value')
+    parser.add_argument('--key-index', action='store_true', help='keep the keys sorted to enable KEYS and SCAN')
+    parser.add_argument('--engine', choices=ENGINES, default='redo',
+                        help='transaction engine, undo writes in place for a constant time COMMIT (default: %(default)s)')
+    parser.add_argument('--spill-threshold', type=int, default=None,
+                        help='number of keys modified by a transaction kept in memory before spilling them to disk')
+    parser.add_argument('--spill-directory', default=None, help='directory of the changes spilled to disk')
+    parser.add_argument('--stats', action='store_true',
+                        help='collect the latency of every command, printed by INFO along with other statistics')
+    parser.add_argument('--slowlog-threshold', type=int, default=None,
+                        help='microseconds above which a command is kept in the slow log (SLOWLOG), enables --stats')
+    parser.add_argument('--slowlog-max-len', type=int, default=SLOWLOG_MAX_LENGTH,
+                        help='number of commands kept in the slow log (default: %(default)s)')
+
+
+def open_database(args):
+    """Creates a database configured by the command line arguments
+
+    Returns:
+        a tuple, containing an object of type Database and an object of type Persistence,
+        or None if the database is not persisted
+    """
+    database = Database(maxmemory=args.maxmemory, eviction_policy=args.maxmemory_policy, compact=args.compact,
+                        range_index=args.range_index, reverse_index=args.reverse_index, key_index=args.key_index,
+                        engine=args.engine, spill_threshold=args.spill_threshold,
+                        spill_directory=args.spill_directory)
+    persistence = None
+    if args.log or args.snapshot:
+        persistence = Persistence(database, args.log, args.snapshot, args.fsync)
+        persistence.open()
+    return (database, persistence)
+
+
+def open_stats(args):
+    """Creates the statistics configured by the command line arguments
+
+    Returns:
+        an object of type Stats, or None if the statistics are disabled
+    """
+    if args.slowlog_threshold is not None:
+        return Stats(SlowLog(args.slowlog_threshold, args.slowlog_max_len))
+    if args.stats:
+        return Stats()
+    return None
+
+
 def main():
-    DBConsole().listen()
+    parser = argparse.ArgumentParser(description='Simple In-Memory Database')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    database, persistence = open_database(args)
+    try:
+        DBConsole(database, persistence=persistence, stats=open_stats(args)).listen()
+    finally:
+        if persistence is not None:
+            persistence.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
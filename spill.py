@@ -0,0 +1,229 @@
+"""
+Temporary on-disk storage of the Simple Database
+
+    Transactions that modify more keys than fit comfortably in memory move their changes
+    into sorted runs (see SpillingTransactionHandler). A run is an immutable sequence of
+    (key, value) pairs sorted by key, written once to a temporary file and read back
+    through mmap, so the operating system pages it in and out as needed and the process
+    keeps no per-key memory for it. A BloomFilter of the keys of the runs avoids touching
+    them to look up most of the keys that are not there.
+
+    File layout:
+        records:  for each pair, a header '<Ii' with the length of the key and the length
+                  of the value (-1 if the value is None), followed by both encoded as UTF-8
+        padding:  up to 7 zero bytes, so the offsets are aligned
+        offsets:  the offset of each record, as native unsigned 64-bit integers
+        footer:   '<QQ' with the offset of the offsets and the number of records
+
+"""
+
+import array
+import heapq
+import mmap
+import struct
+import tempfile
+
+
+HEADER = struct.Struct('<Ii')
+
+FOOTER = struct.Struct('<QQ')
+
+WRITE_BUFFER_SIZE = 1 << 20
+
+BLOOM_BITS_PER_KEY = 10
+
+BLOOM_HASHES = 3
+
+
+
+class SortedRun(object):
+    """Immutable sequence of (key, value) pairs sorted by key, stored in a temporary file
+
+    Args:
+        items: an iterable of tuples (key, value) sorted by key without repeated keys, being
+               None the value of the keys removed
+        directory: an string, the directory of the temporary file, or None for the default one
+
+    Attributes:
+        file: the temporary file, removed once it is closed
+
+        map: an object of type mmap.mmap of the whole file
+
+        offsets: a memoryview of the offsets of the records within the map
+
+        length: an integer, the number of pairs
+    """
+    __slots__ = ('file', 'map', 'offsets', 'length')
+
+    def __init__(self, items, directory=None):
+        self.file = tempfile.TemporaryFile(dir=directory)
+        offsets = array.array('Q')
+        buffer = bytearray()
+        position = 0
+        write = self.file.write
+        for key, value in items:
+            offsets.append(position + len(buffer))
+            key = key.encode('utf-8')
+            if value is None:
+                buffer += HEADER.pack(len(key), -1)
+                buffer += key
+            else:
+                value = value.encode('utf-8')
+                buffer += HEADER.pack(len(key), len(value))
+                buffer += key
+                buffer += value
+            if len(buffer) >= WRITE_BUFFER_SIZE:
+                write(buffer)
+                position += len(buffer)
+                buffer = bytearray()
+        write(buffer)
+        position += len(buffer)
+
+        padding = -position % 8
+        write(b'\0' * padding)
+        offsets_start = position + padding
+        write(offsets.tobytes())
+        write(FOOTER.pack(offsets_start, len(offsets)))
+        self.file.flush()
+
+        self.length = len(offsets)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets = memoryview(self.map)[offsets_start:offsets_start + 8 * self.length].cast('Q')
+
+    def __len__(self):
+        return self.length
+
+    def read(self, index):
+        """Returns the pair (key, value) at the given position
+
+        Running Time: O(1)
+        """
+        offset = self.offsets[index]
+        key_length, value_length = HEADER.unpack_from(self.map, offset)
+        offset += HEADER.size
+        key = self.map[offset:offset + key_length].decode('utf-8')
+        if value_length < 0:
+            return (key, None)
+        offset += key_length
+        return (key, self.map[offset:offset + value_length].decode('utf-8'))
+
+    def get(self, key):
+        """Fetches the value of a key with a binary search
+
+        Running Time: O(log n)
+        Being 'n' the number of pairs
+
+        Returns:
+            a tuple, containing the value of the key and a boolean that represents the
+            existance of the key in the run, as TransactionHandler.get
+        """
+        low = 0
+        high = self.length
+        while low < high:
+            middle = (low + high) // 2
+            found_key, value = self.read(middle)
+            if found_key < key:
+                low = middle + 1
+            elif found_key > key:
+                high = middle
+            else:
+                return (value, True)
+        return (None, False)
+
+    def keys(self):
+        """Generator that yields every key in order
+
+        Running Time: O(n)
+        """
+        for index in range(self.length):
+            offset = self.offsets[index]
+            key_length = HEADER.unpack_from(self.map, offset)[0]
+            offset += HEADER.size
+            yield self.map[offset:offset + key_length].decode('utf-8')
+
+    def items(self):
+        """Generator that yields every pair (key, value) in order
+
+        Running Time: O(n)
+        """
+        for index in range(self.length):
+            yield self.read(index)
+
+    def close(self):
+        """Unmaps and removes the file"""
+        if self.map is not None:
+            self.offsets.release()
+            self.map.close()
+            self.file.close()
+            self.map = None
+
+
+class BloomFilter(object):
+    """Set of keys that may answer that a key belongs to it when it does not (a false positive)
+
+    Each key sets BLOOM_HASHES bits, at positions derived from its built-in hash, so it is
+    only valid within the process. With BLOOM_BITS_PER_KEY bits per key there are about 2%
+    of false positives while it holds at most 'capacity' keys, and more beyond it.
+
+    Args:
+        capacity: an integer, the number of keys expected
+
+    Attributes:
+        bits: a bytearray with the bits of the filter
+
+        size: an integer, the number of bits
+    """
+    __slots__ = ('bits', 'size')
+
+    def __init__(self, capacity):
+        self.bits = bytearray((capacity * BLOOM_BITS_PER_KEY) // 8 + 1)
+        self.size = len(self.bits) * 8
+
+    def add(self, key):
+        """Adds a key
+
+        Running Time: O(1)
+        """
+        key_hash = hash(key)
+        step = (key_hash >> 32) | 1
+        bits = self.bits
+        for _ in range(BLOOM_HASHES):
+            position = key_hash % self.size
+            bits[position >> 3] |= 1 << (position & 7)
+            key_hash += step
+
+    def __contains__(self, key):
+        """Returns False if the key was never added, or True if it may have been added
+
+        Running Time: O(1)
+        """
+        key_hash = hash(key)
+        step = (key_hash >> 32) | 1
+        bits = self.bits
+        for _ in range(BLOOM_HASHES):
+            position = key_hash % self.size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+            key_hash += step
+        return True
+
+
+def merge_runs(runs):
+    """Generator that yields in order the latest pair (key, value) of every key of several runs
+
+    Running Time: O(n log r)
+    Being 'n' the total number of pairs and 'r' the number of runs
+
+    Args:
+        runs: a list of objects of type SortedRun, from the oldest to the most recent. The
+              value of a key in a run replaces the ones of the older runs
+    """
+    def tagged(run, age):
+        for key, value in run.items():
+            yield (key, age, value)
+
+    latest_key = None
+    for key, age, value in heapq.merge(*[tagged(run, -age) for age, run in enumerate(runs)]):
+        if key != latest_key:
+            latest_key = key
+            yield (key, value)
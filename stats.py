@@ -0,0 +1,353 @@
+"""
+Runtime statistics of the Simple Database
+
+    A Stats object collects, for every command executed by the consoles it is attached to
+    (see DBConsole.enable_stats), the number of calls and a histogram of the latency of each
+    command name, along with the deepest transaction opened and the sizes of the write sets
+    committed. The INFO command prints them with the size of the data.
+
+    Consoles without statistics run their regular execute method, so collecting them costs
+    nothing unless they are enabled: enabling them replaces the execute method of the
+    console with one that measures it.
+
+    Histograms:
+        Values are recorded in HDR style buckets: every power of two is split in SUB_BUCKETS
+        linear buckets, so any value is recorded with a relative error below 1/SUB_BUCKETS
+        (about 6%) using a fixed array of counters, whatever the range of the values.
+        Values lower than 2 * SUB_BUCKETS are recorded exactly.
+
+    Slow log:
+        A SlowLog keeps the latest commands that took longer than a threshold in a ring
+        buffer of fixed length, along with their arguments (truncated), the transaction
+        depth and the number of keys they touched. The consoles compare the latency of
+        every command with the threshold, and only build an entry once it is exceeded.
+
+"""
+
+import time
+
+
+SUB_BUCKET_BITS = 4
+
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+BUCKETS = 64 * SUB_BUCKETS
+
+PERCENTILES = (0.5, 0.99, 0.999)
+
+UNKNOWN_COMMAND = 'UNKNOWN'
+
+SLOWLOG_MAX_LENGTH = 128
+
+SLOWLOG_MAX_ARGUMENTS = 32
+
+SLOWLOG_MAX_ARGUMENT_LENGTH = 128
+
+KEY_COMMANDS = frozenset(['GET', 'SET', 'UNSET', 'EXPIRE', 'SETEX', 'TTL', 'PERSIST'])
+
+
+
+def bucket_of(value):
+    """Returns the index of the bucket of a non negative integer
+
+    Running Time: O(1)
+    """
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    if shift > 0:
+        return (shift << SUB_BUCKET_BITS) + (value >> shift)
+    return value
+
+
+def bucket_range(index):
+    """Returns a tuple with the lowest and the highest value recorded in a bucket"""
+    if index < 2 * SUB_BUCKETS:
+        return (index, index)
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    low = (index - (shift << SUB_BUCKET_BITS)) << shift
+    return (low, low + (1 << shift) - 1)
+
+
+
+class Histogram(object):
+    """Histogram of non negative integers, see the HDR style buckets above
+
+    Only the number of values of each bucket is stored, so recording a value is a single
+    increment and the statistics (mean, percentiles and max) are computed from the buckets,
+    with the same relative error.
+
+    Attributes:
+        counts: a list with the number of values recorded in each bucket
+    """
+    __slots__ = ('counts',)
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+
+    def record(self, value):
+        """Records a value
+
+        Running Time: O(1)
+        """
+        self.counts[bucket_of(value)] += 1
+
+    def count(self):
+        """Returns the number of values recorded
+
+        Running Time: O(b)
+        Being 'b' the number of buckets
+        """
+        return sum(self.counts)
+
+    def mean(self):
+        """Returns the mean of the values recorded, taking the middle of each bucket"""
+        count = 0
+        total = 0
+        for index, bucket_count in enumerate(self.counts):
+            if bucket_count:
+                low, high = bucket_range(index)
+                count += bucket_count
+                total += bucket_count * (low + high) / 2
+        return total / count if count else 0.0
+
+    def percentile(self, fraction):
+        """Returns the highest value of the bucket below which the given fraction (0 to 1) of
+        the values are
+
+        Running Time: O(b)
+        Being 'b' the number of buckets
+        """
+        rank = max(1, int(round(fraction * self.count())))
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bucket_range(index)[1]
+        return 0
+
+    def max(self):
+        """Returns the highest value of the highest bucket holding any value"""
+        for index in range(len(self.counts) - 1, -1, -1):
+            if self.counts[index]:
+                return bucket_range(index)[1]
+        return 0
+
+
+
+class Stats(object):
+    """Statistics of the commands executed by one or several consoles
+
+    Args:
+        slowlog: an object of type SlowLog, or None to log no slow commands
+
+    Attributes:
+        commands: a dictionary mapping each command name to a Histogram of the latency of
+                  its calls, in nanoseconds. Names that are not valid commands are counted
+                  together as UNKNOWN_COMMAND
+
+        latencies: a dictionary mapping each command name to the counts of its Histogram,
+                   so a console records a latency without any function call
+
+        write_sets: a Histogram of the number of keys modified by each transaction committed
+
+        max_depth: an integer, the highest number of transactions opened at once
+
+        started: a float, the time (time.time) the statistics were started or reset
+
+        slowlog: an object of type SlowLog of the consoles, or None
+    """
+    __slots__ = ('commands', 'latencies', 'write_sets', 'max_depth', 'started', 'slowlog')
+
+    def __init__(self, slowlog=None):
+        self.slowlog = slowlog
+        self.commands = {}
+        self.latencies = {}
+        self.reset()
+
+    def reset(self):
+        """Drops all the statistics collected
+
+        The dictionaries are cleared in place, since the consoles keep a reference to them.
+        """
+        self.commands.clear()
+        self.latencies.clear()
+        self.write_sets = Histogram()
+        self.max_depth = 0
+        self.started = time.time()
+
+    def histogram(self, name):
+        """Returns the latency Histogram of a command name, creating it if required"""
+        histogram = self.commands.get(name)
+        if histogram is None:
+            histogram = self.commands[name] = Histogram()
+            self.latencies[name] = histogram.counts
+        return histogram
+
+    def record_depth(self, database):
+        """Updates the deepest transaction with the transactions opened in a database"""
+        depth = transaction_depth(database)
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def info(self, database=None):
+        """Returns a dictionary with all the statistics, and the size of the data of a database
+
+        Latencies are reported in microseconds.
+
+        Args:
+            database: an object of type Database (or Session), or None
+        """
+        info = {
+            'uptime_seconds': int(time.time() - self.started),
+            'commands_processed': sum([histogram.count() for histogram in self.commands.values()]),
+            'transaction_depth_max': self.max_depth,
+            'write_sets_committed': self.write_sets.count(),
+            'write_set_size_mean': self.write_sets.mean(),
+            'write_set_size_p99': self.write_sets.percentile(0.99),
+            'write_set_size_max': self.write_sets.max(),
+            'commands': {}
+        }
+        if self.slowlog is not None:
+            info['slowlog_length'] = len(self.slowlog)
+            info['slowlog_logged'] = self.slowlog.next_id
+        if database is not None:
+            info.update(database_info(database))
+        for name, histogram in sorted(self.commands.items()):
+            command_info = {'calls': histogram.count(), 'mean_us': histogram.mean() / 1000.0}
+            for fraction in PERCENTILES:
+                command_info['p%g_us' % (fraction * 100)] = histogram.percentile(fraction) / 1000.0
+            command_info['max_us'] = histogram.max() / 1000.0
+            info['commands'][name] = command_info
+        return info
+
+
+class SlowLog(object):
+    """Ring buffer with the latest commands slower than a threshold
+
+    Args:
+        threshold: an integer, the microseconds a command must take to be logged
+        max_length: an integer, the number of entries kept, the oldest ones are overwritten
+
+    Attributes:
+        threshold: an integer, the threshold in nanoseconds, compared with the latencies
+
+        entries: a list of max_length slots, each one holding an entry or None. An entry is a
+                 tuple (id, timestamp, microseconds, name, arguments, depth, keys)
+
+        next_id: an integer, the id of the next entry, which is also the number of entries
+                 ever logged since the last reset
+    """
+    __slots__ = ('threshold', 'entries', 'next_id')
+
+    def __init__(self, threshold, max_length=SLOWLOG_MAX_LENGTH):
+        if threshold < 0 or max_length <= 0:
+            raise ValueError('the slow log threshold must be non negative and its length positive')
+        self.threshold = threshold * 1000
+        self.entries = [None] * max_length
+        self.next_id = 0
+
+    def record(self, command, elapsed, depth, keys):
+        """Logs a command, overwriting the oldest entry once the buffer is full
+
+        Running Time: O(a)
+        Being 'a' the number of arguments logged, at most SLOWLOG_MAX_ARGUMENTS
+
+        Args:
+            command: a Command tuple
+            elapsed: an integer, the nanoseconds the command took
+            depth: an integer, the number of transactions opened when it was executed
+            keys: an integer, the number of keys it touched
+        """
+        name, arguments = command
+        logged = [argument[:SLOWLOG_MAX_ARGUMENT_LENGTH] for argument in arguments[:SLOWLOG_MAX_ARGUMENTS]]
+        if len(arguments) > SLOWLOG_MAX_ARGUMENTS:
+            logged[-1] = '... (%d more arguments)' % (len(arguments) - SLOWLOG_MAX_ARGUMENTS + 1)
+        self.entries[self.next_id % len(self.entries)] = (self.next_id, int(time.time()), elapsed // 1000, name,
+                                                         tuple(logged), depth, keys)
+        self.next_id += 1
+
+    def get(self, count=10):
+        """Returns a list with up to count entries, from the most recent one
+
+        Running Time: O(count)
+        """
+        entries = []
+        for entry_id in range(self.next_id - 1, max(self.next_id - len(self.entries), 0) - 1, -1):
+            if len(entries) >= count:
+                break
+            entries.append(self.entries[entry_id % len(self.entries)])
+        return entries
+
+    def __len__(self):
+        return min(self.next_id, len(self.entries))
+
+    def reset(self):
+        """Drops all the entries"""
+        self.entries = [None] * len(self.entries)
+        self.next_id = 0
+
+
+def keys_touched(command):
+    """Returns the number of keys named by the arguments of a command, see SlowLog"""
+    name, arguments = command
+    if name in KEY_COMMANDS:
+        return 1
+    if name == 'MGET':
+        return len(arguments)
+    if name == 'MSET':
+        return len(arguments) // 2
+    return 0
+
+
+def transaction_depth(database):
+    """Returns the number of transactions opened in a database, Session or ShardedDatabase"""
+    handler = getattr(database, 'transaction_handler', None)
+    if handler is not None:
+        return handler.get_active_size()
+    return getattr(database, 'depth', 0)
+
+
+def write_set_size(database):
+    """Returns the number of keys modified by the transactions opened in a database, 0 if it
+    does not hold them itself (such as a ShardedDatabase)"""
+    handler = getattr(database, 'transaction_handler', None)
+    if handler is None:
+        return 0
+    return handler.get_write_set_size()
+
+
+def database_info(database):
+    """Returns a dictionary with the size of the data and the transactions of a database
+
+    Args:
+        database: an object of type Database (or Session). Objects without committed data,
+                  such as a ShardedDatabase, only report the transaction depth
+    """
+    info = {
+        'transaction_depth': transaction_depth(database),
+        'write_set_size': write_set_size(database)
+    }
+    data = getattr(database, 'database', None)
+    if data is not None:
+        info['keys'] = len(data.data)
+        info['values'] = len(data.values_freq)
+        info['expires'] = len(data.expires)
+    return info
+
+
+def format_info(info):
+    """Formats the output of INFO, a line 'name:value' for each statistic and a line
+    'cmdstat_NAME:calls=...,p50_us=...' for each command"""
+    lines = []
+    for name, value in sorted(info.items()):
+        if name == 'commands':
+            continue
+        if isinstance(value, float):
+            value = '%.2f' % value
+        lines.append('%s:%s' % (name, value))
+    for name, command_info in sorted(info.get('commands', {}).items()):
+        fields = ['calls=%d' % command_info['calls']]
+        for field, value in command_info.items():
+            if field != 'calls':
+                fields.append('%s=%.2f' % (field, value))
+        lines.append('cmdstat_%s:%s' % (name, ','.join(fields)))
+    return '\n'.join(lines)
@@ -1,7 +1,57 @@
 from simple_database import Database
 from simple_database import Data
+from simple_database import BoundedData, EVICTION_POLICIES
 from simple_database import TransactionHandler
+from simple_database import DBConsole
+from simple_database import parse_command
+from server import DatabaseServer
+from sharding import ShardedDatabase
+from bulk import FORMATS, export_file, import_file
+from indexes import RangeIndex
+import replication
+from stats import Histogram, SlowLog, Stats, bucket_of, bucket_range
+from persistence import CommandLog, Persistence, open_command_log, read_snapshot
+import asyncio
+import contextlib
+import io
+import os
+import pickle
+import pstats
+import sys
+import tempfile
+import threading
 import unittest
+from collections import Counter
+
+
+INPUT_FILES = [
+	'test_input_1.txt',
+	'test_input_2.txt',
+	'test_input_3.txt',
+	'test_input_4.txt',
+	'test_input_custom_1.txt'
+]
+
+
+def run_interactive(console, commands):
+	"""Runs the commands through read_from_stdin and returns everything printed"""
+	output = io.StringIO()
+	stdin = sys.stdin
+	sys.stdin = io.StringIO(commands)
+	try:
+		with contextlib.redirect_stdout(output):
+			while console.read_from_stdin():
+				pass
+	finally:
+		sys.stdin = stdin
+	return output.getvalue()
+
+
+def run_stream(console, commands):
+	"""Runs the commands through process_stream and returns everything written"""
+	output = io.StringIO()
+	console.process_stream(io.StringIO(commands), output)
+	return output.getvalue()
 
 
 class TestDatabase(unittest.TestCase):
@@ -128,6 +178,1559 @@ class TestDatabase(unittest.TestCase):
 		self.assertEqual(final_data, self.database.database.data)
 		self.assertEqual(final_values_freq, self.database.database.values_freq)
 
+
+class TestBatch(unittest.TestCase):
+
+	def setUp(self):
+		self.database = Database()
+
+	def test_unset_without_transaction(self):
+		self.database.set('a', '1')
+		self.database.unset('a')
+
+		self.assertEqual({}, self.database.database.data)
+		self.assertEqual({}, self.database.database.values_freq)
+
+	def test_mset_mget(self):
+		final_data = {'a': '1', 'c': '1'}
+		final_values_freq = {'1': 2}
+
+		self.database.set('b', '2')
+		self.database.mset({'a': '1', 'b': None, 'c': '1'})
+
+		self.assertEqual(['1', None, '1'], self.database.mget(['a', 'b', 'c']))
+		self.assertEqual(final_data, self.database.database.data)
+		self.assertEqual(final_values_freq, self.database.database.values_freq)
+
+	def test_mset_transaction_rollback(self):
+		final_data = {'a': '1', 'b': '2'}
+		final_values_freq = {'1': 1, '2': 1}
+
+		self.database.mset({'a': '1', 'b': '2'})
+		self.database.begin()
+		self.database.mset({'a': '2', 'c': '2'})
+		self.database.begin()
+		self.database.mset({'b': None, 'c': '3'})
+
+		self.assertEqual(['2', None, '3'], self.database.mget(['a', 'b', 'c']))
+		self.assertEqual([1, 0, 1], self.database.num_equal_to_many(['2', '1', '3']))
+
+		self.database.rollback()
+		self.assertEqual(['2', '2', '2'], self.database.mget(['a', 'b', 'c']))
+		self.assertEqual([3, 0], self.database.num_equal_to_many(['2', '1']))
+
+		self.database.rollback()
+		self.assertEqual(final_data, self.database.database.data)
+		self.assertEqual(final_values_freq, self.database.database.values_freq)
+
+	def test_execute_many(self):
+		commands = [
+			('set', ['a', '0'], None),
+			('set', ['b', '0'], None),
+			('unset', ['a'], None),
+			('num_equal_to', ['0'], 1),
+			('begin', [], None),
+			('set', ['a', '10'], None),
+			('set', ['c', '10'], None),
+			('mget', [['a', 'b', 'c']], ['10', '0', '10']),
+			('num_equal_to_many', [['0', '10']], [1, 2]),
+			('commit', [], True),
+			('get', ['c'], '10')
+		]
+		final_data = {'a': '10', 'b': '0', 'c': '10'}
+		final_values_freq = {'0': 1, '10': 2}
+
+		results = self.database.execute_many([(method, arguments) for (method, arguments, output) in commands])
+
+		self.assertEqual([output for (method, arguments, output) in commands], results)
+		self.assertEqual(final_data, self.database.database.data)
+		self.assertEqual(final_values_freq, self.database.database.values_freq)
+
+	def test_compact_values_are_shared(self):
+		database = Database(compact=True)
+		database.set('a', ''.join(['1', '0']))
+		database.mset({'b': ''.join(['1', '0']), 'c': None})
+		database.begin()
+		database.set('c', ''.join(['1', '0']))
+		database.commit()
+
+		data = database.database.data
+		self.assertIs(data['a'], data['b'])
+		self.assertIs(data['a'], data['c'])
+		self.assertEqual({'10': 3}, database.database.values_freq)
+		self.assertFalse(hasattr(database, '__dict__'))
+		self.assertFalse(hasattr(database.database, '__dict__'))
+
+	def test_console_batch_commands(self):
+		commands = 'MSET a 1 b 2 c 1\nMGET a b d\nNUMEQUALTO 1 2 3\nMSET a\n'
+		output = '1\n2\nNULL\n2\n1\n0\nInvalid method or number of arguments\n'
+		self.assertEqual(output, run_stream(DBConsole(), commands))
+
+
+class TestSession(unittest.TestCase):
+
+	def setUp(self):
+		self.database = Database()
+		self.first = self.database.session()
+		self.second = self.database.session()
+
+	def test_isolated_transactions(self):
+		self.database.set('a', '1')
+		self.first.begin()
+		self.first.set('a', '2')
+		self.second.begin()
+		self.second.unset('a')
+
+		self.assertEqual('2', self.first.get('a'))
+		self.assertIsNone(self.second.get('a'))
+		self.assertEqual('1', self.database.get('a'))
+		self.assertEqual(1, self.first.num_equal_to('2'))
+		self.assertEqual(0, self.second.num_equal_to('1'))
+		self.assertEqual(1, self.database.num_equal_to('1'))
+
+		self.assertTrue(self.second.rollback())
+		self.assertFalse(self.second.rollback())
+		self.assertTrue(self.first.commit())
+		self.assertEqual('2', self.second.get('a'))
+
+	def test_idle_session_has_no_transaction_data(self):
+		self.assertIsNone(self.first.transaction_handler)
+		self.first.begin()
+		self.first.set('a', '1')
+		self.first.commit()
+		self.assertIsNone(self.first.transaction_handler)
+		self.assertEqual('1', self.second.get('a'))
+
+	def test_commit_after_concurrent_change(self):
+		final_data = {'a': '3', 'b': '2'}
+		final_values_freq = {'3': 1, '2': 1}
+
+		self.database.set('a', '1')
+		self.first.begin()
+		self.first.set('a', '3')
+		self.first.set('b', '2')
+		self.second.set('a', '2')
+		self.first.commit()
+
+		self.assertEqual(final_data, self.database.database.data)
+		self.assertEqual(final_values_freq, self.database.database.values_freq)
+
+	def test_interleaved_sessions_on_one_key(self):
+		for database in (Database(), Database(thread_safe=True), Database(maxmemory=1 << 20), Database(range_index=True),
+						 Database(spill_threshold=1)):
+			first = database.session()
+			second = database.session()
+			database.set('k', '0')
+			first.begin()
+			first.set('k', '1')
+			first.begin()
+			first.set('k', '5')
+			second.begin()
+			second.set('k', '2')
+			second.commit()
+			self.assertEqual([0, 0, 1], first.num_equal_to_many(['0', '2', '5']))
+
+			first.rollback()
+			second.set('k', '3')
+			self.assertEqual([0, 0, 1, 0], first.num_equal_to_many(['0', '2', '1', '3']))
+			self.assertEqual(1, first.num_equal_to('1'))
+			first.set('other', '3')
+			self.assertEqual(1, first.num_equal_to('3'))
+			if database.database.indexes:
+				self.assertEqual(1, first.num_range(1, 1))
+				self.assertEqual(2, first.num_range(0, 10))
+
+			first.commit()
+			self.assertEqual({'1': 1, '3': 1}, dict(database.database.values_freq))
+			self.assertEqual([1, 1, 0], second.num_equal_to_many(['1', '3', '2']))
+			self.assertEqual(set(), database.database.handlers)
+
+
+class TestMVCC(unittest.TestCase):
+
+	def setUp(self):
+		self.database = Database(mvcc=True)
+
+	def test_transaction_reads_snapshot(self):
+		self.database.mset({'a': '1', 'b': '1'})
+		session = self.database.session()
+		session.begin()
+		session.set('c', '2')
+
+		self.database.mset({'a': '2', 'b': None})
+
+		self.assertEqual(['1', '1', '2'], session.mget(['a', 'b', 'c']))
+		self.assertEqual([2, 1], session.num_equal_to_many(['1', '2']))
+		self.assertEqual(['2', None], self.database.mget(['a', 'b']))
+		self.assertEqual(1, self.database.num_equal_to('2'))
+
+		session.commit()
+		self.assertEqual({'a': '2', 'c': '2'}, self.database.database.data)
+		self.assertEqual({'2': 2}, self.database.database.values_freq)
+
+	def test_versions_are_collected(self):
+		self.database.set('a', '1')
+		snapshot = self.database.database.read_view()
+		self.database.set('a', '2')
+		self.database.set('a', '3')
+
+		self.assertEqual('1', snapshot.get('a'))
+		self.assertEqual(1, snapshot.num_equal_to('1'))
+		self.assertEqual(0, snapshot.num_equal_to('3'))
+		self.assertEqual(2, len(self.database.database.history['a']))
+
+		snapshot.close()
+		self.database.set('a', '4')
+		self.assertEqual({}, self.database.database.history)
+		self.assertEqual({}, self.database.database.freq_history)
+
+	def test_readers_never_see_partial_commits(self):
+		keys = ['key%d' % index for index in range(200)]
+		self.database.mset(dict.fromkeys(keys, '0'))
+		errors = []
+
+		def write():
+			for value in range(1, 200):
+				self.database.mset(dict.fromkeys(keys, str(value)))
+
+		def read():
+			for _ in range(200):
+				values = set(self.database.mget(keys))
+				if len(values) != 1:
+					errors.append(values)
+
+		threads = [threading.Thread(target=write), threading.Thread(target=read)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual([], errors)
+		self.assertEqual({'199': 200}, self.database.database.values_freq)
+
+
+class TestThreadSafe(unittest.TestCase):
+
+	def test_exclusive_with_mvcc(self):
+		self.assertRaises(ValueError, Database, mvcc=True, thread_safe=True)
+
+	def test_concurrent_writers(self):
+		database = Database(thread_safe=True, stripes=8)
+		keys = ['key%d' % index for index in range(50)]
+
+		def write(seed):
+			session = database.session()
+			for index in range(2000):
+				key = keys[(index * seed) % len(keys)]
+				if index % 7 == 0:
+					session.unset(key)
+				elif index % 5 == 0:
+					session.begin()
+					session.set(key, str(index % 3))
+					session.set(keys[index % len(keys)], str(seed))
+					session.commit()
+				else:
+					session.set(key, str(index % 4))
+
+		threads = [threading.Thread(target=write, args=(seed,)) for seed in range(1, 5)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		data = database.database.data
+		values_freq = {}
+		for value in data.values():
+			values_freq[value] = values_freq.get(value, 0) + 1
+
+		self.assertEqual(values_freq, dict(database.database.values_freq))
+		for value, freq in values_freq.items():
+			self.assertEqual(freq, database.num_equal_to(value))
+
+	def test_expiry_never_undoes_a_concurrent_set(self):
+		database = Database(thread_safe=True, stripes=4)
+		data = database.database
+		clock = [0.0]
+		data.clock = lambda: clock[0]
+		keys = ['key%d' % index for index in range(200)]
+		database.mset(dict.fromkeys(keys, '1'))
+		for key in keys:
+			database.expire(key, 1)
+		deadlines = dict(data.expires)
+		clock[0] = 2.0
+
+		# the keys are set again after expire_due found them due, but before it removes them
+		database.mset(dict.fromkeys(keys, '2'))
+		removed = [data.remove_expired(key, deadlines[key]) for key in keys]
+		self.assertEqual([False] * len(keys), removed)
+		self.assertEqual(len(keys), database.num_equal_to('2'))
+
+		database.expire('key0', 1)
+		clock[0] = 4.0
+		threads = [threading.Thread(target=data.expire_due) for _ in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertIsNone(database.get('key0'))
+		self.assertEqual(len(keys) - 1, database.num_equal_to('2'))
+		self.assertEqual({}, data.expires)
+
+
+class TestSharding(unittest.TestCase):
+
+	def setUp(self):
+		self.database = ShardedDatabase(3)
+
+	def tearDown(self):
+		self.database.close()
+
+	def test_same_output_as_database(self):
+		for filename in INPUT_FILES:
+			with open(filename) as input_file:
+				commands = input_file.read()
+
+			self.assertEqual(run_stream(DBConsole(), commands), run_stream(DBConsole(self.database), commands))
+
+	def test_scatter_gather(self):
+		keys = ['key%d' % index for index in range(30)]
+		self.database.mset(dict((key, str(index % 3)) for index, key in enumerate(keys)))
+
+		self.assertEqual(['0', '1', '2', None], self.database.mget(['key0', 'key1', 'key2', 'other']))
+		self.assertEqual([10, 10, 10, 0], self.database.num_equal_to_many(['0', '1', '2', '3']))
+		self.assertEqual(len(self.database.shards), len(set(self.database.shard_of(key) for key in keys)))
+
+	def test_cross_shard_transaction(self):
+		keys = ['key%d' % index for index in range(30)]
+		self.database.begin()
+		self.database.mset(dict.fromkeys(keys, '1'))
+		self.database.begin()
+		self.database.unset('key0')
+		self.assertEqual(29, self.database.num_equal_to('1'))
+		self.database.rollback()
+		self.assertEqual(30, self.database.num_equal_to('1'))
+		self.assertTrue(self.database.commit())
+		self.assertFalse(self.database.commit())
+		self.assertEqual(30, self.database.num_equal_to('1'))
+
+	def test_abort_when_a_shard_fails(self):
+		keys = ['key%d' % index for index in range(30)]
+		self.database.begin()
+		self.database.mset(dict.fromkeys(keys, '1'))
+		failed = self.database.shards[0]
+		failed.process.terminate()
+		failed.process.join()
+
+		self.assertFalse(self.database.commit())
+		alive = [key for key in keys if self.database.shard_of(key) is not failed]
+		self.assertEqual([None] * len(alive), self.database.mget(alive))
+
+	def test_abort_when_a_shard_votes_no(self):
+		keys = ['key%d' % index for index in range(30)]
+		self.database.mset({'key0': '0'})
+		console = DBConsole(self.database)
+		run_stream(console, 'BEGIN\nBEGIN\nMSET %s\n' % ' '.join('%s 1' % key for key in keys))
+		# a shard that lost a block behind the back of the coordinator votes no
+		diverged = self.database.shard_of('key0')
+		diverged.call('rollback')
+
+		self.assertEqual('ERR transaction aborted\n', run_stream(console, 'COMMIT\n'))
+		self.assertFalse(self.database.is_transaction_active())
+		self.assertEqual('0', self.database.get('key0'))
+		self.assertEqual(1, self.database.num_equal_to('0'))
+		self.assertEqual(0, self.database.num_equal_to('1'))
+		self.assertEqual('NO TRANSACTION\n', run_stream(console, 'COMMIT\n'))
+
+
+class TestCommandLog(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.directory.name, 'commands.log')
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def read_log(self):
+		with open(self.path) as log_file:
+			return log_file.read()
+
+	def test_log_committed_changes(self):
+		final_log = 'SET a 1\nBEGIN\nSET b 2\nUNSET a\nCOMMIT\n'
+
+		database = Database()
+		command_log = open_command_log(database, self.path, 'always')
+		database.set('a', '1')
+		database.set('a', '1')
+		database.begin()
+		database.set('c', '3')
+		database.rollback()
+		database.begin()
+		database.set('b', '2')
+		database.begin()
+		database.unset('a')
+		database.commit()
+		database.begin()
+		database.set('d', '4')
+		command_log.close()
+
+		self.assertEqual(final_log, self.read_log())
+
+	def test_recover(self):
+		final_data = {'b': '2', 'c': '2'}
+		final_values_freq = {'2': 2}
+
+		database = Database()
+		command_log = open_command_log(database, self.path, 'never')
+		database.mset({'a': '1', 'b': '1'})
+		database.set('b', '2')
+		database.begin()
+		database.unset('a')
+		database.set('c', '2')
+		database.commit()
+		command_log.close()
+
+		recovered = Database()
+		open_command_log(recovered, self.path).close()
+
+		self.assertEqual(final_data, recovered.database.data)
+		self.assertEqual(final_values_freq, recovered.database.values_freq)
+
+	def test_recover_interrupted_write(self):
+		with open(self.path, 'w') as log_file:
+			log_file.write('SET a 1\nBEGIN\nSET b 2\nCOMMIT\nBEGIN\nSET a 3\nSET c')
+
+		database = Database()
+		command_log = open_command_log(database, self.path, 'always')
+		database.set('d', '4')
+		command_log.close()
+
+		self.assertEqual({'a': '1', 'b': '2', 'd': '4'}, database.database.data)
+		self.assertEqual('SET a 1\nBEGIN\nSET b 2\nCOMMIT\nSET d 4\n', self.read_log())
+
+	def test_group_commit(self):
+		database = Database()
+		command_log = open_command_log(database, self.path, 'always')
+		with command_log.group():
+			database.set('a', '1')
+			database.set('b', '2')
+			self.assertEqual('', self.read_log())
+		self.assertEqual('SET a 1\nSET b 2\n', self.read_log())
+		command_log.close()
+
+	def test_invalid_fsync_policy(self):
+		self.assertRaises(ValueError, CommandLog, self.path, 'sometimes')
+
+
+class TestSnapshot(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.log_path = os.path.join(self.directory.name, 'commands.log')
+		self.snapshot_path = os.path.join(self.directory.name, 'data.snapshot')
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def open_database(self):
+		database = Database()
+		persistence = Persistence(database, self.log_path, self.snapshot_path, 'never')
+		persistence.open()
+		return (database, persistence)
+
+	def test_save_compacts_log(self):
+		database, persistence = self.open_database()
+		database.mset({'a': '1', 'b': '1'})
+		database.begin()
+		database.set('c', '1')
+
+		self.assertTrue(persistence.save())
+		self.assertEqual(({'a': '1', 'b': '1'}, {'1': 2}), read_snapshot(self.snapshot_path))
+		self.assertEqual(0, os.path.getsize(self.log_path))
+
+		database.commit()
+		database.unset('a')
+		persistence.close()
+
+		recovered, persistence = self.open_database()
+		persistence.close()
+		self.assertEqual({'b': '1', 'c': '1'}, recovered.database.data)
+		self.assertEqual({'1': 2}, recovered.database.values_freq)
+
+	def test_bgsave(self):
+		database, persistence = self.open_database()
+		database.mset({'a': '1', 'b': '2'})
+
+		self.assertTrue(persistence.bgsave())
+		database.set('a', '3')
+		persistence.wait()
+		self.assertEqual(({'a': '1', 'b': '2'}, {'1': 1, '2': 1}), read_snapshot(self.snapshot_path))
+		self.assertEqual([self.log_path], [os.path.join(self.directory.name, name) for name in os.listdir(self.directory.name) if name.startswith('commands')])
+		persistence.close()
+
+		recovered, persistence = self.open_database()
+		persistence.close()
+		self.assertEqual({'a': '3', 'b': '2'}, recovered.database.data)
+		self.assertEqual({'3': 1, '2': 1}, recovered.database.values_freq)
+
+	def test_console_save(self):
+		database, persistence = self.open_database()
+		console = DBConsole(database, persistence=persistence)
+		self.assertEqual('OK\nBackground saving started\n', run_stream(console, 'SET a 1\nSAVE\nSET b 2\nBGSAVE\n'))
+		persistence.wait()
+		self.assertEqual(({'a': '1', 'b': '2'}, {'1': 1, '2': 1}), read_snapshot(self.snapshot_path))
+		persistence.close()
+
+	def test_recover_rotated_log(self):
+		database, persistence = self.open_database()
+		database.mset({'a': '1', 'b': '2'})
+		persistence.save()
+		database.set('a', '2')
+		database.unset('b')
+		persistence.close()
+
+		# a crash while a snapshot is being written leaves the rotated log behind
+		database, persistence = self.open_database()
+		persistence.rotate_log()
+		persistence.command_log.on_commit([('c', None, '3')])
+		persistence.close()
+
+		recovered, persistence = self.open_database()
+		persistence.close()
+		self.assertEqual({'a': '2', 'c': '3'}, recovered.database.data)
+		self.assertEqual({'2': 1, '3': 1}, recovered.database.values_freq)
+
+
+class TestServer(unittest.TestCase):
+
+	async def exchange(self, server, chunks, replies):
+		"""Sends each chunk to a new connection and returns the reply lines and the final read"""
+		address = server.sockets[0].getsockname()
+		reader, writer = await asyncio.open_connection(address[0], address[1])
+		for chunk in chunks:
+			writer.write(chunk)
+			await writer.drain()
+		lines = [await reader.readline() for _ in range(replies)]
+		rest = await reader.read()
+		writer.close()
+		return (lines, rest)
+
+	def run_server(self, test):
+		async def run():
+			database = Database()
+			server = await DatabaseServer(database).start('127.0.0.1', 0)
+			async with server:
+				return await test(server, database)
+		return asyncio.run(run())
+
+	def test_pipelined_commands(self):
+		chunks = [b'SET a 10\nSET b 10\nGE', b'T a\nNUMEQUALTO 10\nROLLBACK\n', b'FOO\nEND\nGET a\n']
+		final_lines = [b'10\n', b'2\n', b'NO TRANSACTION\n', b'Invalid method or number of arguments\n']
+
+		async def test(server, database):
+			return await self.exchange(server, chunks, 4)
+
+		lines, rest = self.run_server(test)
+		self.assertEqual(final_lines, lines)
+		self.assertEqual(b'', rest)
+
+	def test_connections_share_database(self):
+		async def test(server, database):
+			await self.exchange(server, [b'SET a 1\nEND\n'], 0)
+			return await self.exchange(server, [b'GET a\nEND\n'], 1)
+
+		lines, rest = self.run_server(test)
+		self.assertEqual([b'1\n'], lines)
+
+	def test_connection_transactions(self):
+		async def test(server, database):
+			address = server.sockets[0].getsockname()
+			first_reader, first = await asyncio.open_connection(address[0], address[1])
+			first.write(b'BEGIN\nSET a 1\nGET a\n')
+			await first.drain()
+			first_lines = [await first_reader.readline()]
+			second_lines, rest = await self.exchange(server, [b'GET a\nROLLBACK\nEND\n'], 2)
+			first.write(b'COMMIT\nEND\n')
+			await first.drain()
+			await first_reader.read()
+			first.close()
+			return (first_lines, second_lines, database.get('a'))
+
+		first_lines, second_lines, value = self.run_server(test)
+		self.assertEqual([b'1\n'], first_lines)
+		self.assertEqual([b'NULL\n', b'NO TRANSACTION\n'], second_lines)
+		self.assertEqual('1', value)
+
+	def test_undo_engine_rejected(self):
+		self.assertRaises(ValueError, DatabaseServer, Database(engine='undo'))
+
+	def test_failed_connection_is_released(self):
+		async def run():
+			database_server = DatabaseServer(Database())
+			database_server.create_console = lambda: 1 / 0
+			server = await database_server.start('127.0.0.1', 0)
+			async with server:
+				address = server.sockets[0].getsockname()
+				reader, writer = await asyncio.open_connection(address[0], address[1])
+				try:
+					rest = await reader.read()
+				except ConnectionError:
+					rest = b''
+				writer.close()
+				for _ in range(100):
+					if not database_server.connections:
+						break
+					await asyncio.sleep(0.01)
+				return (rest, database_server.connections)
+
+		self.assertEqual((b'', 0), asyncio.run(run()))
+
+	def test_file_commands_disabled(self):
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, 'data.csv')
+			with open(path, 'w') as output_file:
+				output_file.write('a,1\n')
+			commands = ('LOAD %s\nIMPORT %s\nEXPORT %s\nPROFILE START cprofile %s\nPROFILE STOP\nGET a\nEND\n' %
+						(path, path, path, path)).encode('utf-8')
+
+			async def test(server, database):
+				return await self.exchange(server, [commands], 6)
+
+			lines, rest = self.run_server(test)
+			self.assertEqual([b'ERR file commands are disabled, start the server with --allow-file-commands\n'] * 5 +
+							 [b'NULL\n'], lines)
+			with open(path) as input_file:
+				self.assertEqual('a,1\n', input_file.read())
+
+	def test_disconnect_rolls_back(self):
+		async def run(database):
+			database_server = DatabaseServer(database)
+			server = await database_server.start('127.0.0.1', 0)
+			async with server:
+				address = server.sockets[0].getsockname()
+				reader, writer = await asyncio.open_connection(address[0], address[1])
+				writer.write(b'BEGIN\nSET a 1\nGET a\n')
+				await reader.readline()
+				opened = len(database.database.handlers)
+				writer.close()
+				while database_server.connections:
+					await asyncio.sleep(0.01)
+				return opened
+
+		for database in (Database(), Database(mvcc=True)):
+			self.assertEqual(1, asyncio.run(run(database)))
+			self.assertEqual(set(), database.database.handlers)
+			self.assertIsNone(database.get('a'))
+		self.assertEqual({}, database.database.snapshots)
+
+
+class TestExpiry(unittest.TestCase):
+
+	def setUp(self):
+		self.now = 100.0
+		self.database = Database()
+		self.database.database.clock = lambda: self.now
+
+	def test_expire_ttl_persist(self):
+		self.database.set('a', '1')
+		self.assertFalse(self.database.expire('b', 10))
+		self.assertTrue(self.database.expire('a', 10))
+		self.assertEqual(10, self.database.ttl('a'))
+		self.assertEqual(-2, self.database.ttl('b'))
+		self.now += 2.5
+		self.assertEqual(8, self.database.ttl('a'))
+		self.assertTrue(self.database.persist('a'))
+		self.assertEqual(-1, self.database.ttl('a'))
+		self.assertFalse(self.database.persist('a'))
+
+		self.database.expire('a', 10)
+		self.database.set('a', '2')
+		self.assertEqual(-1, self.database.ttl('a'))
+
+	def test_lazy_and_active_expiry(self):
+		self.database.mset({'a': '1', 'b': '1', 'c': '1', 'd': '2'})
+		for key in ('a', 'b', 'c'):
+			self.database.expire(key, 5)
+		self.now += 5
+		self.assertIsNone(self.database.get('a'))
+		self.assertEqual({'b': '1', 'c': '1', 'd': '2'}, self.database.database.data)
+
+		self.assertEqual(1, self.database.expire_due(limit=1))
+		self.assertEqual(2, len(self.database.database.data))
+		self.assertEqual(0, self.database.num_equal_to('1'))
+		self.assertEqual({'d': '2'}, self.database.database.data)
+		self.assertEqual({'2': 1}, self.database.database.values_freq)
+		self.assertEqual(0, self.database.expire_due())
+
+	def test_keys_modified_by_transactions_are_pinned(self):
+		session = self.database.session()
+		self.database.mset({'a': '1', 'b': '1'})
+		self.database.expire('a', 5)
+		self.database.expire('b', 5)
+		session.begin()
+		session.set('a', '2')
+		self.now += 5
+
+		self.assertEqual(1, self.database.expire_due())
+		self.assertEqual({'a': '1'}, self.database.database.data)
+		self.assertEqual(1, session.num_equal_to('2'))
+		self.assertEqual(0, session.num_equal_to('1'))
+		session.rollback()
+		self.assertIsNone(self.database.get('a'))
+		self.assertEqual({}, self.database.database.values_freq)
+
+	def test_keys_shadowed_by_transactions(self):
+		for database in (self.database, Database(engine='undo'), Database(mvcc=True)):
+			database.database.clock = lambda: self.now
+			console = DBConsole(database)
+			commands = 'SET b 1\nEXPIRE b 100\nSET c 1\nEXPIRE c 50\nBEGIN\nSET a 1\nEXPIRE a 100\nTTL a\nUNSET b\n' \
+					   'TTL b\nGET b\nPERSIST b\nEXPIRE b 10\nSET c 2\nTTL c\nPERSIST c\nSET d 1\nUNSET d\nTTL d\n'
+			self.assertEqual('1\n1\nERR EXPIRE is not allowed for a key modified within the transaction\n-1\n-2\n'
+							 'NULL\n0\nERR EXPIRE is not allowed for a key modified within the transaction\n-1\n0\n-2\n',
+							 run_stream(console, commands))
+			self.assertEqual('100\n50\n', run_stream(console, 'ROLLBACK\nTTL b\nTTL c\n'))
+
+	def test_console_commands(self):
+		console = DBConsole(self.database)
+		self.assertIsNone(console.execute(parse_command('SETEX a 10 1')))
+		self.assertEqual('10', console.execute(parse_command('TTL a')))
+		self.assertEqual('1', console.execute(parse_command('PERSIST a')))
+		self.assertEqual('1', console.execute(parse_command('EXPIRE a 0')))
+		self.assertEqual('NULL', console.execute(parse_command('GET a')))
+		self.assertEqual('ERR value is not an integer', console.execute(parse_command('EXPIRE a x')))
+		console.execute(parse_command('BEGIN'))
+		self.assertEqual('ERR SETEX is not allowed within a transaction', console.execute(parse_command('SETEX a 10 1')))
+
+
+class TestEviction(unittest.TestCase):
+
+	def create(self, policy, keys):
+		size = BoundedData.size_of('k00', 'v0')
+		database = Database(maxmemory=size * keys, eviction_policy=policy)
+		database.database.samples = 50
+		database.database.random.seed(0)
+		return database
+
+	def assertConsistent(self, database):
+		data = database.database
+		self.assertLessEqual(data.used_memory, data.maxmemory)
+		self.assertEqual(dict(Counter(data.data.values())), data.values_freq)
+		self.assertEqual(sorted(data.data), sorted(data.keys))
+
+	def test_invalid_configuration(self):
+		self.assertRaises(ValueError, Database, maxmemory=100, mvcc=True)
+		self.assertRaises(ValueError, Database, maxmemory=100, eviction_policy='fifo')
+
+	def test_lru_evicts_least_recently_used(self):
+		database = self.create('lru', 10)
+		for index in range(10):
+			database.set('k%02d' % index, 'v%d' % (index % 3))
+		database.get('k00')
+		database.set('k10', 'v1')
+
+		self.assertIsNone(database.get('k01'))
+		self.assertEqual('v0', database.get('k00'))
+		self.assertEqual(1, database.memory_stats()['evicted_keys'])
+		self.assertConsistent(database)
+
+	def test_policies_keep_frequencies_exact(self):
+		for policy in EVICTION_POLICIES:
+			database = self.create(policy, 20)
+			for index in range(100):
+				database.mset({'k%02d' % index: 'v%d' % (index % 3), 'k%02d' % (index // 2): 'v1'})
+				database.get('k%02d' % (index // 3))
+			self.assertEqual(20, len(database.database.data))
+			self.assertConsistent(database)
+
+	def test_ttl_first(self):
+		database = self.create('ttl', 3)
+		database.mset({'k00': 'v0', 'k01': 'v0', 'k02': 'v0'})
+		database.expire('k02', 100)
+		database.expire('k01', 50)
+		database.set('k03', 'v0')
+		self.assertEqual(['k00', 'k02', 'k03'], sorted(database.database.data))
+
+	def test_pinned_keys_are_not_evicted(self):
+		database = self.create('random', 2)
+		session = database.session()
+		database.mset({'k00': 'v0', 'k01': 'v0'})
+		session.begin()
+		session.set('k00', 'v1')
+		session.set('k01', 'v1')
+		database.set('k02', 'v0')
+		self.assertEqual(['k00', 'k01'], sorted(database.database.data))
+
+		session.commit()
+		database.set('k02', 'v0')
+		self.assertEqual(2, len(database.database.data))
+		self.assertConsistent(database)
+
+	def test_snapshot_is_plain_dictionary(self):
+		database = self.create('lru', 10)
+		database.set('k00', 'v0')
+		self.assertIs(dict, type(pickle.loads(pickle.dumps(database.database.data))))
+		console = DBConsole(database)
+		self.assertIn('evicted_keys:0', console.execute(parse_command('MEMORY')).split('\n'))
+
+
+class TestRangeIndex(unittest.TestCase):
+
+	def setUp(self):
+		self.database = Database(range_index=True)
+		self.database.mset({'a': '1', 'b': '2.5', 'c': '10', 'd': 'x', 'e': '2.5'})
+
+	def test_numeric_and_lexicographic_ranges(self):
+		self.assertEqual(3, self.database.num_range(1, 2.5))
+		self.assertEqual(1, self.database.num_greater_than(2.5))
+		self.assertEqual(0, self.database.num_range(11, 20))
+		self.assertEqual(4, self.database.lex_range('1', '2.5'))
+		self.assertEqual(1, self.database.lex_range('a', 'z'))
+
+		self.database.unset('c')
+		self.database.set('b', '7')
+		self.database.set('f', '-3')
+		self.assertEqual(2, self.database.num_greater_than(1))
+		self.assertEqual(4, self.database.num_range('-inf', 'inf'))
+
+	def test_transaction_deltas(self):
+		self.database.begin()
+		self.database.set('a', '3')
+		self.database.unset('c')
+		self.database.set('g', '4')
+		self.assertEqual(4, self.database.num_range(2, 5))
+		self.assertEqual(0, self.database.num_greater_than(5))
+		self.database.rollback()
+		self.assertEqual(2, self.database.num_range(2, 5))
+
+	def test_blocks_split_and_emptied(self):
+		index = RangeIndex(numeric=True)
+		index.BLOCK_SIZE = 2
+		data = {}
+		for step in range(300):
+			key = 'k%d' % (step * 7 % 40)
+			value = str(step * 13 % 50) if step % 5 else None
+			index.on_commit([(key, data.get(key), value)])
+			if value is None:
+				data.pop(key, None)
+			else:
+				data[key] = value
+			low, high = step % 30, step % 30 + step % 17
+			expected = sum(1 for value in data.values() if low < float(value) <= high)
+			self.assertEqual(expected, index.count(low, high, low_inclusive=False))
+		self.assertTrue(all(0 < len(block) <= 4 for block in index.blocks))
+		self.assertEqual(len(data), index.count())
+
+	def test_rebuilt_on_load(self):
+		self.database.database.load({'a': '5', 'b': '6'}, {'5': 1, '6': 1})
+		self.assertEqual(2, self.database.num_greater_than(0))
+		self.assertIsNone(Database().num_range(0, 1))
+
+	def test_console_commands(self):
+		console = DBConsole(self.database)
+		self.assertEqual('3', console.execute(parse_command('NUMRANGE 1 2.5')))
+		self.assertEqual('1', console.execute(parse_command('NUMGREATERTHAN 2.5')))
+		self.assertEqual('1', console.execute(parse_command('LEXRANGE a z')))
+		self.assertEqual('ERR value is not a number', console.execute(parse_command('NUMRANGE a 2')))
+		self.assertEqual('ERR range index disabled', DBConsole().execute(parse_command('NUMGREATERTHAN 2')))
+
+
+class TestReverseIndex(unittest.TestCase):
+
+	def setUp(self):
+		self.database = Database(reverse_index=True)
+		self.database.mset(dict(('k%03d' % index, str(index % 2)) for index in range(200)))
+
+	def test_keys_with_value(self):
+		self.assertEqual(100, len(set(self.database.keys_with_value('1', count=7))))
+		self.database.set('k001', '0')
+		self.database.unset('k003')
+		keys = set(self.database.keys_with_value('1'))
+		self.assertEqual(98, len(keys))
+		self.assertNotIn('k001', keys)
+		self.assertEqual([], list(self.database.keys_with_value('2')))
+		self.assertRaises(ValueError, list, Database().keys_with_value('1'))
+
+	def test_scan_while_modifying(self):
+		seen = []
+		cursor, keys = self.database.scan_keys_with_value('0', 0, 10)
+		seen.extend(keys)
+		for index in range(0, 200, 2):
+			if 'k%03d' % index not in seen:
+				self.database.set('k%03d' % index, '1')
+			if len(seen) + index // 2 > 90:
+				break
+		while cursor:
+			cursor, keys = self.database.scan_keys_with_value('0', cursor, 10)
+			seen.extend(keys)
+		self.assertTrue(set(seen) >= set(self.database.keys_with_value('0')))
+
+	def test_transaction_overlay(self):
+		self.database.begin()
+		self.database.set('k001', '0')
+		self.database.set('k002', '1')
+		self.database.set('new', '0')
+		keys = set(self.database.keys_with_value('0'))
+		self.assertEqual(101, len(keys))
+		self.assertIn('new', keys)
+		self.assertNotIn('k002', keys)
+		self.database.rollback()
+		self.assertEqual(100, len(set(self.database.keys_with_value('0'))))
+
+	def test_console_commands(self):
+		console = DBConsole(Database(reverse_index=True))
+		console.execute(parse_command('MSET a 1 b 2 c 1'))
+		self.assertEqual('a\nc', console.execute(parse_command('KEYSWITHVALUE 1')))
+		self.assertIsNone(console.execute(parse_command('KEYSWITHVALUE 3')))
+		cursor, key = console.execute(parse_command('SCANVALUE 1 0 1')).split('\n')
+		self.assertEqual('a', key)
+		self.assertEqual('0\nc', console.execute(parse_command('SCANVALUE 1 %s 1' % cursor)))
+		self.assertEqual('ERR reverse index disabled', DBConsole().execute(parse_command('KEYSWITHVALUE 1')))
+
+
+class TestKeyIndex(unittest.TestCase):
+
+	def setUp(self):
+		self.database = Database(key_index=True)
+		self.database.mset(dict(('user:%03d' % index, '1') for index in range(100)))
+		self.database.mset({'item:1': '1', 'item:2': '2'})
+
+	def test_prefix_and_pattern(self):
+		self.assertEqual(['item:1', 'item:2'], list(self.database.keys_with_prefix('item:')))
+		self.assertEqual(['user:010', 'user:020'], list(self.database.keys('user:0[12]0')))
+		self.assertEqual(102, len(list(self.database.keys('*'))))
+		self.assertRaises(ValueError, list, Database().keys('*'))
+
+	def test_scan_while_modifying(self):
+		seen = []
+		cursor, keys = self.database.scan(None, 'user:*', 30)
+		seen.extend(keys)
+		self.database.unset('user:000')
+		self.database.unset('user:099')
+		self.database.set('user:050a', '1')
+		while cursor is not None:
+			cursor, keys = self.database.scan(cursor, 'user:*', 30)
+			seen.extend(keys)
+		self.assertEqual(seen, sorted(set(seen)))
+		self.assertEqual(100, len(seen))
+		self.assertIn('user:050a', seen)
+		self.assertNotIn('user:099', seen)
+
+	def test_transaction_layers(self):
+		self.database.begin()
+		self.database.unset('item:1')
+		self.database.begin()
+		self.database.set('item:0', '3')
+		self.assertEqual(['item:0', 'item:2'], list(self.database.keys('item:*')))
+		self.assertEqual((None, ['item:2']), self.database.scan('item:0', 'item:*', 10))
+		self.database.rollback()
+		self.assertEqual(['item:2'], list(self.database.keys_with_prefix('item')))
+		self.database.rollback()
+		self.assertEqual(['item:1', 'item:2'], list(self.database.keys('item:?')))
+
+	def test_console_commands(self):
+		console = DBConsole(self.database)
+		self.assertEqual('item:1\nitem:2', console.execute(parse_command('KEYS item:*')))
+		self.assertEqual('>item:1\nitem:1', console.execute(parse_command('SCAN 0 MATCH item:* COUNT 1')))
+		self.assertEqual('0\nitem:2', console.execute(parse_command('SCAN >item:1 MATCH item:* COUNT 5')))
+		self.assertEqual('Invalid method or number of arguments', console.execute(parse_command('SCAN 0 MATCH')))
+		self.assertEqual('ERR key index disabled', DBConsole().execute(parse_command('KEYS *')))
+
+
+class TestUndoEngine(unittest.TestCase):
+
+	def setUp(self):
+		self.database = Database(engine='undo')
+
+	def test_same_output_as_redo(self):
+		for filename in INPUT_FILES:
+			with open(filename) as input_file:
+				commands = input_file.read()
+
+			self.assertEqual(run_stream(DBConsole(), commands), run_stream(DBConsole(Database(engine='undo')), commands))
+
+	def test_nested_rollback(self):
+		self.database.mset({'a': '1', 'b': '1'})
+		self.database.begin()
+		self.database.set('a', '2')
+		self.database.begin()
+		self.database.mset({'a': '3', 'b': None, 'c': '3'})
+		self.assertEqual('3', self.database.get('a'))
+		self.assertEqual(2, self.database.num_equal_to('3'))
+		self.assertTrue(self.database.rollback())
+		self.assertEqual({'a': '2', 'b': '1'}, self.database.database.data)
+		self.assertEqual({'1': 1, '2': 1}, self.database.database.values_freq)
+		self.assertTrue(self.database.rollback())
+		self.assertEqual({'a': '1', 'b': '1'}, self.database.database.data)
+		self.assertEqual({'1': 2}, self.database.database.values_freq)
+		self.assertFalse(self.database.rollback())
+
+	def test_command_log_gets_net_changes(self):
+		directory = tempfile.TemporaryDirectory()
+		self.addCleanup(directory.cleanup)
+		path = os.path.join(directory.name, 'commands.log')
+		command_log = open_command_log(self.database, path, 'always')
+		self.database.set('a', '1')
+		self.database.begin()
+		self.database.set('a', '2')
+		self.database.set('b', '2')
+		self.database.begin()
+		self.database.set('a', '1')
+		self.database.unset('b')
+		self.database.set('c', '3')
+		self.assertTrue(self.database.commit())
+		command_log.close()
+
+		with open(path) as log_file:
+			self.assertEqual('SET a 1\nSET c 3\n', log_file.read())
+
+	def test_ttl_survives_until_commit(self):
+		self.database.database.clock = lambda: 100.0
+		self.database.set('a', '1')
+		self.database.expire('a', 10)
+		self.database.begin()
+		self.database.set('a', '2')
+		self.database.rollback()
+		self.assertEqual(10, self.database.ttl('a'))
+		self.database.begin()
+		self.database.set('a', '2')
+		self.database.commit()
+		self.assertEqual(-1, self.database.ttl('a'))
+
+	def test_no_snapshot_within_transaction(self):
+		directory = tempfile.TemporaryDirectory()
+		self.addCleanup(directory.cleanup)
+		persistence = Persistence(self.database, os.path.join(directory.name, 'commands.log'),
+								  os.path.join(directory.name, 'data.snapshot'), 'never')
+		persistence.open()
+		self.addCleanup(persistence.close)
+		self.database.begin()
+		self.database.set('a', '1')
+		self.assertFalse(persistence.save())
+		self.database.commit()
+		self.assertTrue(persistence.save())
+
+	def test_unsupported_options(self):
+		self.assertRaises(ValueError, Database, engine='other')
+		self.assertRaises(ValueError, Database, engine='undo', mvcc=True)
+		self.assertRaises(ValueError, Database, engine='undo', key_index=True)
+		self.assertRaises(ValueError, self.database.session)
+
+
+class TestSavepoint(unittest.TestCase):
+
+	commands = (
+		'SET a 1\nBEGIN\nSET a 2\nSET b 2\nSAVEPOINT s1\nSET a 3\nUNSET b\nSET c 3\n'
+		'RELEASE\nGET a\nGET b\nNUMEQUALTO 3\nROLLBACK\nGET a\nGET c\nNUMEQUALTO 1\n'
+		'SAVEPOINT s1\nSET a 4\nBEGIN\nSET d 4\nROLLBACK TO s1\nGET a\nGET d\nSET e 5\n'
+		'ROLLBACK TO s2\nRELEASE s2\nRELEASE s1\nGET e\nRELEASE\nRELEASE\nROLLBACK TO s1\n'
+		'ROLLBACK FROM s1\nGET a\nGET e\nNUMEQUALTO 5\n'
+	)
+	output = (
+		'3\nNULL\n2\n1\nNULL\n1\n1\nNULL\nERR no such savepoint\nERR no such savepoint\n5\n'
+		'NO TRANSACTION\nNO TRANSACTION\nNO TRANSACTION\nInvalid method or number of arguments\n1\n5\n1\n'
+	)
+
+	def test_console(self):
+		self.assertEqual(self.output, run_stream(DBConsole(), self.commands))
+		self.assertEqual(self.output, run_stream(DBConsole(Database(engine='undo')), self.commands))
+		self.assertEqual(self.output, run_stream(DBConsole(Database().session()), self.commands))
+
+	def test_sharding(self):
+		database = ShardedDatabase(3)
+		self.addCleanup(database.close)
+		self.assertEqual(self.output, run_stream(DBConsole(database), self.commands))
+
+	def test_release_merges_into_parent(self):
+		database = Database()
+		database.begin()
+		database.mset({'a': '1', 'b': '1'})
+		database.savepoint('s1')
+		database.set('a', '2')
+		database.begin()
+		database.mset({'a': '3', 'c': '3'})
+		self.assertTrue(database.release('s1'))
+
+		handler = database.transaction_handler
+		self.assertEqual(1, handler.get_active_size())
+		self.assertEqual({'a': ['3'], 'b': ['1'], 'c': ['3']}, handler.transactions.data)
+		self.assertEqual({}, database.database.data)
+		self.assertTrue(database.rollback())
+		self.assertEqual({}, database.database.data)
+
+	def test_release_outermost_commits(self):
+		database = Database()
+		database.savepoint('s1')
+		database.set('a', '1')
+		self.assertTrue(database.release('s1'))
+		self.assertFalse(database.is_transaction_active())
+		self.assertEqual({'a': '1'}, database.database.data)
+		self.assertFalse(database.release())
+
+
+class TestSpill(unittest.TestCase):
+
+	def setUp(self):
+		self.database = Database(spill_threshold=10)
+
+	def test_transaction_reads_spilled_changes(self):
+		self.database.mset(dict(('key%d' % index, '0') for index in range(50)))
+		self.database.begin()
+		for index in range(40):
+			self.database.set('key%d' % index, '1')
+		self.database.unset('key45')
+
+		handler = self.database.transaction_handler
+		self.assertEqual(3, len(handler.runs))
+		self.assertLessEqual(len(handler.transactions.data), 10)
+		self.assertEqual('1', self.database.get('key0'))
+		self.assertIsNone(self.database.get('key45'))
+		self.assertEqual('0', self.database.get('key49'))
+		self.assertEqual([40, 9], self.database.num_equal_to_many(['1', '0']))
+		self.assertEqual({'0': 50}, self.database.database.values_freq)
+
+	def test_nested_rollback_over_spilled_changes(self):
+		self.database.begin()
+		self.database.mset(dict(('key%d' % index, '1') for index in range(30)))
+		self.database.begin()
+		self.database.mset({'key0': '2', 'key1': None, 'other': '2'})
+		self.assertEqual(2, self.database.num_equal_to('2'))
+		self.database.rollback()
+		self.assertEqual(['1', '1', None], self.database.mget(['key0', 'key1', 'other']))
+		self.assertEqual(30, self.database.num_equal_to('1'))
+
+	def test_commit_streams_runs(self):
+		directory = tempfile.TemporaryDirectory()
+		self.addCleanup(directory.cleanup)
+		path = os.path.join(directory.name, 'commands.log')
+		command_log = open_command_log(self.database, path, 'never')
+		self.database.begin()
+		for index in range(25):
+			self.database.set('key%d' % index, str(index % 2))
+		self.database.set('key0', 'last')
+		runs = list(self.database.transaction_handler.runs)
+		self.assertTrue(self.database.commit())
+		command_log.close()
+
+		self.assertTrue(all(run.map is None for run in runs))
+		self.assertEqual('last', self.database.get('key0'))
+		self.assertEqual({'0': 12, '1': 12, 'last': 1}, self.database.database.values_freq)
+
+		recovered = Database()
+		open_command_log(recovered, path).close()
+		self.assertEqual(self.database.database.data, recovered.database.data)
+
+
+class TestBulk(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def write_file(self, name, content):
+		path = os.path.join(self.directory.name, name)
+		with open(path, 'w') as output_file:
+			output_file.write(content)
+		return path
+
+	def test_export_and_import_every_format(self):
+		database = Database()
+		database.mset({'a': '1', 'b': '1', 'c,"d"': 'x"y'})
+		for format in FORMATS:
+			path = os.path.join(self.directory.name, 'data.' + format)
+			if format == 'tsv':
+				database.unset('c,"d"')
+			self.assertEqual(len(database.database.data), export_file(database, path)[0])
+
+			imported = Database(key_index=True)
+			self.assertEqual(len(database.database.data), import_file(imported, path)[0])
+			self.assertEqual(database.database.data, imported.database.data)
+			self.assertEqual(database.database.values_freq, imported.database.values_freq)
+			self.assertEqual(['a', 'b'], list(imported.keys('[ab]')))
+
+	def test_ranges_merged_in_order(self):
+		path = self.write_file('data.jsonl', '["a", "1"]\n{"key": "b", "value": "2"}\n\n["c", "1"]\n'
+										  '{"key": "a", "value": "2"}\n["c", null]\n["d", "2"]\n')
+		database = Database()
+		self.assertEqual(6, import_file(database, path, processes=2, range_size=8)[0])
+		self.assertEqual({'a': '2', 'b': '2', 'd': '2'}, database.database.data)
+		self.assertEqual({'2': 3}, database.database.values_freq)
+
+	def test_invalid_records(self):
+		contents = [
+			('data.csv', 'a,1\nb,hello world\n', 'line 2: invalid value'),
+			('data.csv', 'a,1\n\nb,\n', 'line 3: invalid value'),
+			('data.tsv', 'a\t1\n\t1\n', 'line 2: invalid key'),
+			('data.jsonl', '["a", "1"]\n{"key": "b", "value": true}\n', 'line 2: invalid value'),
+			('data.jsonl', '["a", "1"]\n["b"]\n', 'line 2: expected'),
+			('data.jsonl', '{"value": "1"}\n', 'line 1: expected'),
+			('data.jsonl', '["a", "1"]\n{\n', 'line 2: invalid JSON')
+		]
+		for name, content, message in contents:
+			path = self.write_file(name, content)
+			database = Database()
+			with self.assertRaises(ValueError) as context:
+				import_file(database, path)
+			self.assertTrue(str(context.exception).startswith(message), str(context.exception))
+			self.assertEqual({}, database.database.data)
+
+		path = self.write_file('data.csv', 'a,1\nb,2\nc,3\nd,x y\n')
+		with self.assertRaisesRegex(ValueError, '^line 4: '):
+			import_file(Database(), path, processes=2, range_size=4)
+
+		log_path = os.path.join(self.directory.name, 'commands.log')
+		database = Database()
+		command_log = open_command_log(database, log_path, 'never')
+		database.set('z', '0')
+		with self.assertRaisesRegex(ValueError, '^line 4: '):
+			import_file(database, path, processes=1, range_size=4)
+		command_log.close()
+		self.assertEqual({'z': '0'}, database.database.data)
+		recovered = Database()
+		open_command_log(recovered, log_path).close()
+		self.assertEqual({'z': '0'}, recovered.database.data)
+
+	def test_numbers_converted(self):
+		path = self.write_file('data.jsonl', '{"key": "n", "value": 5}\n["m", 5]\n["f", 1.5]\n')
+		log_path = os.path.join(self.directory.name, 'commands.log')
+		database = Database(range_index=True)
+		command_log = open_command_log(database, log_path, 'never')
+		import_file(database, path)
+		command_log.close()
+		self.assertEqual('2', DBConsole(database).execute(parse_command('NUMEQUALTO 5')))
+		self.assertEqual(2, database.num_range('5', '5'))
+
+		recovered = Database()
+		open_command_log(recovered, log_path).close()
+		self.assertEqual({'n': '5', 'm': '5', 'f': '1.5'}, recovered.database.data)
+
+	def test_import_into_existing_data_is_logged(self):
+		path = self.write_file('data.csv', 'a,2\nb,2\n')
+		log_path = os.path.join(self.directory.name, 'commands.log')
+		database = Database()
+		command_log = open_command_log(database, log_path, 'never')
+		database.set('a', '1')
+		import_file(database, path, processes=1)
+		command_log.close()
+
+		recovered = Database()
+		open_command_log(recovered, log_path).close()
+		self.assertEqual({'a': '2', 'b': '2'}, recovered.database.data)
+		self.assertEqual({'2': 2}, recovered.database.values_freq)
+
+	def test_console(self):
+		path = self.write_file('data.tsv', 'a\t1\nb\t1\n')
+		console = DBConsole()
+		self.assertRegex(console.execute(parse_command('LOAD %s' % path)), r'^OK 2 rows in [0-9.]+s \([0-9]+ rows/sec\)$')
+		self.assertEqual('2', console.execute(parse_command('NUMEQUALTO 1')))
+		self.assertRegex(console.execute(parse_command('EXPORT %s csv' % path)), r'^OK 2 rows')
+		self.assertIsNone(console.execute(parse_command('BEGIN')))
+		self.assertEqual('ERR the import is not allowed within a transaction',
+						 console.execute(parse_command('IMPORT %s csv' % path)))
+		self.assertIsNone(console.execute(parse_command('ROLLBACK')))
+		self.assertEqual('ERR line 1: expected a key and a value separated by a tab',
+						 console.execute(parse_command('IMPORT %s tsv' % path)))
+		self.assertTrue(console.execute(parse_command('LOAD data.txt')).startswith('ERR unknown format'))
+
+
+class TestStats(unittest.TestCase):
+
+	def test_histogram(self):
+		histogram = Histogram()
+		for value in range(1, 1001):
+			histogram.record(value)
+		self.assertEqual(1000, histogram.count())
+		self.assertAlmostEqual(500, histogram.percentile(0.5), delta=500 / 16)
+		self.assertAlmostEqual(990, histogram.percentile(0.99), delta=990 / 16)
+		self.assertAlmostEqual(1000, histogram.max(), delta=1000 / 16)
+		self.assertAlmostEqual(500.5, histogram.mean(), delta=500 / 16)
+		for value in list(range(100)) + [10 ** 6, 2 ** 62]:
+			low, high = bucket_range(bucket_of(value))
+			self.assertTrue(low <= value <= high)
+
+	def test_console(self):
+		stats = Stats()
+		console = DBConsole(stats=stats)
+		commands = 'SET a 1\nSET b 1\nBEGIN\nSAVEPOINT s\nSET c 2\nUNSET a\nCOMMIT\nGET a\nFOO\nGET\n'
+		self.assertEqual('NULL\n' + 'Invalid method or number of arguments\n' * 2, run_stream(console, commands))
+		info = stats.info(console.database)
+		self.assertEqual(10, info['commands_processed'])
+		self.assertEqual(3, info['commands']['SET']['calls'])
+		self.assertEqual(2, info['commands']['GET']['calls'])
+		self.assertEqual(1, info['commands']['UNKNOWN']['calls'])
+		self.assertEqual(2, info['transaction_depth_max'])
+		self.assertEqual(1, info['write_sets_committed'])
+		self.assertEqual(2, info['write_set_size_max'])
+		self.assertEqual((2, 2, 0), (info['keys'], info['values'], info['transaction_depth']))
+
+		output = console.execute(parse_command('INFO'))
+		self.assertIn('keys:2', output.split('\n'))
+		self.assertRegex(output, r'cmdstat_SET:calls=3,mean_us=[0-9.]+,p50_us=[0-9.]+')
+		self.assertEqual('OK', console.execute(parse_command('STATS RESET')))
+		self.assertEqual({'STATS': 1}, dict([(name, command['calls']) for name, command in stats.info()['commands'].items()]))
+		self.assertEqual('Invalid method or number of arguments', console.execute(parse_command('INFO FOO')))
+
+	def test_command_named_unknown(self):
+		stats = Stats()
+		console = DBConsole(stats=stats)
+		self.assertEqual('Invalid method or number of arguments\n' * 3, run_stream(console, 'FOO\nUNKNOWN\nUNKNOWN 1\n'))
+		self.assertEqual(3, stats.info()['commands']['UNKNOWN']['calls'])
+
+	def test_disabled(self):
+		console = DBConsole()
+		self.assertEqual(DBConsole.execute, console.execute.__func__)
+		console.execute(parse_command('BEGIN'))
+		console.execute(parse_command('SET a 1'))
+		self.assertEqual('expires:0\nkeys:0\ntransaction_depth:1\nvalues:0\nwrite_set_size:1',
+						 console.execute(parse_command('INFO')))
+
+		stats = console.enable_stats()
+		console.execute(parse_command('COMMIT'))
+		self.assertEqual(1, stats.info()['write_sets_committed'])
+		console.disable_stats()
+		self.assertEqual(DBConsole.execute, console.execute.__func__)
+
+	def test_slowlog(self):
+		slowlog = SlowLog(0, max_length=2)
+		console = DBConsole(stats=Stats(slowlog))
+		run_stream(console, 'SET a 1\nBEGIN\nMSET b 2 c 3 d 4\nCOMMIT\nSET %s 1\n' % ('x' * 200))
+		self.assertEqual(2, len(slowlog))
+		self.assertEqual(5, slowlog.next_id)
+		entries = console.execute(parse_command('SLOWLOG GET')).split('\n')
+		self.assertEqual(2, len(entries))
+		self.assertRegex(entries[0], r'^4 [0-9]+ [0-9]+us depth=0 keys=1 SET x{128} 1$')
+		self.assertRegex(entries[1], r'^3 [0-9]+ [0-9]+us depth=1 keys=3 COMMIT$')
+		self.assertEqual(1, len(console.execute(parse_command('SLOWLOG GET 1')).split('\n')))
+		self.assertEqual('2', console.execute(parse_command('SLOWLOG LEN')))
+		self.assertEqual('OK', console.execute(parse_command('SLOWLOG RESET')))
+		self.assertEqual([], slowlog.get()[1:])
+		self.assertEqual('Invalid method or number of arguments', console.execute(parse_command('SLOWLOG LEN 1')))
+
+		console = DBConsole(stats=Stats(SlowLog(10 ** 6)))
+		run_stream(console, 'SET a 1\nBEGIN\nCOMMIT\n')
+		self.assertEqual('0', console.execute(parse_command('SLOWLOG LEN')))
+		self.assertEqual('ERR slow log disabled', DBConsole().execute(parse_command('SLOWLOG LEN')))
+
+	def test_write_set_of_every_engine(self):
+		for database in (Database(engine='undo'), Database(spill_threshold=2)):
+			database.begin()
+			database.mset({'a': '1', 'b': '1', 'c': '1'})
+			self.assertEqual(3, database.transaction_handler.get_write_set_size())
+
+
+class TestProfile(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def test_commands_limit(self):
+		path = os.path.join(self.directory.name, 'profile.pstats')
+		console = DBConsole()
+		operations = console.operations
+		commands = 'PROFILE START cprofile %s COMMANDS 3\nSET a 1\nBEGIN\nSET a 2\nGET a\nPROFILE STOP\n' % path
+		self.assertEqual('OK\n2\nERR no profile running\n', run_stream(console, commands))
+		self.assertIs(operations, console.operations)
+		functions = [function for _, _, function in pstats.Stats(path).stats]
+		self.assertIn('begin', functions)
+		self.assertNotIn('format_value', functions)
+
+	def test_sampling_seconds(self):
+		path = os.path.join(self.directory.name, 'profile.folded')
+		console = DBConsole()
+		self.assertEqual('OK', console.execute(parse_command('PROFILE START sampling %s SECONDS 0.05' % path)))
+		while console.profile_session is not None:
+			console.execute(parse_command('NUMEQUALTO 1'))
+		with open(path) as input_file:
+			lines = input_file.read().splitlines()
+		self.assertTrue(lines)
+		for line in lines:
+			self.assertRegex(line, r'^.+;test.py:TestProfile.test_sampling_seconds(;.+)? [0-9]+$')
+
+	def test_invalid_arguments(self):
+		console = DBConsole()
+		path = os.path.join(self.directory.name, 'profile')
+		for arguments in ('foo %s' % path, 'cprofile', 'cprofile %s SECONDS' % path, 'cprofile %s SECONDS x' % path,
+						  'cprofile %s COMMANDS 0' % path, 'cprofile %s' % os.path.join(path, 'missing')):
+			self.assertTrue(console.execute(parse_command('PROFILE START ' + arguments)).startswith('ERR'))
+		self.assertEqual('OK', console.execute(parse_command('PROFILE START cprofile ' + path)))
+		self.assertEqual('ERR a profile is already running', console.execute(parse_command('PROFILE START cprofile ' + path)))
+		self.assertRegex(console.execute(parse_command('PROFILE STOP')), r'^OK 0 commands profiled in [0-9.]+s')
+		self.assertEqual('Invalid method or number of arguments', console.execute(parse_command('PROFILE FOO')))
+
+	def test_server(self):
+		path = os.path.join(self.directory.name, 'profile.folded')
+
+		async def run():
+			database_server = DatabaseServer(Database(), allow_file_commands=True)
+			server = await database_server.start('127.0.0.1', 0)
+			async with server:
+				address = server.sockets[0].getsockname()
+				reader, writer = await asyncio.open_connection(address[0], address[1])
+				writer.write(('PROFILE START sampling %s SECONDS 0.1\n' % path).encode('utf-8'))
+				started = await reader.readline()
+				other_reader, other = await asyncio.open_connection(address[0], address[1])
+				other.write(b'SET a 1\nGET a\n')
+				reply = await other_reader.readline()
+				await asyncio.sleep(0.2)
+				writer.write(b'PROFILE STOP\nEND\n')
+				stopped = await reader.readline()
+				other.close()
+				writer.close()
+				return (started, reply, stopped, database_server.profile_session)
+
+		self.assertEqual((b'OK\n', b'1\n', b'ERR no profile running\n', None), asyncio.run(run()))
+		self.assertTrue(os.path.getsize(path))
+
+
+class TestReplication(unittest.TestCase):
+
+	def setUp(self):
+		self.reconnect_interval = replication.RECONNECT_INTERVAL
+		replication.RECONNECT_INTERVAL = 0.01
+
+	def tearDown(self):
+		replication.RECONNECT_INTERVAL = self.reconnect_interval
+
+	async def send(self, server, commands, replies):
+		"""Sends commands to a server through a new connection and returns the reply lines"""
+		address = server.sockets[0].getsockname()
+		reader, writer = await asyncio.open_connection(address[0], address[1])
+		writer.write(commands.encode('utf-8'))
+		lines = [(await reader.readline()).decode('utf-8').rstrip('\n') for _ in range(replies)]
+		writer.close()
+		return lines
+
+	async def wait_for(self, condition):
+		for _ in range(500):
+			if condition():
+				return
+			await asyncio.sleep(0.01)
+		self.fail('the replica did not catch up')
+
+	def run_replication(self, test, backlog_size=replication.BACKLOG_SIZE):
+		"""Runs a test with a primary server and a replica server following it"""
+		async def run():
+			primary_database = Database()
+			primary_database.mset({'a': '1', 'b': '1'})
+			primary = DatabaseServer(primary_database)
+			primary.primary = replication.Primary(primary_database, backlog_size, heartbeat_interval=0.01)
+			primary_server = await primary.start('127.0.0.1', 0)
+			replica_database = Database()
+			replica = DatabaseServer(replica_database, replica_of='127.0.0.1:%d' % primary_server.sockets[0].getsockname()[1])
+			replica.replica.heartbeat_interval = 0.01
+			replica_server = await replica.start('127.0.0.1', 0)
+			following = asyncio.get_running_loop().create_task(replica.replica.run())
+			try:
+				async with primary_server, replica_server:
+					return await test(primary, primary_server, replica, replica_server)
+			finally:
+				following.cancel()
+				primary.primary.close()
+		return asyncio.run(run())
+
+	def test_stream(self):
+		async def test(primary, primary_server, replica, replica_server):
+			data = replica.database.database
+			await self.wait_for(lambda: replica.replica.connected)
+			self.assertEqual({'a': '1', 'b': '1'}, data.data)
+			await self.send(primary_server, 'SET c 2\nBEGIN\nSET d 3\nUNSET a\nCOMMIT\nBEGIN\nSET e 5\nROLLBACK\nEND\n', 0)
+			await self.wait_for(lambda: replica.replica.offset == primary.primary.offset)
+			self.assertEqual(primary.database.database.data, data.data)
+			self.assertEqual(primary.database.database.values_freq, data.values_freq)
+
+			lines = await self.send(replica_server, 'GET d\nSET x 1\nNUMEQUALTO 1\nREPLICATION\n', 6)
+			self.assertEqual(['3', replication.READONLY, '1', 'connected_replicas:0', 'full_syncs:1'], lines[:5])
+			await self.wait_for(lambda: primary.primary.info()['replica0'].split(',')[2] == 'lag_bytes=0')
+			lines = await self.send(primary_server, 'REPLICATION\n', 6)
+			self.assertIn('role:primary', lines)
+			self.assertIn('replication_offset:%d' % primary.primary.offset, lines)
+			self.assertGreaterEqual(replica.replica.lag, 0.0)
+
+			for link in list(primary.primary.links):
+				link.writer.close()
+			await self.send(primary_server, 'SET f 6\nEND\n', 0)
+			await self.wait_for(lambda: data.get('f') == '6')
+			self.assertEqual((1, 1), (replica.replica.full_syncs, replica.replica.partial_syncs))
+
+		self.run_replication(test)
+
+	def test_full_resync_once_backlog_is_over(self):
+		async def test(primary, primary_server, replica, replica_server):
+			await self.wait_for(lambda: replica.replica.connected)
+			for link in list(primary.primary.links):
+				link.writer.close()
+			await self.send(primary_server, 'MSET c 1 d 1 e 1 f 1\nSET g 2\nEND\n', 0)
+			await self.wait_for(lambda: replica.replica.full_syncs == 2)
+			await self.wait_for(lambda: replica.database.database.data == primary.database.database.data)
+			self.assertEqual(0, replica.replica.partial_syncs)
+
+		self.run_replication(test, backlog_size=8)
+
+	def test_apply_stream(self):
+		follower = replication.Replica(Database(), '127.0.0.1', 0)
+		follower.offset = 0
+		follower.apply_lines([b'SET a 1', b'BEGIN', b'SET b 1'])
+		self.assertEqual((8, {'a': '1'}), (follower.offset, follower.data.data))
+		follower.apply_lines([b'UNSET a', b'COMMIT', b'PING 0'])
+		self.assertEqual((37, {'b': '1'}), (follower.offset, follower.data.data))
+		self.assertGreater(follower.lag, 0)
+		with self.assertRaises(ValueError):
+			follower.apply_lines([b'GET a'])
+
+
+class TestDBConsole(unittest.TestCase):
+
+	def test_stream_matches_interactive(self):
+		for filename in INPUT_FILES:
+			with open(filename) as input_file:
+				commands = input_file.read()
+
+			expected = run_interactive(DBConsole(), commands)
+			self.assertEqual(expected, run_stream(DBConsole(), commands))
+			self.assertEqual(expected, run_stream(DBConsole(chunk_size=3, flush_threshold=1), commands))
+
+	def test_stream_stops_at_end(self):
+		commands = 'SET a 1\nGET a\nEND\nGET a\n'
+		self.assertEqual('1\n', run_stream(DBConsole(), commands))
+
+	def test_stream_without_trailing_newline(self):
+		commands = 'SET a 1\n\nget a'
+		self.assertEqual('1\n', run_stream(DBConsole(), commands))
+
+	def test_parse_command(self):
+		self.assertEqual(('SET', ['a', '10']), parse_command('set a  10\n'))
+		self.assertEqual(('COMMIT', []), parse_command('COMMIT'))
+		self.assertIsNone(parse_command('   '))
+
+	def test_execute_command(self):
+		console = DBConsole()
+		self.assertIsNone(console.execute(parse_command('SET a 10')))
+		self.assertEqual('10', console.execute(parse_command('GET a')))
+		self.assertEqual('NULL', console.execute(parse_command('GET b')))
+		self.assertEqual('1', console.execute(parse_command('NUMEQUALTO 10')))
+		self.assertEqual('NO TRANSACTION', console.execute(parse_command('ROLLBACK')))
+		self.assertEqual('Invalid method or number of arguments', console.execute(parse_command('GET a b')))
+
+	def test_register_operation(self):
+		console = DBConsole()
+		console.register('DOUBLE', 1, lambda value: int(value) * 2, str)
+		self.assertEqual('42', console.execute(parse_command('double 21')))
+
+	def test_shared_database(self):
+		database = Database()
+		DBConsole(database).execute(parse_command('SET a 10'))
+		self.assertEqual('10', database.get('a'))
+
+	def test_stream_invalid_command(self):
+		commands = 'SET a\nFOO\n'
+		output = 'Invalid method or number of arguments\n' * 2
+		self.assertEqual(output, run_stream(DBConsole(), commands))
+
+
 if __name__ == '__main__':
 	unittest.main()
 